@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+'''Medicion de los recorridos especializados de shia_v1 (run_shia con fastKernel):
+tiempo de run_shia con fastKernel = True y con fastKernel = False en la cuenca
+sintetica de cuenca_sintetica.py, para laderas lineales y con onda cinematica.
+Revisa ademas que los dos recorridos den los mismos resultados.
+
+Uso: python Benchmark_Kernel.py [n] [--guardar]
+   n: lado de la cuenca sintetica en celdas (60 por defecto).
+   --guardar: agrega los resultados con la fecha a Benchmark_Kernel.txt.'''
+import os
+import sys
+import time
+import datetime
+import tempfile
+import platform
+import numpy as np
+import cuenca_sintetica
+
+CALIB = np.ones(11)
+Nintervals = 288 * 6
+Repeticiones = 7
+
+def corre(b, path, fastKernel):
+    '''Mejor tiempo de Repeticiones ejecuciones y los resultados de la ultima.'''
+    mejor = np.inf
+    for i in range(Repeticiones):
+        b.set_Storage(1.0, 0); b.set_Storage(1.0, 1); b.set_Storage(1.0, 2)
+        b.set_Storage(1.0, 3); b.set_Storage(1.0, 4)
+        t = time.time()
+        R = b.run_shia(CALIB, path, Nintervals, 0, EvpVariable = False,
+            QsimDataFrame = False, fastKernel = fastKernel)
+        mejor = min(mejor, time.time() - t)
+    return mejor, dict((k, np.array(v)) for k, v in R.items())
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 and sys.argv[1].isdigit() else 60
+    path = os.path.join(tempfile.mkdtemp(), 'lluvia.bin')
+    b = cuenca_sintetica.cuenca(n, 'cells')
+    cuenca_sintetica.lluvia(b, path, Nintervals)
+    lineas = []
+    for tipos in [[1, 1, 1], [2, 1, 1], [2, 2, 2]]:
+        b.set_Speed_type(tipos)
+        t0, R0 = corre(b, path, False)
+        t1, R1 = corre(b, path, True)
+        igual = all(np.array_equal(R0[k], R1[k]) for k in R0 if k != 'Kernel')
+        lineas.append('celdas %d intervalos %d velocidades %s: general %.3f s, especializado %.3f s (kernel %d), speedup %.2f, iguales %s' % (
+            b.ncells, Nintervals, ''.join(map(str, tipos)), t0, t1, R1['Kernel'], t0 / t1, igual))
+        print(lineas[-1])
+    if '--guardar' in sys.argv:
+        f = open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Benchmark_Kernel.txt'), 'a')
+        f.write('%s, %s, python %s\n' % (datetime.datetime.now().strftime('%Y-%m-%d %H:%M'),
+            platform.processor() or platform.machine(), platform.python_version()))
+        for l in lineas:
+            f.write('   %s\n' % l)
+        f.close()
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+'''Prueba de set_Partition: la simulacion de la cuenca partida en subdominios
+(run_shia con nthreads > 1) debe dar los mismos caudales y almacenamientos,
+bit a bit, que la simulacion de la cuenca completa en serie.
+
+Uso: python Prueba_Particion.py
+Los hilos solo se usan si models se compilo con OpenMP (WMF_OPENMP=1 en setup.py),
+sin OpenMP la ejecucion es serial y la prueba solo revisa la particion.'''
+import os
+import sys
+import tempfile
+import numpy as np
+import cuenca_sintetica
+
+CALIB = np.ones(11)
+
+def simula(b, path, Nintervals, nthreads):
+    '''Corre el modelo desde el mismo almacenamiento inicial, retorna Qsim y Storage.'''
+    b.set_Storage(1.0, 0); b.set_Storage(1.0, 1); b.set_Storage(1.0, 2)
+    b.set_Storage(1.0, 3); b.set_Storage(1.0, 4)
+    R = b.run_shia(CALIB, path, Nintervals, 0, EvpVariable = False, nthreads = nthreads,
+        QsimDataFrame = False)
+    return np.array(R['Qsim']), np.array(R['Storage'])
+
+if __name__ == '__main__':
+    Nintervals = 288
+    path = os.path.join(tempfile.mkdtemp(), 'lluvia.bin')
+    fallas = 0
+    for modelType in ['cells', 'hills']:
+        b = cuenca_sintetica.cuenca(60, modelType)
+        cuenca_sintetica.lluvia(b, path, Nintervals)
+        b.set_Partition()
+        Q0, S0 = simula(b, path, Nintervals, 1)
+        N = b.ncells if modelType == 'cells' else b.nhills
+        for Nparts, Nodes in [(2, None), (4, None), (8, None), (None, [N//20, N//4, N//2])]:
+            tamanos = b.set_Partition(Nparts, Nodes)
+            for nthreads in [2, 4]:
+                Q, S = simula(b, path, Nintervals, nthreads)
+                igual = np.array_equal(Q, Q0) and np.array_equal(S, S0)
+                fallas += not igual
+                print('%s Nparts %s Nodes %s subdominios %d hilos %d: %s' % (modelType,
+                    Nparts, Nodes, len(tamanos), nthreads, 'igual' if igual else 'DIFERENTE'))
+        b.set_Partition()
+    sys.exit(1 if fallas else 0)
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+'''Cuenca sintetica para las pruebas y mediciones de Examples: un cono de n x n
+celdas que drena a una esquina, con parametros fijos y una lluvia interpolada
+de estaciones aleatorias. No necesita mapas ni GDAL.'''
+import numpy as np
+import pandas as pd
+from wmf import wmf
+
+def cuenca(n = 60, modelType = 'cells', semilla = 0):
+    '''Traza la cuenca sintetica de n x n celdas de 30 m y le asigna los
+    parametros del modelo. Retorna la SimuBasin.'''
+    rng = np.random.RandomState(semilla)
+    #Coordenadas planas en metros (cualquier EPSG positivo traza la cuenca)
+    wmf.Global_EPSG = 3116
+    wmf.cu.ncols = n + 2; wmf.cu.nrows = n; wmf.cu.xll = 0.0; wmf.cu.yll = 0.0
+    wmf.cu.dx = 30.0; wmf.cu.dy = 30.0; wmf.cu.dxp = 30.0; wmf.cu.nodata = -9999.0
+    #DEM en cono hacia la salida (columna 1, fila n) y direcciones por maxima pendiente
+    C, F = np.meshgrid(np.arange(1, n+1), np.arange(1, n+1), indexing = 'ij')
+    DEM = np.hypot(C - 1, F - n) * 10 + rng.rand(n, n) * 3 + 100
+    DEM[0, n-1] = 0
+    DIR = np.zeros((n, n), dtype = int)
+    for c in range(n):
+        for f in range(n):
+            mejor = None
+            for dc in (-1, 0, 1):
+                for df in (-1, 0, 1):
+                    cc, ff = c + dc, f + df
+                    if (dc, df) != (0, 0) and 0 <= cc < n and 0 <= ff < n:
+                        s = (DEM[c, f] - DEM[cc, ff]) / np.hypot(dc, df)
+                        if mejor is None or s > mejor[0]:
+                            mejor = (s, dc, df)
+            DIR[c, f] = -3 * mejor[2] + mejor[1] + 5
+    DIR[0, n-1] = 1
+    #Dos columnas de borde para que la salida quede dentro del mapa
+    DIR = np.vstack([DIR, np.ones((2, n), dtype = int) * 6])
+    DEM = np.vstack([DEM, np.ones((2, n)) * 500])
+    #La salida es el centro de la celda de la esquina inferior izquierda
+    b = wmf.SimuBasin(15.0, 15.0, DEM, DIR, threshold = 20, modelType = modelType, dt = 300)
+    b.set_Geomorphology([20, 20])
+    #Parametros: tanques con onda cinematica en laderas y cauce
+    b.set_Speed_type([2, 2, 2])
+    for pos, v in enumerate([0.001, 0.001, 0.001, 0.001]):
+        b.set_PhysicVariables('v_coef', v, pos)
+    for pos, v in enumerate([0.5, 0.5, 0.5, 1.0]):
+        b.set_PhysicVariables('h_coef', v, pos)
+        b.set_PhysicVariables('h_exp', 0.5, pos)
+    b.set_PhysicVariables('capilar', 5.0, 0)
+    b.set_PhysicVariables('gravit', 30.0, 0)
+    return b
+
+def lluvia(b, path, Nintervals = 288, semilla = 1):
+    '''Escribe en path la lluvia de Nintervals intervalos de 5 minutos
+    interpolada (IDW) de 8 estaciones aleatorias, con un periodo seco.'''
+    rng = np.random.RandomState(semilla)
+    lado = wmf.cu.nrows * wmf.cu.dx
+    coord = rng.rand(2, 8) * lado
+    reg = pd.DataFrame(np.maximum(rng.gamma(0.3, 4, (Nintervals, 8)) - 1, 0),
+        index = pd.date_range('2020-01-01', periods = Nintervals, freq = '5min'))
+    reg.iloc[Nintervals // 4: Nintervals // 2] = 0
+    return b.rain_interpolate_idw(coord, reg, path)
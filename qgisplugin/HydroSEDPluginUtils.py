@@ -864,44 +864,16 @@ class controlHS(object):
    
     def BasinConvert2HillsOrChannels(self, Var, Metodo, Agregado):
         '''Agrega una variable por canales o laderas de acuerdo a una metodologia'''
-        #Funcion de metodologias
-        def __fx__(x, metodo = 'media'):
-            if metodo == 'media':
-                return np.nanmean(x)
-            elif metodo[0] == 'P':
-                percentil = int(metodo[1:])
-                return np.nanpercentile(x, percentil)
-            elif metodo == 'min':
-                return np.nanmin(x)
-            elif metodo == 'max':
-                return np.nanmax(x)
-            elif metodo == 'moda':
-                res = stat.mode(x)
-                return res.mode[0]
-        #Variable vacia nula
-        VarAgregada = np.ones(self.cuenca.ncells)*wmf.cu.nodata
-        #Itera por las laderas del elemento cuenca
-        for i in range(1,self.cuenca.nhills+1):
-            #Define posiciones de acuerdo a la metodologia
-            hacer = True
-            pos = np.where(self.cuenca.hills_own == i)[0]
-            if Agregado == 'Canales':
-                pos2 = np.where((self.cuenca.hills_own == i) & (self.cuenca.CellCauce == 1))[0]
-                if len(pos2)==0:
-                    hacer = False
-                else:
-                    pos = pos2
-            #Agrega la variable
-            if hacer:
-                VarTemporal = __fx__(Var[pos], Metodo)
-                VarAgregada[pos] = VarTemporal
-            #correccion no data de canales 
-        #if Agregado == 'Canales':
-            #posMalos = np.where((self.cuenca.CellCauce == 1) & (VarAgregada == wmf.cu.nodata))[0]
-            #print posMalos
-                ##posBuenos = np.where((self.cuenca.CellCauce == 1) & (VarAgregada <> wmf.cu.nodata))[0]
-                #VarAgregada[posMalos] = VarAgregada[posBuenos].mean()
-                #print VarAgregada[posMalos].min()
+        #Nombre de la metodologia en wmf (media, Pxx, min, max, moda)
+        Estadistico = {'media': 'mean', 'moda': 'mode'}.get(Metodo, Metodo)
+        Canales = Agregado == 'Canales'
+        #Agrega la variable por laderas o por tramos de cauce en una sola pasada
+        VarLaderas = self.cuenca.Transform_Basin2HillsStats(Var, stats = [Estadistico],
+            channels = Canales, nodata = wmf.cu.nodata)[Estadistico]
+        VarAgregada = self.cuenca.Transform_Hills2Basin(VarLaderas)
+        #En el caso de canales las laderas quedan sin dato
+        if Canales:
+            VarAgregada[self.cuenca.CellCauce != 1] = wmf.cu.nodata
         return VarAgregada
     
     def Radar_FechasProcess(self, Fi, Ff, TimeStep, FechasRadar, ListaRadar):
@@ -4,8 +4,13 @@ from numpy.distutils.core import setup, Extension
 
 ext1 = Extension(name = 'cu',
                  sources = ['wmf/cuencas.f90'])
+#models se compila serial, con WMF_OPENMP=1 (gfortran) se compila con OpenMP
+#para usar nthreads en run_shia
+omp = os.environ.get('WMF_OPENMP', '0') == '1'
 ext2 = Extension(name = 'models',
-                 sources = ['wmf/modelosv2.f90'])
+                 sources = ['wmf/modelosv2.f90'],
+                 extra_f90_compile_args = ['-fopenmp'] if omp else [],
+                 extra_link_args = ['-lgomp'] if omp else [])
 
 setup(
     name='wmf',
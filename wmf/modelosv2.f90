@@ -59,6 +59,8 @@ real, allocatable :: elem_area(:,:) !Area de cada elemento de la cuenca, si es c
 
 
 !Variables de propiedades fisicas
+!Los mapas de parametros v_coef, h_coef, h_exp, Max_capilar, Max_gravita y Max_aquifer pueden
+!tener segunda dimension 1 si son uniformes en la cuenca, su valor aplica a todas las celdas
 real, allocatable :: v_coef(:,:) !Coeficientes de velocidades verticales [LT-1] [4,Nceldas]: 1. Evp, 2. Ks, 3. Kp, 4. kpp
 real, allocatable :: v_exp(:,:)  !Exponentes de velocidades verticales no lineales [adim] [4,Nceldas]. (no implementado)
 real, allocatable :: h_coef(:,:) !Coeficientes de velocidades horizontales [L] [4,Nceldas]: 1. runoff, 2. sub-sup, 3. subte, 4. cauce
@@ -94,7 +96,34 @@ integer, allocatable :: control(:,:) !Celdas de la cuenca que tienen puntos de c
 integer, allocatable :: control_h(:,:) !Celdas de la cuenca que son puntos de control de humedad
 integer, allocatable :: guarda_cond(:) !Intervalos de tiempo en que se hace guardado de condiciones
 integer, allocatable :: guarda_vfluxes(:) !Intervalos de tiempo en que se hace guardado de los vfluxes
-integer calc_niter !Cantidad de iteraciones para la ecuacion de solucion numerica (defecto 5)
+integer calc_niter !Cantidad de iteraciones para la ecuacion de solucion numerica (defecto 5), maximo si calc_tol > 0
+real calc_tol !Tolerancia relativa de la velocidad en calc_speed (Newton), si es 0 hace calc_niter iteraciones de promedio
+integer(kind=8) calc_count(4) !Contadores de calc_speed en la ultima ejecucion: 1. soluciones, 2. iteraciones, 3. sin converger,
+!4. soluciones remplazadas por la recesion de la mascara de actividad (ver act_tol)
+real route_courant !Courant maximo (v*dt/long) del transito por onda cinematica, se divide en subpasos si se supera (0: sin subpasos)
+integer route_maxsub !Maximo de subpasos en un intervalo
+integer route_hills !(1) tambien divide en subpasos los tanques de ladera por onda cinematica, (0) solo el cauce
+real, allocatable :: route_sto0(:,:) !Almacenamiento al inicio del intervalo (5,N_cel), solo se usa con subpasos
+real act_tol !Cambio relativo del almacenamiento de un tanque cinematico bajo el cual no se resuelve y sale por recesion (0: siempre resuelve)
+real, allocatable :: act_sto(:,:) !Almacenamiento de cada tanque en su ultima solucion completa (5,N_cel), solo con act_tol > 0
+real, allocatable :: act_ratio(:,:) !Fraccion del almacenamiento que salio en esa solucion (5,N_cel)
+real, allocatable :: act_errcell(:) !Cota del error de volumen [mm] de la recesion en cada celda durante el intervalo
+real, allocatable :: act_error(:) !Cota del error de volumen [mm] de la recesion en cada intervalo (N_reg), suma sobre las celdas
+integer shia_threads !Hilos de OpenMP en shia_v1 (0 o 1: recorrido serial por celdas)
+integer shia_fast !(1) usa shia_v1_plain en las ejecuciones seriales que no tienen opciones extra, (0) siempre el recorrido general
+integer shia_kernel !Recorrido usado en la ultima ejecucion: 1. general, 2. shia_v1_plain, 3. shia_v1_plain con laderas lineales, 4. shia_v1_step
+integer, allocatable :: sub_domain(:,:) !Subdominio de cada elemento para shia_v1 en paralelo (ver route_partition), ceros: sin particion
+!Binarios de lluvia abiertos durante una ejecucion (1: lluvia, 2: convectiva, 3: estratiforme)
+integer rain_prefetch !Cantidad de records de lluvia leidos en cada lectura (0 o 1: uno a la vez)
+integer rain_units(3) !Unidad abierta de cada binario
+integer rain_isSparse(3) !(1) si el binario esta en formato disperso
+integer rain_nrec(3) !Cantidad de records del binario
+integer rain_bufFirst(3), rain_bufN(3) !Primer record y cantidad de records en el buffer
+integer(kind=8) rain_offpos(3) !Posicion de la tabla de offsets de un binario disperso
+integer, allocatable :: rain_buffer(:,:,:) !Records leidos por adelantado (N_cel, rain_prefetch, 3)
+!Lluvia en memoria (la asigna SimuBasin.run_shia), en este caso no se lee ruta_bin ni ruta_hdr
+integer rain_in_memory !(1) lee la lluvia de rain_fields con los records de posEvento
+integer, allocatable :: rain_fields(:,:) !Campos de lluvia [mm*1000] (N_cel, N_records), el record 1 es seco
 
 !Variables de resultados globales (siempre van a estar ahi)
 real, allocatable :: Storage(:,:) !Almacenamiento de los 5 tanques del modelo
@@ -220,14 +249,24 @@ subroutine shia_v1(ruta_bin,ruta_hdr,calib,StoIn,HspeedIn,N_cel,N_cont,N_contH,N
 	integer RainInt(N_cel)
 	integer Conv(N_cel),Stra(N_cel),Co,St !Unos o ceros si hay o no lluvia conv o strati en cada celda en un intervalo
 	integer Res !Dice si se leyo bien o no la lluvia 
-	real rain_sum
+	real(kind=8) rain_sum
 	!Variables de iteracion
 	integer celda,tiempo !Iteradores para la cantidad de celdas y los intervalos de tiempo
 	real tiempo_r !Version real del tiempo, sirve solo para verbose 
     integer drenaid !Vector con el id a donde drena cada celda
-    integer control_cont, controlh_cont, i
-    !Variables para el balance
-    real entradas, salidas, StoAtras
+    integer control_cont, controlh_cont, i, ic, ie
+    real fila(N_cel) !Fila de un mapa de parametros (ver param_row)
+    !Variables para el balance, en doble precision para que el balance solo muestre
+    !el error de redondeo de los almacenamientos y no el de las sumas sobre la cuenca
+    real(kind=8) entradas, salidas, StoAtras
+    !Variables de la ejecucion en paralelo (ver shia_v1_step)
+    integer par_mode, N_serial, N_lev, N_grp, hilos
+    integer hills_lin !(1) los tanques 2 a 4 son lineales (shia_v1_plain)
+    real, allocatable :: hill_frac(:,:), kin_coef(:,:) !Coeficientes fijos de shia_v1_plain
+    integer(kind=8) kin_cnt(4) !Contadores de calc_speed (ver calc_count)
+    integer, allocatable :: up_ptr(:), up_idx(:), lev_ptr(:), grp_ptr(:), grp_cells(:), par_dom(:)
+    integer, allocatable :: pos_control(:), pos_controlh(:)
+    real, allocatable :: par_vflux(:,:), par_evp(:), par_out(:,:)
 	!Variables de conversion
 	real m3_mmHill(N_cel) !Convierte mm a m3 o viceversa se basa en el area del elemento.
 	real m3_mmRivers(N_cel)
@@ -253,8 +292,13 @@ subroutine shia_v1(ruta_bin,ruta_hdr,calib,StoIn,HspeedIn,N_cel,N_cont,N_contH,N
 	!--------------------------------------------------------------------------
     !PREPARACION BASICA DEL MODELO
     !--------------------------------------------------------------------------
-	!Lee los vectores de estructura de guardado de la lluvia 
-	call rain_read_ascii_table(ruta_hdr,N_reg)
+	!Lee los vectores de estructura de guardado de la lluvia y abre el binario
+	!una sola vez para toda la ejecucion (si la lluvia esta en memoria ya
+	!estan posEvento y rain_fields)
+	if (rain_in_memory .ne. 1) then
+		call rain_read_ascii_table(ruta_hdr,N_reg)
+		call rain_unit_open(ruta_bin, 1, N_cel, Res)
+	endif
 	!Inicia la variable global de lluvia promedio sobre la cuenca
 	if (allocated(Mean_Rain)) deallocate(Mean_Rain)
 	allocate(Mean_Rain(1,N_reg))
@@ -278,6 +322,7 @@ subroutine shia_v1(ruta_bin,ruta_hdr,calib,StoIn,HspeedIn,N_cel,N_cont,N_contH,N
 	entradas=0
 	salidas=0
 	balance = 0	
+	kin_cnt = 0
 	!Calcula parametros que cambien con el tiempo
 	! Calib 1 2 3 y 4: Velocidad vertical, 1. vel evp, los demas vel prof.
 	! Calib 5 6 7 y 8: Velocidad Hztal tanques 2 3 4 y 5
@@ -289,9 +334,11 @@ subroutine shia_v1(ruta_bin,ruta_hdr,calib,StoIn,HspeedIn,N_cel,N_cont,N_contH,N
 		!Velocidades horizontales estimadas desde parametros sin condiciones previas.
 		do i=1,4
 			!Calculo de velocidades iniciales 
-			vspeed(i,:)=v_coef(i,:)*Calib(i)*dt ! Cantidad [mm] que baja de tanque a tanque
+			call param_row(v_coef, 4, size(v_coef,2), i, N_cel, fila)
+			vspeed(i,:)=fila*Calib(i)*dt ! Cantidad [mm] que baja de tanque a tanque
 			if (speed_type(i) .eq. 1) then 
-				hspeed(i,:)=h_coef(i,:)*Calib(i+4) ! Velocidad [mm/seg] que se mueve
+				call param_row(h_coef, 4, size(h_coef,2), i, N_cel, fila)
+				hspeed(i,:)=fila*Calib(i+4) ! Velocidad [mm/seg] que se mueve
 			else
 				hspeed(i,:) = 0.0 ! Velocidad de arranque para las ecuaciones no lineales horizontales
 			endif		
@@ -299,9 +346,12 @@ subroutine shia_v1(ruta_bin,ruta_hdr,calib,StoIn,HspeedIn,N_cel,N_cont,N_contH,N
 	endif
 	
 	!Calcula parametros estaticos en el tiempo
-	H(1,:)=Max_capilar(1,:)*Calib(9)
-	H(2,:)=Max_gravita(1,:)*Calib(10)
-	H(3,:)=Max_aquifer(1,:)*Calib(11)
+	call param_row(Max_capilar, 1, size(Max_capilar,2), 1, N_cel, fila)
+	H(1,:)=fila*Calib(9)
+	call param_row(Max_gravita, 1, size(Max_gravita,2), 1, N_cel, fila)
+	H(2,:)=fila*Calib(10)
+	call param_row(Max_aquifer, 1, size(Max_aquifer,2), 1, N_cel, fila)
+	H(3,:)=fila*Calib(11)
 	
 	!--------------------------------------------------------------------------
     !PREPARACION OPCIONAL DEL MODELO 
@@ -357,6 +407,8 @@ subroutine shia_v1(ruta_bin,ruta_hdr,calib,StoIn,HspeedIn,N_cel,N_cont,N_contH,N
 		Qsep_byrain = 0
 		!Lectura de posiciones de eventos en el tiempo de cada caso.
 		call rain_read_ascii_table_separate(ruta_hdrConv,ruta_hdrStra,N_reg)
+		call rain_unit_open(ruta_binConv, 2, N_cel, Res)
+		call rain_unit_open(ruta_binStra, 3, N_cel, Res)
 	endif
 	!Preparacion para el caso en que se muestra en la salida el alm promedio por tanque 
 	if (show_storage .eq. 1) then 
@@ -424,6 +476,96 @@ subroutine shia_v1(ruta_bin,ruta_hdr,calib,StoIn,HspeedIn,N_cel,N_cont,N_contH,N
         !set the variable equals to 0
         rc_coef = 0
     endif
+    
+    !Prepara la ejecucion en paralelo, solo para las opciones en las que cada celda
+    !escribe unicamente sobre si misma (sin sedimentos, deslizamientos, inundaciones,
+    !separacion de flujos ni separacion por tipo de lluvia). Si models se compilo
+    !sin OpenMP no hay hilos y se usa el recorrido serial.
+    par_mode = 0
+    hilos = 1
+    !$ hilos = shia_threads
+    if (hilos .gt. 1 .and. sim_sediments .eq. 0 .and. sim_slides .eq. 0 .and. &
+        & sim_floods .eq. 0 .and. separate_fluxes .eq. 0 .and. separate_rain .eq. 0) then
+        par_mode = 1
+        allocate(par_dom(N_cel), pos_control(N_cel), pos_controlh(N_cel))
+        allocate(par_vflux(4,N_cel), par_evp(N_cel), par_out(5,N_cel))
+        !Transita por subdominios si hay particion, si no cada celda es su propio grupo
+        N_grp = 0
+        if (allocated(sub_domain)) then
+            if (size(sub_domain,2) .eq. N_cel) N_grp = maxval(sub_domain)
+        endif
+        if (N_grp .gt. 1) then
+            par_dom = sub_domain(1,:)
+        else
+            N_grp = N_cel
+            par_dom = (/ (celda, celda=1,N_cel) /)
+        endif
+        allocate(up_ptr(N_cel+1), up_idx(N_cel), lev_ptr(N_grp+1), grp_ptr(N_grp+1), grp_cells(N_cel))
+        call route_levels(N_cel, par_dom, N_grp, up_ptr, up_idx, lev_ptr, grp_ptr, grp_cells, N_lev)
+        par_out = 0.0
+    !Sin hilos y sin opciones que escriban fuera del balance basico usa el recorrido
+    !especializado shia_v1_plain, con los coeficientes que no cambian precalculados
+    elseif (shia_fast .eq. 1 .and. sim_sediments .eq. 0 .and. sim_slides .eq. 0 .and. &
+        & sim_floods .eq. 0 .and. separate_fluxes .eq. 0 .and. separate_rain .eq. 0 .and. &
+        & save_vfluxes .eq. 0 .and. save_rc .eq. 0) then
+        par_mode = 2
+        allocate(pos_control(N_cel), pos_controlh(N_cel), hill_frac(3,N_cel), kin_coef(4,N_cel))
+        hills_lin = 1
+        do i=1,3
+            if (speed_type(i) .eq. 1) then
+                hill_frac(i,:) = 1-hill_long(1,:)/(hspeed(i,:)*dt+hill_long(1,:))
+            else
+                hill_frac(i,:) = 0.0
+                hills_lin = 0
+            endif
+            call param_row(h_coef, 4, size(h_coef,2), i, N_cel, fila)
+            kin_coef(i,:) = fila*Calib(i+4)
+        enddo
+        call param_row(h_coef, 4, size(h_coef,2), 4, N_cel, fila)
+        kin_coef(4,:) = fila*Calib(8)
+    endif
+    !Posicion de cada punto de control en Q y en Hum (en el orden del recorrido serial)
+    if (par_mode .gt. 0) then
+        control_cont = 2
+        controlh_cont = 1
+        do celda=1,N_cel
+            pos_control(celda) = 0
+            pos_controlh(celda) = 0
+            if (control(1,celda).ne.0) then
+                pos_control(celda) = control_cont
+                control_cont = control_cont+1
+            endif
+            if (control_h(1,celda).ne.0) then
+                pos_controlh(celda) = controlh_cont
+                controlh_cont = controlh_cont+1
+            endif
+        enddo
+    endif
+    N_serial = 0
+    if (par_mode .eq. 0) N_serial = N_cel
+    shia_kernel = 1
+    if (par_mode .eq. 1) shia_kernel = 4
+    if (par_mode .eq. 2) shia_kernel = 2 + hills_lin
+    
+    !Si el transito va en subpasos guarda el almacenamiento al inicio de cada intervalo
+    if (route_courant .gt. 0.0) then
+        if (allocated(route_sto0)) deallocate(route_sto0)
+        allocate(route_sto0(5,N_cel))
+    endif
+    !Mascara de actividad de los tanques cinematicos, el primer intervalo siempre
+    !resuelve (act_sto negativo). No se usa con sedimentos porque dependen de la velocidad.
+    if (allocated(act_sto)) deallocate(act_sto)
+    if (allocated(act_ratio)) deallocate(act_ratio)
+    if (allocated(act_errcell)) deallocate(act_errcell)
+    if (allocated(act_error)) deallocate(act_error)
+    allocate(act_error(N_reg))
+    act_error = 0.0
+    if (act_tol .gt. 0.0 .and. sim_sediments .eq. 0) then
+        allocate(act_sto(5,N_cel), act_ratio(5,N_cel), act_errcell(N_cel))
+        act_sto = -1.0
+        act_ratio = 0.0
+        act_errcell = 0.0
+    endif
 
 
 	!--------------------------------------------------------------------------
@@ -437,22 +579,27 @@ subroutine shia_v1(ruta_bin,ruta_hdr,calib,StoIn,HspeedIn,N_cel,N_cont,N_contH,N
 		controlh_cont=1
 		
 		!Determina el almacenamiento en el paso anterior 
-		StoAtras = sum(StoOut)
+		StoAtras = sum(dble(StoOut))
+		if (route_courant .gt. 0.0) route_sto0 = StoOut
 		
 		!--------------------------------------------------------------------------
 		!Lee la lluvia 
 		if (posEvento(tiempo) .eq. 1) then
 			Rain = 0.0
 		else
-			call read_int_basin(ruta_bin, posEvento(tiempo),&
-				& N_cel, RainInt, Res) 
+			if (rain_in_memory .eq. 1) then
+				RainInt = rain_fields(:,posEvento(tiempo))
+			else
+				call rain_unit_read(1, posEvento(tiempo),&
+					& N_cel, RainInt, Res) 
+			endif
 			Rain = RainInt / 1000.0
 			!Si se habilita la funcion de separacion de flujos por lluvia, 
 			!lee los tipos de lluvia 
 			if (separate_rain .eq. 1) then 
-				call read_int_basin(ruta_binConv, posConv(tiempo),&
+				call rain_unit_read(2, posConv(tiempo),&
 				& N_cel, Conv, Res)
-				call read_int_basin(ruta_binStra, posStra(tiempo),&
+				call rain_unit_read(3, posStra(tiempo),&
 				& N_cel, Stra, Res)
 			endif
 		endif
@@ -460,12 +607,27 @@ subroutine shia_v1(ruta_bin,ruta_hdr,calib,StoIn,HspeedIn,N_cel,N_cont,N_contH,N
 		!Actualiza la variable global de acumulacion de lluvia para el periodo de simulacion
 		Acum_rain(1,:) = Acum_rain(1,:) + Rain
 		
+		!--------------------------------------------------------------------------
+		!En paralelo el intervalo lo resuelve shia_v1_step y no entra al recorrido serial
+		if (par_mode .eq. 1) then
+			call shia_v1_step(tiempo, N_cel, N_cont, N_contH, N_reg, N_lev, N_grp, calib, Rain, &
+				& vspeed, hspeed, H, m3_mmHill, m3_mmRivers, up_ptr, up_idx, lev_ptr, grp_ptr, grp_cells, &
+				& pos_control, pos_controlh, par_vflux, par_evp, par_out, StoOut, Q, Hum, St1, St3, &
+				& speed, AreaControl, entradas, salidas, rain_sum, kin_cnt)
+		elseif (par_mode .eq. 2) then
+			call shia_v1_plain(tiempo, N_cel, N_cont, N_contH, N_reg, hills_lin, Rain, &
+				& vspeed, hspeed, H, m3_mmHill, m3_mmRivers, hill_frac, kin_coef, pos_control, pos_controlh, &
+				& StoOut, Q, Hum, St1, St3, speed, AreaControl, entradas, salidas, rain_sum, kin_cnt)
+		endif
+		
 		!--------------------------------------------------------------------------
 		!Iter around the cells or hills
-		do celda=1,N_cel
+		do celda=1,N_serial
 			
 			!determina el elemento objetivo y realiza balance de lluvia
 			drenaid = N_cel-drena(1,celda)+1
+			ic = min(celda,size(h_coef,2)) !Columna de los mapas de parametros (1 si es uniforme)
+			ie = min(celda,size(h_exp,2))
 			entradas = entradas+Rain(celda)
 			rain_sum = rain_sum+Rain(celda)
 			if (separate_rain .eq. 1) then 
@@ -560,11 +722,10 @@ subroutine shia_v1(ruta_bin,ruta_hdr,calib,StoIn,HspeedIn,N_cel,N_cont,N_contH,N
                     !Caso no lineal potencial 
                     case(2)	
                         !Itera para calcular la velocidad de salida y el area de la seccion por onda cinematica
-                        call calc_speed(StoOut(i+1,celda)*m3_mmHill(celda), h_coef(i,celda)*Calib(i+4),&
-                            & h_exp(i,celda), hill_long(1,celda), hspeed(i,celda), section_area)
-                        !con la velocidad y el area calcula la cantidad de agua que sale del tanque
-                        hflux(i)=min(section_area*hspeed(i,celda)*dt/m3_mmHill(celda),&
-                            & StoOut(i+1,celda))![mm]
+                        !y con la velocidad y el area calcula la cantidad de agua que sale del tanque
+                        call calc_route(StoOut(i+1,celda), i+1, celda, m3_mmHill(celda), h_coef(i,ic)*Calib(i+4),&
+                            & h_exp(i,ie), hill_long(1,celda), route_hills, hspeed(i,celda), section_area,&
+                            & hflux(i), kin_cnt) ![mm]
                     !Simulacion de sedimentos 
                     if (sim_sediments .eq. 1 .and. i .eq. 1) then
                         !Calcula el caudal lineal
@@ -627,12 +788,11 @@ subroutine shia_v1(ruta_bin,ruta_hdr,calib,StoIn,HspeedIn,N_cel,N_cont,N_contH,N
                     Storage_stra(5,celda) = Storage_stra(5,celda)+sum(hflux_s(1:2))+hflux_s(3)*(unit_type(1,celda)-2)
                 endif
                 
-                !Resuelve el transporte en el canal por onda cinematica
-                call calc_speed(StoOut(5,celda)*m3_mmRivers(celda), h_coef(4,celda)*Calib(8),&
-                    & h_exp(4,celda), stream_long(1,celda), hspeed(4,celda), section_area)
-                !Calcula la cantidad de agua que sale del canal.
-                hflux(4)=min(section_area*hspeed(4,celda)*dt/m3_mmRivers(celda),&
-                    &StoOut(5,celda)) ![mm]				
+                !Resuelve el transporte en el canal por onda cinematica y calcula la 
+                !cantidad de agua que sale del canal.
+                call calc_route(StoOut(5,celda), 5, celda, m3_mmRivers(celda), h_coef(4,ic)*Calib(8),&
+                    & h_exp(4,ie), stream_long(1,celda), 1, hspeed(4,celda), section_area,&
+                    & hflux(4), kin_cnt) ![mm]				
                 !Calcula sedimentos 
                 if (sim_sediments .eq. 1) then
                     Vsal_sed = 0.0
@@ -843,7 +1003,11 @@ subroutine shia_v1(ruta_bin,ruta_hdr,calib,StoIn,HspeedIn,N_cel,N_cont,N_contH,N
             Retorned = 0.0
         endif	
         !Actualiza balance 
-        balance(tiempo) = sum(StoOut)-StoAtras - entradas + salidas
+        balance(tiempo) = sum(dble(StoOut))-StoAtras - entradas + salidas
+        if (allocated(act_sto)) then
+            act_error(tiempo) = sum(act_errcell)
+            act_errcell = 0.0
+        endif
         entradas = 0
         salidas = 0
         
@@ -865,6 +1029,631 @@ subroutine shia_v1(ruta_bin,ruta_hdr,calib,StoIn,HspeedIn,N_cel,N_cont,N_contH,N
         !rc_coef(3,:) = rc_coef(1,:) / rc_coef(2,:)
         call write_float_basin(ruta_rc,rc_coef,1,N_cel,2)
     endif
+    
+    !Contadores de la solucion de la onda cinematica
+    calc_count = kin_cnt
+    if (allocated(route_sto0)) deallocate(route_sto0)
+    if (allocated(act_sto)) deallocate(act_sto, act_ratio, act_errcell)
+    
+    !Cierra los binarios de lluvia
+    if (rain_in_memory .ne. 1) call rain_unit_close(1)
+    if (separate_rain .eq. 1) then
+        call rain_unit_close(2)
+        call rain_unit_close(3)
+    endif
+    if (par_mode .eq. 1) then
+        deallocate(up_ptr, up_idx, lev_ptr, grp_ptr, grp_cells, par_dom, pos_control, pos_controlh)
+        deallocate(par_vflux, par_evp, par_out)
+    elseif (par_mode .eq. 2) then
+        deallocate(pos_control, pos_controlh, hill_frac, kin_coef)
+    endif
+
+end subroutine
+
+!Resuelve un intervalo de shia_v1 en dos fases con OpenMP (shia_threads hilos):
+!1. Balance vertical del tanque 1 (lluvia, evaporacion y flujos verticales) en
+!   todas las celdas a la vez, no depende de las demas celdas.
+!2. Transito por niveles: los grupos de un nivel solo reciben de niveles anteriores
+!   (route_levels) y cada hilo recorre en orden las celdas de un grupo (una celda,
+!   o un subdominio si hay particion en sub_domain). Cada celda toma lo que le
+!   envian sus celdas aguas arriba en el mismo orden del recorrido serial y guarda
+!   en par_out lo que envia aguas abajo.
+!Las sumas sobre la cuenca (entradas, salidas, lluvia) se hacen al final en el
+!orden serial, por lo que el resultado es identico al de shia_v1 sin importar la
+!cantidad de hilos. Los puntos de control deben estar en celdas de cauce.
+subroutine shia_v1_step(tiempo, N_cel, N_cont, N_contH, N_reg, N_lev, N_grp, calib, Rain, &
+	& vspeed, hspeed, H, m3_mmHill, m3_mmRivers, up_ptr, up_idx, lev_ptr, grp_ptr, grp_cells, &
+	& pos_control, pos_controlh, par_vflux, par_evp, par_out, StoOut, Q, Hum, St1, St3, &
+	& speed, AreaControl, entradas, salidas, rain_sum, kin_cnt)
+	!Variables de entrada
+	integer, intent(in) :: tiempo, N_cel, N_cont, N_contH, N_reg, N_lev, N_grp
+	real, intent(in) :: calib(11), Rain(N_cel), vspeed(4,N_cel), H(3,N_cel)
+	real, intent(in) :: m3_mmHill(N_cel), m3_mmRivers(N_cel)
+	integer, intent(in) :: up_ptr(N_cel+1), up_idx(N_cel), lev_ptr(N_grp+1), grp_ptr(N_grp+1), grp_cells(N_cel)
+	integer, intent(in) :: pos_control(N_cel), pos_controlh(N_cel)
+	!Variables de trabajo y de salida
+	real, intent(inout) :: par_vflux(4,N_cel), par_evp(N_cel), par_out(5,N_cel)
+	real, intent(inout) :: hspeed(4,N_cel), StoOut(5,N_cel)
+	real, intent(inout) :: Q(N_cont,N_reg), Hum(N_contH,N_reg), St1(N_contH,N_reg), St3(N_contH,N_reg)
+	real, intent(inout) :: speed(N_cont,N_reg), AreaControl(N_cont,N_reg)
+	real(kind=8), intent(inout) :: entradas, salidas, rain_sum
+	integer(kind=8), intent(inout) :: kin_cnt(4)
+	!Variables locales
+	integer celda, g, k, u, lev, i, drenaid, ic, ie
+	real vflux(4), hflux(4), Evp_loss, Ret, Ret_aq, section_area
+	
+	!$omp parallel num_threads(shia_threads) default(shared) &
+	!$omp& private(celda, g, k, u, lev, i, drenaid, ic, ie, vflux, hflux, Evp_loss, Ret, Ret_aq, section_area) &
+	!$omp& reduction(+:kin_cnt)
+	!--------------------------------------------------------------------------
+	!Fase 1: balance vertical del tanque 1
+	!$omp do schedule(static)
+	do celda=1,N_cel
+		vflux(1) = max(0.0, Rain(celda)-H(1,celda)+StoOut(1,celda)) ![mm]
+		StoOut(1,celda)=StoOut(1,celda)+Rain(celda)-vflux(1) ![mm]
+		Evp_loss=min(EvpSerie(tiempo)*vspeed(1,celda)*(StoOut(1,celda)/H(1,celda))**0.6,&
+			&StoOut(1,celda)) ![mm]
+		StoOut(1,celda)=StoOut(1,celda)-Evp_loss ![mm]
+		do i=1,3
+			vflux(i+1)=min(vflux(i),vspeed(i+1,celda)) ![mm]
+		enddo
+		par_vflux(:,celda) = vflux
+		par_evp(celda) = Evp_loss
+	enddo
+	!$omp end do
+	
+	!--------------------------------------------------------------------------
+	!Fase 2: transito por niveles, cada nivel espera al anterior
+	do lev=1,N_lev
+		!$omp do schedule(static)
+		do g=lev_ptr(lev),lev_ptr(lev+1)-1
+		do k=grp_ptr(g),grp_ptr(g+1)-1
+			celda = grp_cells(k)
+			ic = min(celda,size(h_coef,2)) !Columna de los mapas de parametros (1 si es uniforme)
+			ie = min(celda,size(h_exp,2))
+			!Recibe lo que envian las celdas aguas arriba
+			do u=up_ptr(celda),up_ptr(celda+1)-1
+				if (unit_type(1,up_idx(u)).eq.1) then
+					StoOut(2:4,celda)=StoOut(2:4,celda)+par_out(1:3,up_idx(u))
+				elseif (unit_type(1,up_idx(u)).gt.1) then
+					StoOut(4,celda)=StoOut(4,celda)+par_out(3,up_idx(u))
+					StoOut(5,celda)=StoOut(5,celda)+par_out(4,up_idx(u))
+				endif
+			enddo
+			!Completa el flujo vertical hacia los tanques 2 a 4
+			vflux = par_vflux(:,celda)
+			do i=1,3
+				StoOut(i+1,celda)=StoOut(i+1,celda)+vflux(i)-vflux(i+1) ![mm]
+			enddo
+			if (retorno_aq .gt. 0) then
+				Ret_aq = max(0.0 , StoOut(4,celda)-H(3,celda))
+				StoOut(3,celda) = StoOut(3,celda) + Ret_aq ![mm]
+				StoOut(4,celda) = StoOut(4,celda) - Ret_aq ![mm]
+			endif
+			if (retorno_gr .gt. 0) then
+			    Ret = max(0.0 , StoOut(3,celda)-H(2,celda))
+				StoOut(2,celda) = StoOut(2,celda) + Ret ![mm]
+				StoOut(3,celda) = StoOut(3,celda) - Ret ![mm]
+				Retorned(1,celda) = Retorned(1,celda) + Ret
+				vflux(2) = vflux(2) + Ret
+				vflux(3) = vflux(3) - Ret
+			endif
+			if (save_vfluxes .eq. 1) vfluxes(:,celda) = vflux
+			if (save_rc .eq. 1) then
+				rc_coef(1,celda) = rc_coef(1,celda) + vflux(2) - vflux(3) 
+				rc_coef(2,celda) = rc_coef(2,celda) + Rain(celda)
+			endif
+			!Flujo que sale de los tanques 2 a 4
+			do i=1,3
+				select case(speed_type(i))
+					case(1)
+						hflux(i)=(1-hill_long(1,celda)/(hspeed(i,celda)*dt+&
+							& hill_long(1,celda)))*StoOut(i+1,celda)
+					case(2)	
+						call calc_route(StoOut(i+1,celda), i+1, celda, m3_mmHill(celda), h_coef(i,ic)*Calib(i+4),&
+							& h_exp(i,ie), hill_long(1,celda), route_hills, hspeed(i,celda), section_area,&
+							& hflux(i), kin_cnt) ![mm]
+				end select
+				StoOut(i+1,celda)=StoOut(i+1,celda)-hflux(i)	
+			enddo
+			!Guarda lo que envia aguas abajo (o lo que sale por la salida de la cuenca)
+			hflux(4) = 0.0
+			section_area = 0.0
+			if (unit_type(1,celda).eq.1) then
+				par_out(1:3,celda) = hflux(1:3)
+			elseif (unit_type(1,celda).gt.1) then
+				par_out(3,celda) = hflux(3)*(3-unit_type(1,celda))
+				StoOut(5,celda)=StoOut(5,celda)+sum(hflux(1:2))+&
+					& hflux(3)*(unit_type(1,celda)-2)
+				call calc_route(StoOut(5,celda), 5, celda, m3_mmRivers(celda), h_coef(4,ic)*Calib(8),&
+					& h_exp(4,ie), stream_long(1,celda), 1, hspeed(4,celda), section_area,&
+					& hflux(4), kin_cnt) ![mm]
+				StoOut(5,celda) = StoOut(5,celda) - hflux(4)
+				par_out(4,celda) = hflux(4)
+				par_out(5,celda) = section_area
+			endif
+			!Puntos de control de caudal y de humedad
+			if (pos_control(celda).ne.0) then
+				Q(pos_control(celda),tiempo)=hflux(4)*m3_mmRivers(celda)/dt ![m3/s]
+				if (show_speed .eq. 1) then 
+					Speed(pos_control(celda), tiempo) = hspeed(4,celda)
+					AreaControl(pos_control(celda), tiempo) = section_area
+				endif
+			endif
+			if (pos_controlh(celda).ne.0) then 
+				Hum(pos_controlh(celda),tiempo)=sum((/ StoOut(1,celda), StoOut(3,celda)/))
+				St1(pos_controlh(celda),tiempo)=StoOut(1,celda)
+				St3(pos_controlh(celda),tiempo)=StoOut(3,celda)
+			endif
+		enddo
+		enddo
+		!$omp end do
+	enddo
+	!$omp end parallel
+	
+	!--------------------------------------------------------------------------
+	!Sumas sobre la cuenca y salida, en el orden del recorrido serial
+	do celda=1,N_cel
+		entradas = entradas+Rain(celda)
+		rain_sum = rain_sum+Rain(celda)
+		salidas=salidas+par_vflux(4,celda)+par_evp(celda) ![mm]
+		if (drena(1,celda).eq.0) then
+			if (unit_type(1,celda).eq.1) then
+				Q(1,tiempo)=Q(1,tiempo)+sum(par_out(1:3,celda))*m3_mmHill(celda) ![m3/s]
+				salidas=salidas+sum(par_out(1:3,celda))
+			elseif (unit_type(1,celda).gt.1) then
+				Q(1,tiempo)=par_out(4,celda)*m3_mmRivers(celda)/dt ![m3/s]
+				salidas=salidas+par_out(4,celda) ![mm]
+				if (show_speed .eq. 1) then 
+					Speed(1,tiempo) = hspeed(4,celda)
+					AreaControl(1, tiempo) = par_out(5,celda)
+				endif
+			endif
+		endif
+	enddo
+end subroutine
+
+!Resuelve un intervalo de shia_v1 en serie para el caso sin opciones extra (sin
+!sedimentos, deslizamientos, inundaciones, separacion de flujos o de lluvia, ni
+!guardado de vfluxes o rc). Recorre las celdas igual que shia_v1 pero sin revisar
+!esas opciones en cada celda, con la fraccion que sale de los tanques lineales
+!(hill_frac) y los coeficientes de la onda cinematica (kin_coef) precalculados.
+!Con hills_lin = 1 los tanques 2 a 4 son lineales y solo el cauce va por onda
+!cinematica, la rama se decide fuera del recorrido. El resultado es identico al
+!del recorrido general. Los puntos de control deben estar en celdas de cauce.
+subroutine shia_v1_plain(tiempo, N_cel, N_cont, N_contH, N_reg, hills_lin, Rain, &
+	& vspeed, hspeed, H, m3_mmHill, m3_mmRivers, hill_frac, kin_coef, pos_control, pos_controlh, &
+	& StoOut, Q, Hum, St1, St3, speed, AreaControl, entradas, salidas, rain_sum, kin_cnt)
+	!Variables de entrada
+	integer, intent(in) :: tiempo, N_cel, N_cont, N_contH, N_reg, hills_lin
+	real, intent(in) :: Rain(N_cel), vspeed(4,N_cel), H(3,N_cel)
+	real, intent(in) :: m3_mmHill(N_cel), m3_mmRivers(N_cel), hill_frac(3,N_cel), kin_coef(4,N_cel)
+	integer, intent(in) :: pos_control(N_cel), pos_controlh(N_cel)
+	!Variables de salida
+	real, intent(inout) :: hspeed(4,N_cel), StoOut(5,N_cel)
+	real, intent(inout) :: Q(N_cont,N_reg), Hum(N_contH,N_reg), St1(N_contH,N_reg), St3(N_contH,N_reg)
+	real, intent(inout) :: speed(N_cont,N_reg), AreaControl(N_cont,N_reg)
+	real(kind=8), intent(inout) :: entradas, salidas, rain_sum
+	integer(kind=8), intent(inout) :: kin_cnt(4)
+	!Variables locales
+	integer celda, i, drenaid, ie
+	real vflux(4), hflux(4), Evp_loss, Ret, Ret_aq, section_area
+	
+	do celda=1,N_cel
+		drenaid = N_cel-drena(1,celda)+1
+		ie = min(celda,size(h_exp,2)) !Columna de h_exp (1 si es uniforme)
+		entradas = entradas+Rain(celda)
+		rain_sum = rain_sum+Rain(celda)
+		!Flujo vertical y evaporacion
+		vflux(1) = max(0.0, Rain(celda)-H(1,celda)+StoOut(1,celda)) ![mm]
+		StoOut(1,celda)=StoOut(1,celda)+Rain(celda)-vflux(1) ![mm]
+		Evp_loss=min(EvpSerie(tiempo)*vspeed(1,celda)*(StoOut(1,celda)/H(1,celda))**0.6,&
+			&StoOut(1,celda)) ![mm]
+		StoOut(1,celda)=StoOut(1,celda)-Evp_loss ![mm]
+		do i=1,3
+			vflux(i+1)=min(vflux(i),vspeed(i+1,celda)) ![mm]
+			StoOut(i+1,celda)=StoOut(i+1,celda)+vflux(i)-vflux(i+1) ![mm]
+		enddo
+		if (retorno_aq .gt. 0) then
+			Ret_aq = max(0.0 , StoOut(4,celda)-H(3,celda))
+			StoOut(3,celda) = StoOut(3,celda) + Ret_aq ![mm]
+			StoOut(4,celda) = StoOut(4,celda) - Ret_aq ![mm]
+		endif
+		if (retorno_gr .gt. 0) then
+		    Ret = max(0.0 , StoOut(3,celda)-H(2,celda))
+			StoOut(2,celda) = StoOut(2,celda) + Ret ![mm]
+			StoOut(3,celda) = StoOut(3,celda) - Ret ![mm]
+			Retorned(1,celda) = Retorned(1,celda) + Ret
+		endif
+		salidas=salidas+vflux(4)+Evp_loss ![mm]
+		!Flujo que sale de los tanques 2 a 4
+		if (hills_lin .eq. 1) then
+			hflux(1:3) = hill_frac(:,celda)*StoOut(2:4,celda)
+		else
+			do i=1,3
+				if (speed_type(i) .eq. 1) then
+					hflux(i) = hill_frac(i,celda)*StoOut(i+1,celda)
+				else
+					call calc_route(StoOut(i+1,celda), i+1, celda, m3_mmHill(celda), kin_coef(i,celda),&
+						& h_exp(i,ie), hill_long(1,celda), route_hills, hspeed(i,celda), section_area,&
+						& hflux(i), kin_cnt) ![mm]
+				endif
+			enddo
+		endif
+		StoOut(2:4,celda) = StoOut(2:4,celda) - hflux(1:3)
+		!Envia los flujos de acuerdo al tipo de celda
+		hflux(4) = 0.0
+		section_area = 0.0
+		if (unit_type(1,celda).eq.1) then
+			if (drena(1,celda).ne.0) then
+				StoOut(2:4,drenaid)=StoOut(2:4,drenaid)+hflux(1:3)
+			else
+				Q(1,tiempo)=Q(1,tiempo)+sum(hflux(1:3))*m3_mmHill(celda) ![m3/s]
+				salidas=salidas+sum(hflux(1:3))
+			endif
+		elseif (unit_type(1,celda).gt.1) then
+			StoOut(4,drenaid)=StoOut(4,drenaid)+hflux(3)*&
+				&(3-unit_type(1,celda))
+			StoOut(5,celda)=StoOut(5,celda)+sum(hflux(1:2))+&
+				& hflux(3)*(unit_type(1,celda)-2)
+			call calc_route(StoOut(5,celda), 5, celda, m3_mmRivers(celda), kin_coef(4,celda),&
+				& h_exp(4,ie), stream_long(1,celda), 1, hspeed(4,celda), section_area,&
+				& hflux(4), kin_cnt) ![mm]
+			StoOut(5,celda) = StoOut(5,celda) - hflux(4)
+			if (drena(1,celda).ne.0) then
+				StoOut(5,drenaid) = StoOut(5,drenaid)+hflux(4)
+			else
+				Q(1,tiempo)=hflux(4)*m3_mmRivers(celda)/dt ![m3/s]
+				salidas=salidas+hflux(4) ![mm]
+				if (show_speed .eq. 1) then 
+					Speed(1,tiempo) = hspeed(4,celda)
+					AreaControl(1, tiempo) = section_area
+				endif
+			endif
+		endif
+		!Puntos de control de caudal y de humedad
+		if (pos_control(celda).ne.0) then
+			Q(pos_control(celda),tiempo)=hflux(4)*m3_mmRivers(celda)/dt ![m3/s]
+			if (show_speed .eq. 1) then 
+				Speed(pos_control(celda), tiempo) = hspeed(4,celda)
+				AreaControl(pos_control(celda), tiempo) = section_area
+			endif
+		endif
+		if (pos_controlh(celda).ne.0) then 
+			Hum(pos_controlh(celda),tiempo)=sum((/ StoOut(1,celda), StoOut(3,celda)/))
+			St1(pos_controlh(celda),tiempo)=StoOut(1,celda)
+			St3(pos_controlh(celda),tiempo)=StoOut(3,celda)
+		endif
+	enddo
+end subroutine
+
+!Niveles de transito de la topologia en drena para grupos de celdas (dom, con ids
+!de 1 a N_grp): cada grupo drena completo hacia su celda mas aguas abajo, los
+!grupos fuente son el nivel 1 y cada grupo esta un nivel por debajo del mas
+!lejano que le drena. Con dom(c) = c cada celda es un grupo.
+!Entrega las celdas que drenan a cada celda (up_idx(up_ptr(c):up_ptr(c+1)-1), en
+!orden ascendente), los grupos ordenados por nivel (lev_ptr(l):lev_ptr(l+1)-1) y
+!las celdas de cada grupo en orden ascendente (grp_cells(grp_ptr(g):grp_ptr(g+1)-1)).
+subroutine route_levels(N_cel, dom, N_grp, up_ptr, up_idx, lev_ptr, grp_ptr, grp_cells, N_lev)
+	!Variables de entrada
+	integer, intent(in) :: N_cel, N_grp, dom(N_cel)
+	!Variables de salida
+	integer, intent(out) :: up_ptr(N_cel+1), up_idx(N_cel), lev_ptr(N_grp+1), grp_ptr(N_grp+1)
+	integer, intent(out) :: grp_cells(N_cel), N_lev
+	!Variables locales
+	integer nivel(N_grp), pos(N_grp), cursor(max(N_cel,N_grp)+1), celda, drenaid, g
+	!Cantidad de celdas que drenan a cada una y nivel de cada grupo, las celdas
+	!aguas abajo siempre tienen un indice mayor
+	up_ptr = 0
+	nivel = 1
+	do celda=1,N_cel
+		if (drena(1,celda) .ne. 0) then
+			drenaid = N_cel-drena(1,celda)+1
+			up_ptr(drenaid+1) = up_ptr(drenaid+1) + 1
+			if (dom(drenaid) .ne. dom(celda)) then
+				nivel(dom(drenaid)) = max(nivel(dom(drenaid)), nivel(dom(celda))+1)
+			endif
+		endif
+	enddo
+	!Celdas aguas arriba de cada celda
+	up_ptr(1) = 1
+	do celda=1,N_cel
+		up_ptr(celda+1) = up_ptr(celda+1) + up_ptr(celda)
+	enddo
+	cursor(1:N_cel+1) = up_ptr
+	do celda=1,N_cel
+		if (drena(1,celda) .ne. 0) then
+			drenaid = N_cel-drena(1,celda)+1
+			up_idx(cursor(drenaid)) = celda
+			cursor(drenaid) = cursor(drenaid) + 1
+		endif
+	enddo
+	!Grupos ordenados por nivel (pos: posicion de cada grupo en ese orden)
+	N_lev = maxval(nivel)
+	lev_ptr = 0
+	do g=1,N_grp
+		lev_ptr(nivel(g)+1) = lev_ptr(nivel(g)+1) + 1
+	enddo
+	lev_ptr(1) = 1
+	do g=1,N_lev
+		lev_ptr(g+1) = lev_ptr(g+1) + lev_ptr(g)
+	enddo
+	cursor(1:N_grp+1) = lev_ptr
+	do g=1,N_grp
+		pos(g) = cursor(nivel(g))
+		cursor(nivel(g)) = cursor(nivel(g)) + 1
+	enddo
+	!Celdas de cada grupo en orden ascendente
+	grp_ptr = 0
+	do celda=1,N_cel
+		grp_ptr(pos(dom(celda))+1) = grp_ptr(pos(dom(celda))+1) + 1
+	enddo
+	grp_ptr(1) = 1
+	do g=1,N_grp
+		grp_ptr(g+1) = grp_ptr(g+1) + grp_ptr(g)
+	enddo
+	cursor(1:N_grp+1) = grp_ptr
+	do celda=1,N_cel
+		grp_cells(cursor(pos(dom(celda)))) = celda
+		cursor(pos(dom(celda))) = cursor(pos(dom(celda))) + 1
+	enddo
+end subroutine
+
+!Particion de la cuenca en subdominios para shia_v1 en paralelo: corta en los
+!elementos marcados en cuts y, si size_target > 0, donde la cantidad de elementos
+!aguas arriba aun sin subdominio llega a size_target, o en un tributario de al
+!menos size_target/2 elementos si al unirse a otro pasa de size_target. Cada
+!subdominio drena completo hacia su elemento de corte (o la salida), el de la
+!salida es el 1.
+subroutine route_partition(N_cel, size_target, cuts, dom, N_dom)
+	!Variables de entrada
+	integer, intent(in) :: N_cel, size_target, cuts(N_cel)
+	!Variables de salida
+	integer, intent(out) :: dom(N_cel), N_dom
+	!Variables locales
+	integer acum(N_cel), corte(N_cel), celda, drenaid
+	!Elementos sin subdominio aguas arriba de cada elemento
+	corte = cuts
+	acum = 0
+	do celda=1,N_cel
+		acum(celda) = acum(celda) + 1
+		if (drena(1,celda) .ne. 0) then
+			drenaid = N_cel-drena(1,celda)+1
+			if (size_target .gt. 0 .and. (acum(celda) .ge. size_target .or. &
+				& (2*acum(celda) .ge. size_target .and. acum(drenaid)+acum(celda) .gt. size_target))) then
+				corte(celda) = 1
+			endif
+			if (corte(celda) .eq. 0) acum(drenaid) = acum(drenaid) + acum(celda)
+		endif
+	enddo
+	!Numera los subdominios desde la salida
+	N_dom = 0
+	do celda=N_cel,1,-1
+		if (drena(1,celda) .eq. 0 .or. corte(celda) .ne. 0) then
+			N_dom = N_dom + 1
+			dom(celda) = N_dom
+		else
+			dom(celda) = dom(N_cel-drena(1,celda)+1)
+		endif
+	enddo
+end subroutine
+
+!Ejecuta el modelo para N_mem juegos de parametros en una sola pasada: la lluvia
+!se lee una vez por intervalo, la topologia se recorre una vez y en cada celda se
+!actualizan todos los miembros (dimension interna de los arreglos).
+!Solo simula caudal en los puntos de control y balance (sin sedimentos,
+!deslizamientos, inundaciones, separacion de flujos ni guardado de estados).
+!Cada miembro sigue las mismas operaciones de shia_v1, las potencias vectoriales
+!pueden diferir en el ultimo digito (diferencias relativas del orden de 1e-6).
+subroutine shia_v1_batch(ruta_bin,ruta_hdr,calib,StoIn,N_cel,N_cont,N_reg,N_mem,&
+	& Q,balance,StoOut)
+    
+    !--------------------------------------------------------------------------
+    !DECLARACION DE VARIABLES
+    !--------------------------------------------------------------------------
+	!Variables de entrada
+    integer, intent(in) :: N_cel,N_reg,N_cont,N_mem
+    real, intent(in) :: calib(N_mem,11)
+    character*500, intent(in) :: ruta_bin, ruta_hdr
+    real, intent(in) :: StoIn(N_mem,5,N_cel)
+	!Variables de salida
+    real, intent(out) :: Q(N_mem,N_cont,N_reg), balance(N_mem,N_reg)
+    real, intent(out) :: StoOut(N_mem,5,N_cel)
+    !f2py intent(in) :: N_cel,N_reg,N_cont,N_mem,calib,ruta_bin,ruta_hdr,StoIn
+    !f2py intent(out) :: Q,balance,StoOut
+	!Variables de la lluvia
+	real Rain(N_cel)
+	integer RainInt(N_cel)
+	integer Res
+	real(kind=8) rain_sum
+	!Variables de iteracion
+	integer celda,tiempo,drenaid,control_cont,i,k,ic,ie
+	real fila(N_cel) !Fila de un mapa de parametros (ver param_row)
+	integer(kind=8) kin_cnt(4)
+	real tiempo_r
+    !Variables para el balance
+    real(kind=8) entradas, salidas(N_mem), StoAtras(N_mem) !En doble precision (ver shia_v1)
+	!Variables de conversion
+	real m3_mmHill(N_cel), m3_mmRivers(N_cel)
+	!Flujos de cada miembro
+	real vflux(N_mem,4), hflux(N_mem,4)
+	real Ret(N_mem), Ret_aq(N_mem), Evp_loss(N_mem), section_area(N_mem)
+	!Velocidades y almacenamientos maximos de cada miembro
+	real, allocatable :: vspeed(:,:,:), hspeed(:,:,:), H(:,:,:)
+	
+	!--------------------------------------------------------------------------
+    !PREPARACION BASICA DEL MODELO
+    !--------------------------------------------------------------------------
+	!Estructura de la lluvia y binario abierto para toda la ejecucion
+	if (rain_in_memory .ne. 1) then
+		call rain_read_ascii_table(ruta_hdr,N_reg)
+		call rain_unit_open(ruta_bin, 1, N_cel, Res)
+	endif
+	if (allocated(Mean_Rain)) deallocate(Mean_Rain)
+	allocate(Mean_Rain(1,N_reg))
+	Mean_Rain = 0
+	if (allocated(Acum_rain)) deallocate(Acum_rain)
+	allocate(Acum_rain(1,N_cel))
+	Acum_rain = 0
+	!Establece variable de conversion
+	m3_mmHill=elem_area(1,:)/1000.0
+	m3_mmRivers=elem_area(1,:)/1000.0
+	Q=0.0
+	!Almacenamiento inicial de cada miembro o el global
+	if (StoIn(1,1,1) .gt. 0) then
+		StoOut=StoIn
+	else
+		do k=1,N_mem
+			StoOut(k,:,:)=Storage + storage_constant
+		enddo
+	endif
+	entradas=0
+	salidas=0
+	balance = 0
+	kin_cnt = 0
+	!Velocidades y almacenamientos de cada miembro (como en shia_v1)
+	allocate(vspeed(N_mem,4,N_cel),hspeed(N_mem,4,N_cel),H(N_mem,3,N_cel))
+	do k=1,N_mem
+		do i=1,4
+			call param_row(v_coef, 4, size(v_coef,2), i, N_cel, fila)
+			vspeed(k,i,:)=fila*calib(k,i)*dt
+			if (speed_type(i) .eq. 1) then 
+				call param_row(h_coef, 4, size(h_coef,2), i, N_cel, fila)
+				hspeed(k,i,:)=fila*calib(k,i+4)
+			else
+				hspeed(k,i,:) = 0.0
+			endif
+		enddo
+		call param_row(Max_capilar, 1, size(Max_capilar,2), 1, N_cel, fila)
+		H(k,1,:)=fila*calib(k,9)
+		call param_row(Max_gravita, 1, size(Max_gravita,2), 1, N_cel, fila)
+		H(k,2,:)=fila*calib(k,10)
+		call param_row(Max_aquifer, 1, size(Max_aquifer,2), 1, N_cel, fila)
+		H(k,3,:)=fila*calib(k,11)
+	enddo
+	
+	!--------------------------------------------------------------------------
+    !EJECUCION DEL MODELO 
+    !--------------------------------------------------------------------------
+	do tiempo=1,N_reg
+		
+		control_cont=2
+		do k=1,N_mem
+			StoAtras(k) = sum(dble(StoOut(k,:,:)))
+		enddo
+		
+		!Lee la lluvia una vez para todos los miembros
+		if (posEvento(tiempo) .eq. 1) then
+			Rain = 0.0
+		else
+			if (rain_in_memory .eq. 1) then
+				RainInt = rain_fields(:,posEvento(tiempo))
+			else
+				call rain_unit_read(1, posEvento(tiempo), N_cel, RainInt, Res) 
+			endif
+			Rain = RainInt / 1000.0
+		endif
+		rain_sum = 0.0
+		Acum_rain(1,:) = Acum_rain(1,:) + Rain
+		
+		do celda=1,N_cel
+			
+			drenaid = N_cel-drena(1,celda)+1
+			ic = min(celda,size(h_coef,2)) !Columna de los mapas de parametros (1 si es uniforme)
+			ie = min(celda,size(h_exp,2))
+			entradas = entradas+Rain(celda)
+			rain_sum = rain_sum+Rain(celda)
+			
+			!Flujo vertical entre tanques
+			vflux(:,1) = max(0.0, Rain(celda)-H(:,1,celda)+StoOut(:,1,celda))
+			StoOut(:,1,celda)=StoOut(:,1,celda)+Rain(celda)-vflux(:,1)
+			Evp_loss=min(EvpSerie(tiempo)*vspeed(:,1,celda)*(StoOut(:,1,celda)/H(:,1,celda))**0.6,&
+				&StoOut(:,1,celda))
+			StoOut(:,1,celda)=StoOut(:,1,celda)-Evp_loss
+			do i=1,3
+				vflux(:,i+1)=min(vflux(:,i),vspeed(:,i+1,celda))
+				StoOut(:,i+1,celda)=StoOut(:,i+1,celda)+vflux(:,i)-vflux(:,i+1)
+			enddo
+			if (retorno_aq .gt. 0) then
+				Ret_aq = max(0.0 , StoOut(:,4,celda)-H(:,3,celda))
+				StoOut(:,3,celda) = StoOut(:,3,celda) + Ret_aq
+				StoOut(:,4,celda) = StoOut(:,4,celda) - Ret_aq
+			endif
+			if (retorno_gr .gt. 0) then
+			    Ret = max(0.0 , StoOut(:,3,celda)-H(:,2,celda))
+				StoOut(:,2,celda) = StoOut(:,2,celda) + Ret
+				StoOut(:,3,celda) = StoOut(:,3,celda) - Ret
+				vflux(:,2) = vflux(:,2) + Ret
+				vflux(:,3) = vflux(:,3) - Ret
+			endif
+			salidas=salidas+vflux(:,4)+Evp_loss
+			
+            !Flujo que sale de los tanques 2 a 4
+            do i=1,3
+                select case(speed_type(i))
+                    case(1)
+                        hflux(:,i)=(1-hill_long(1,celda)/(hspeed(:,i,celda)*dt+&
+                            & hill_long(1,celda)))*StoOut(:,i+1,celda)
+                    case(2)	
+                        call calc_speed_batch(N_mem, StoOut(:,i+1,celda)*m3_mmHill(celda), h_coef(i,ic)*calib(:,i+4),&
+                            & h_exp(i,ie), hill_long(1,celda), hspeed(:,i,celda), section_area, kin_cnt)
+                        hflux(:,i)=min(section_area*hspeed(:,i,celda)*dt/m3_mmHill(celda),&
+                            & StoOut(:,i+1,celda))
+                end select
+                StoOut(:,i+1,celda)=StoOut(:,i+1,celda)-hflux(:,i)	
+            enddo	
+            
+            !Envia los flujos de acuerdo al tipo de celda 
+            if (unit_type(1,celda).eq.1) then
+                if (drena(1,celda).ne.0) then
+                    StoOut(:,2:4,drenaid)=StoOut(:,2:4,drenaid)+hflux(:,1:3)
+                else
+                    Q(:,1,tiempo)=Q(:,1,tiempo)+sum(hflux(:,1:3),dim=2)*m3_mmHill(celda)
+                    salidas=salidas+sum(hflux(:,1:3),dim=2)
+                endif
+            elseif (unit_type(1,celda).gt.1) then
+                StoOut(:,4,drenaid)=StoOut(:,4,drenaid)+hflux(:,3)*&
+                    &(3-unit_type(1,celda))
+                StoOut(:,5,celda)=StoOut(:,5,celda)+sum(hflux(:,1:2),dim=2)+&
+                    & hflux(:,3)*(unit_type(1,celda)-2)
+                !Onda cinematica en el canal
+                call calc_speed_batch(N_mem, StoOut(:,5,celda)*m3_mmRivers(celda), h_coef(4,ic)*calib(:,8),&
+                    & h_exp(4,ie), stream_long(1,celda), hspeed(:,4,celda), section_area, kin_cnt)
+                hflux(:,4)=min(section_area*hspeed(:,4,celda)*dt/m3_mmRivers(celda),&
+                    &StoOut(:,5,celda))
+                StoOut(:,5,celda) = StoOut(:,5,celda) - hflux(:,4)
+                if (drena(1,celda).ne.0) then
+                    StoOut(:,5,drenaid) = StoOut(:,5,drenaid)+hflux(:,4)
+                else
+                    Q(:,1,tiempo)=hflux(:,4)*m3_mmRivers(celda)/dt
+                    salidas=salidas+hflux(:,4)
+                endif
+            endif
+            
+            !Caudales en los puntos de control
+            if (control(1,celda).ne.0) then
+                Q(:,control_cont,tiempo)=hflux(:,4)*m3_mmRivers(celda)/dt
+                control_cont=control_cont+1
+            endif
+        enddo
+        
+        Mean_Rain(1,tiempo)=rain_sum/N_cel
+        !Balance de cada miembro
+        do k=1,N_mem
+            balance(k,tiempo) = sum(dble(StoOut(k,:,:)))-StoAtras(k) - entradas + salidas(k)
+        enddo
+        entradas = 0
+        salidas = 0
+        
+        if (verbose .eq. 1) then 
+            tiempo_r = tiempo
+            print *, tiempo_r/N_reg
+        endif
+    enddo
+    
+    calc_count = kin_cnt
+    deallocate(vspeed,hspeed,H)
+    if (rain_in_memory .ne. 1) call rain_unit_close(1)
 
 end subroutine
 
@@ -908,6 +1697,7 @@ subroutine read_float_basin_Ncol(ruta, record, N_cel, N_col, vect, Res)
 	close(10)
 end subroutine
 !Lee los datos flotantes de un binario de cuenca en los records ordenados
+!Si el binario esta en formato disperso (ver read_int_basin_sparse) lo decodifica
 subroutine read_int_basin(ruta, record, N_cel, vect, Res) 
     !Variables de entrada
     integer, intent(in) :: record, N_cel
@@ -917,13 +1707,177 @@ subroutine read_int_basin(ruta, record, N_cel, vect, Res)
     integer, intent(out) :: Res
     !f2py intent(in) :: record, N_cel, ruta
     !f2py intent(out) :: vect, Res    
-    !Lectura 
+    !Variables locales
+    integer magic
+    !Lectura, mira si el binario es disperso con el primer entero del record 1
+    !(en un binario normal es el campo seco, en uno disperso es el magic)
     open(10,file=ruta,form='unformatted',status='old',access='direct',&
 		& RECL=4*N_cel)
+        read(10,rec=1,iostat=Res) magic
+        if (Res.eq.0 .and. magic.eq.1397116247) then
+            close(10)
+            call read_int_basin_sparse(ruta, record, N_cel, vect, Res)
+            if (Res.ne.0) print *, 'Error: Se ha tratado de leer un valor fuera del rango'
+            return
+        endif
 	    read(10,rec=record,iostat=Res) vect
 	    if (Res.ne.0) print *, 'Error: Se ha tratado de leer un valor fuera del rango'
 	close(10)
 end subroutine
+!Lee un record de un binario de lluvia disperso, formato (enteros de 4 bytes):
+!   encabezado: magic (WMFS), version, N_cel, N_rec, posicion de los offsets (8 bytes)
+!   records: N_runs, inicio (base 0) y largo de cada tramo no cero, valores de los tramos
+!   offsets: posicion en bytes (8 bytes) de cada record, el record 1 es el campo seco
+subroutine read_int_basin_sparse(ruta, record, N_cel, vect, Res) 
+    !Variables de entrada
+    integer, intent(in) :: record, N_cel
+    character*500, intent(in) :: ruta
+    !Variables de salida
+    integer, intent(out) :: vect(N_cel)
+    integer, intent(out) :: Res
+    !f2py intent(in) :: record, N_cel, ruta
+    !f2py intent(out) :: vect, Res    
+    !Variables locales
+    integer magic, version, ncel, nrec
+    integer(kind=8) offpos
+    !Lectura 
+    vect = 0
+    open(10,file=ruta,form='unformatted',status='old',access='stream',action='read')
+        read(10,iostat=Res) magic, version, ncel, nrec, offpos
+        if (Res.eq.0 .and. ncel.ne.N_cel) Res = -1
+        if (Res.eq.0) call read_sparse_record(10, offpos, nrec, record, N_cel, vect, Res)
+    close(10)
+end subroutine
+!Decodifica un record de un binario disperso abierto en la unidad dada
+subroutine read_sparse_record(unidad, offpos, nrec, record, N_cel, vect, Res)
+    !Variables de entrada
+    integer, intent(in) :: unidad, nrec, record, N_cel
+    integer(kind=8), intent(in) :: offpos
+    !Variables de salida
+    integer, intent(out) :: vect(N_cel)
+    integer, intent(out) :: Res
+    !Variables locales
+    integer nruns, i
+    integer(kind=8) off
+    integer, allocatable :: starts(:), lens(:)
+    !Lectura 
+    vect = 0
+    Res = 0
+    if (record.lt.1 .or. record.gt.nrec) Res = -1
+    if (Res.eq.0) read(unidad,pos=offpos+8*(record-1)+1,iostat=Res) off
+    if (Res.eq.0) read(unidad,pos=off+1,iostat=Res) nruns
+    if (Res.eq.0 .and. (nruns.lt.0 .or. nruns.gt.N_cel)) Res = -1
+    if (Res.eq.0 .and. nruns.gt.0) then
+        allocate(starts(nruns),lens(nruns))
+        read(unidad,iostat=Res) starts, lens
+        !Los tramos deben quedar dentro de la cuenca (binario truncado o danado)
+        if (Res.eq.0) then
+            if (any(starts.lt.0) .or. any(lens.lt.0) .or. any(int(starts,8)+lens.gt.N_cel) &
+                & .or. sum(int(lens,8)).gt.N_cel) Res = -1
+        endif
+        !Los valores de cada tramo vienen seguidos
+        i = 1
+        do while (Res.eq.0 .and. i.le.nruns)
+            read(unidad,iostat=Res) vect(starts(i)+1:starts(i)+lens(i))
+            i = i+1
+        enddo
+        deallocate(starts,lens)
+    endif
+end subroutine
+!Abre un binario de lluvia (normal o disperso) y lo deja abierto en el espacio
+!slot (1: lluvia, 2: convectiva, 3: estratiforme) para leerlo con rain_unit_read
+subroutine rain_unit_open(ruta, slot, N_cel, Res)
+    !Variables de entrada
+    integer, intent(in) :: slot, N_cel
+    character*500, intent(in) :: ruta
+    !Variables de salida
+    integer, intent(out) :: Res
+    !f2py intent(in) :: ruta, slot, N_cel
+    !f2py intent(out) :: Res
+    !Variables locales
+    integer magic, version, ncel, nbuf
+    integer(kind=8) tamano
+    !Si ya estaba abierto lo cierra
+    call rain_unit_close(slot)
+    !Buffer de records leidos por adelantado
+    nbuf = max(1, rain_prefetch)
+    if (allocated(rain_buffer)) then
+        if (size(rain_buffer,1).ne.N_cel .or. size(rain_buffer,2).ne.nbuf) deallocate(rain_buffer)
+    endif
+    if (.not. allocated(rain_buffer)) allocate(rain_buffer(N_cel,nbuf,3))
+    rain_bufFirst(slot) = 0
+    rain_bufN(slot) = 0
+    !Abre el binario y mira si es disperso
+    open(newunit=rain_units(slot),file=ruta,form='unformatted',status='old',&
+        & access='stream',action='read',iostat=Res)
+    if (Res.ne.0) then
+        rain_units(slot) = 0
+        print *, 'Error: No se pudo abrir el binario de lluvia'
+        return
+    endif
+    read(rain_units(slot),iostat=Res) magic
+    rain_isSparse(slot) = 0
+    if (Res.eq.0 .and. magic.eq.1397116247) then
+        rain_isSparse(slot) = 1
+        read(rain_units(slot),iostat=Res) version, ncel, rain_nrec(slot), rain_offpos(slot)
+        if (Res.eq.0 .and. ncel.ne.N_cel) Res = -1
+    else
+        inquire(unit=rain_units(slot), size=tamano)
+        rain_nrec(slot) = int(tamano / (4_8*N_cel))
+        Res = 0
+    endif
+end subroutine
+!Lee un record del binario abierto en el espacio slot, en los binarios normales
+!lee de una vez rain_prefetch records consecutivos y los siguientes se toman del buffer
+subroutine rain_unit_read(slot, record, N_cel, vect, Res)
+    !Variables de entrada
+    integer, intent(in) :: slot, record, N_cel
+    !Variables de salida
+    integer, intent(out) :: vect(N_cel)
+    integer, intent(out) :: Res
+    !f2py intent(in) :: slot, record, N_cel
+    !f2py intent(out) :: vect, Res
+    !Variables locales
+    integer n
+    Res = 0
+    !Si el record ya esta en el buffer no lee
+    if (record.ge.rain_bufFirst(slot) .and. record.lt.rain_bufFirst(slot)+rain_bufN(slot)) then
+        vect = rain_buffer(:,record-rain_bufFirst(slot)+1,slot)
+        return
+    endif
+    rain_bufN(slot) = 0
+    if (record.lt.1 .or. record.gt.rain_nrec(slot)) then
+        Res = -1
+    elseif (rain_isSparse(slot).eq.1) then
+        call read_sparse_record(rain_units(slot), rain_offpos(slot), rain_nrec(slot),&
+            & record, N_cel, rain_buffer(:,1,slot), Res)
+        n = 1
+    else
+        n = min(size(rain_buffer,2), rain_nrec(slot)-record+1)
+        read(rain_units(slot),pos=4_8*N_cel*(record-1)+1,iostat=Res) rain_buffer(:,1:n,slot)
+    endif
+    if (Res.ne.0) then
+        vect = 0
+        print *, 'Error: Se ha tratado de leer un valor fuera del rango'
+        return
+    endif
+    rain_bufFirst(slot) = record
+    rain_bufN(slot) = n
+    vect = rain_buffer(:,1,slot)
+end subroutine
+!Cierra el binario abierto en el espacio slot
+subroutine rain_unit_close(slot)
+    !Variables de entrada
+    integer, intent(in) :: slot
+    !f2py intent(in) :: slot
+    logical abierto
+    if (rain_units(slot).ne.0) then
+        inquire(unit=rain_units(slot), opened=abierto)
+        if (abierto) close(rain_units(slot))
+    endif
+    rain_units(slot) = 0
+    rain_bufN(slot) = 0
+end subroutine
 !Escribe los datos flotantes de un binario de cuenca en los records ordenados
 subroutine write_float_basin(ruta,vect,record,N_cel,N_col) 
     !Variables de entrada
@@ -1274,23 +2228,175 @@ end subroutine
 !Subrutinas de solucion
 !-----------------------------------------------------------------------
 !Solucion de la onda cinematica generica, aplica para ecuaciones 
-!del tipo v=c*Area**Exp.
-subroutine calc_speed(sm, coef, expo, elem_long, speed, area)
+!del tipo v=c*Area**Exp, con Area = sm/(long+v*dt).
+!Si calc_tol > 0 resuelve f(v) = v - c*Area(v)**Exp = 0 por Newton, partiendo de la
+!velocidad del intervalo anterior, y sale cuando el cambio de la velocidad es menor
+!que calc_tol veces la velocidad (maximo calc_niter iteraciones). f es creciente
+!(f' = 1 + Exp*c*Area**Exp*dt/(long+v*dt) >= 1), por lo que Newton no se detiene.
+!Si calc_tol es 0 hace calc_niter iteraciones de promedio (esquema anterior).
+!En cnt acumula soluciones, iteraciones y soluciones que no convergieron.
+!calc_speed resuelve para el paso dts (dt o un subpaso de calc_route).
+subroutine calc_speed(sm, coef, expo, elem_long, dts, speed, area, cnt)
 	!Variables de entrada
-	real, intent(in) :: sm,coef, expo, elem_long
+	real, intent(in) :: sm,coef, expo, elem_long, dts
 	!Variables de salidqa
 	real, intent(out) :: Area
 	real, intent(inout) :: speed
+	integer(kind=8), intent(inout) :: cnt(4)
 	!Variables locales
-	real new_speed
+	real new_speed, delta
 	integer i 
-	!Itera la cantidad de veces niter para solucionar la ecuacion
-	do i=1,calc_niter
-	    Area = sm/(elem_long+speed*dt) ![m2] Calcula el area de la seccion
-	    new_speed = coef*(Area**expo) ![m/seg] Calcula la velocidad nueva
-	    speed = (2*new_speed+speed)/3 ![m/seg] Promedia la velocidad
-	enddo		
+	cnt(1) = cnt(1) + 1
+	if (calc_tol .gt. 0.0) then
+		!Newton hasta que la velocidad cambie menos que la tolerancia
+		do i=1,calc_niter
+		    Area = sm/(elem_long+speed*dts) ![m2] Calcula el area de la seccion
+		    new_speed = coef*(Area**expo) ![m/seg] Velocidad con esa area
+		    delta = (speed-new_speed)/(1.0+expo*new_speed*dts/(elem_long+speed*dts))
+		    speed = max(0.0, speed-delta)
+		    if (abs(delta) .le. calc_tol*speed .or. speed .eq. 0.0) exit
+		enddo
+		cnt(2) = cnt(2) + min(i, calc_niter)
+		if (i .gt. calc_niter) cnt(3) = cnt(3) + 1
+		Area = sm/(elem_long+speed*dts)
+	else
+		!Itera la cantidad de veces niter para solucionar la ecuacion
+		cnt(2) = cnt(2) + calc_niter
+		do i=1,calc_niter
+		    Area = sm/(elem_long+speed*dts) ![m2] Calcula el area de la seccion
+		    new_speed = coef*(Area**expo) ![m/seg] Calcula la velocidad nueva
+		    speed = (2*new_speed+speed)/3 ![m/seg] Promedia la velocidad
+		enddo		
+	endif
 end subroutine 
+!Version de calc_speed para varios miembros (shia_v1_batch), cada miembro itera
+!hasta converger
+subroutine calc_speed_batch(N_mem, sm, coef, expo, elem_long, speed, area, cnt)
+	!Variables de entrada
+	integer, intent(in) :: N_mem
+	real, intent(in) :: sm(N_mem), coef(N_mem), expo, elem_long
+	!Variables de salida
+	real, intent(out) :: area(N_mem)
+	real, intent(inout) :: speed(N_mem)
+	integer(kind=8), intent(inout) :: cnt(4)
+	!Variables locales
+	real new_speed(N_mem), delta(N_mem)
+	logical activo(N_mem), sigue(N_mem)
+	integer i
+	cnt(1) = cnt(1) + N_mem
+	if (calc_tol .gt. 0.0) then
+		activo = .true.
+		do i=1,calc_niter
+			cnt(2) = cnt(2) + count(activo)
+			where (activo)
+				area = sm/(elem_long+speed*dt)
+				new_speed = coef*(area**expo)
+				delta = (speed-new_speed)/(1.0+expo*new_speed*dt/(elem_long+speed*dt))
+				speed = max(0.0, speed-delta)
+				sigue = abs(delta) .gt. calc_tol*speed .and. speed .gt. 0.0
+			elsewhere
+				sigue = .false.
+			end where
+			activo = sigue
+			if (.not. any(activo)) exit
+		enddo
+		cnt(3) = cnt(3) + count(activo)
+		area = sm/(elem_long+speed*dt)
+	else
+		cnt(2) = cnt(2) + N_mem*calc_niter
+		do i=1,calc_niter
+		    area = sm/(elem_long+speed*dt)
+		    speed = (2*(coef*(area**expo))+speed)/3
+		enddo
+	endif
+end subroutine
+!Transito de un tanque por onda cinematica en un intervalo: sto [mm] es el agua en
+!el tanque (con lo que le entro en el intervalo) y flux [mm] lo que sale.
+!Si route_courant > 0 y subpasos = 1, divide el intervalo en n subpasos iguales
+!para que speed*dt/n no pase de route_courant*elem_long (Courant con la velocidad
+!del intervalo anterior, maximo route_maxsub subpasos). Lo que entro al tanque en
+!el intervalo (sto menos route_sto0(tanque,celda)) entra por partes iguales en los
+!subpasos y lo que sale en cada subpaso deja de estar en el tanque para el
+!siguiente. Con n = 1 es lo mismo que una solucion de calc_speed con dt.
+!Con la mascara de actividad (act_sto alojado, ver act_tol) si el almacenamiento
+!cambio menos de act_tol (relativo, x) desde la ultima solucion completa del tanque
+!no resuelve: la fraccion que sale r = v*dt/(L+v*dt) se extrapola lineal desde la
+!de esa solucion con su elasticidad d(ln r)/d(ln S) = expo*(1-r)/(1+expo*r), asi el
+!error es de segundo orden, cerca de x**2*expo*(1+expo) del flujo, y se suma en act_errcell.
+subroutine calc_route(sto, tanque, celda, m3_mm, coef, expo, elem_long, subpasos, speed, area, flux, cnt)
+	!Variables de entrada
+	real, intent(in) :: sto, m3_mm, coef, expo, elem_long
+	integer, intent(in) :: tanque, celda, subpasos
+	!Variables de salida
+	real, intent(inout) :: speed
+	real, intent(out) :: area, flux
+	integer(kind=8), intent(inout) :: cnt(4)
+	!Variables locales
+	real S, entra, dts, sal, x, r
+	integer n, k
+	!Mascara de actividad: tanque quieto, sale por recesion (los tanques que
+	!estaban vacios se resuelven completos)
+	if (allocated(act_sto)) then
+		if (act_sto(tanque,celda) .gt. 0.0 .and. &
+			& abs(sto - act_sto(tanque,celda)) .le. act_tol*act_sto(tanque,celda)) then
+			x = sto/act_sto(tanque,celda) - 1.0
+			r = act_ratio(tanque,celda)
+			r = r*(1.0 + x*expo*(1.0-r)/(1.0+expo*r))
+			if (r .lt. 1.0) then
+				flux = r*sto
+				speed = r*elem_long/((1.0-r)*dt)
+				area = sto*m3_mm/(elem_long + speed*dt)
+				cnt(4) = cnt(4) + 1
+				act_errcell(celda) = act_errcell(celda) + x*x*expo*(1.0+expo)*flux
+				return
+			endif
+		endif
+	endif
+	!Cantidad de subpasos
+	n = 1
+	if (route_courant .gt. 0.0 .and. subpasos .eq. 1) then
+		n = min(max(1, ceiling(speed*dt/(route_courant*elem_long))), max(1, route_maxsub))
+	endif
+	if (n .eq. 1) then
+		call calc_speed(sto*m3_mm, coef, expo, elem_long, dt, speed, area, cnt)
+		flux = min(area*speed*dt/m3_mm, sto)
+	else
+		dts = dt/n
+		S = min(sto, route_sto0(tanque,celda))
+		entra = (sto - S)/n
+		flux = 0.0
+		do k=1,n
+			S = S + entra
+			call calc_speed(S*m3_mm, coef, expo, elem_long, dts, speed, area, cnt)
+			sal = min(area*speed*dts/m3_mm, S)
+			S = S - sal
+			flux = flux + sal
+		enddo
+		!El flujo total no puede pasar del agua del tanque por redondeo
+		flux = min(flux, sto)
+	endif
+	!Guarda la solucion completa para la recesion de los siguientes intervalos
+	if (allocated(act_sto)) then
+		act_sto(tanque,celda) = sto
+		act_ratio(tanque,celda) = 0.0
+		if (sto .gt. 0.0) act_ratio(tanque,celda) = flux/sto
+	endif
+end subroutine
+
+!Fila i de un mapa de parametros p (k filas, N_p columnas) para las N_cel celdas,
+!si el mapa es uniforme (N_p = 1) repite su valor en todas.
+subroutine param_row(p, k, N_p, i, N_cel, fila)
+	!Variables de entrada
+	integer, intent(in) :: k, N_p, i, N_cel
+	real, intent(in) :: p(k,N_p)
+	!Variables de salida
+	real, intent(out) :: fila(N_cel)
+	if (N_p .eq. 1) then
+		fila = p(i,1)
+	else
+		fila = p(i,1:N_cel)
+	endif
+end subroutine
 
 !-----------------------------------------------------------------------
 !Subrutinas de sedimentos
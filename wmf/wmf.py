@@ -20,9 +20,18 @@ from cu import *
 from models import *
 import numpy as np
 import pylab as pl
-from scipy.spatial import Delaunay
+from scipy.spatial import Delaunay, cKDTree
+from scipy.linalg import lu_factor, lu_solve
+import scipy.sparse as sparse
 from scipy.stats import norm
 import os
+import re
+import shutil
+import hashlib
+from collections import OrderedDict, deque
+import threading
+import functools
+import weakref
 import pandas as pd
 import datetime as datetime
 from multiprocessing import Pool
@@ -378,7 +387,7 @@ def read_map_points(path_map, ListAtr = None):
             #Busca si el atributo esta
             pos = f.GetFieldIndex(j)
             #Si esta lee la info del atributo
-            if pos is not -1:
+            if pos != -1:
                 vals = []
                 for i in range(l.GetFeatureCount()):
                     f = l.GetFeature(i)
@@ -526,7 +535,71 @@ def Save_Points2Map(XY,ids,path,EPSG = 4326, Dict = None,
         feature.Destroy()
     shapeData.Destroy()
 
-def __ListaRadarNames__(path,FechaI,FechaF,fmt,exten,string,dt):
+#Expresiones regulares de los codigos de fecha y resolucion de cada uno
+__RadarFmtCodes__ = {'%Y':(r'\d{4}','D'), '%y':(r'\d{2}','D'), '%m':(r'\d{2}','D'),
+    '%d':(r'\d{2}','D'), '%j':(r'\d{3}','D'), '%H':(r'\d{2}','h'),
+    '%M':(r'\d{2}','m'), '%S':(r'\d{2}','s')}
+
+def __RadarIndex__(path,fmt,exten,string,IndexPath=None):
+    'Funcion: __RadarIndex__\n'\
+    'Descripcion: Lista una vez la carpeta de radar y obtiene la fecha de cada\n'\
+    '   archivo con una expresion regular compilada.\n'\
+    'Parametros:.\n'\
+    '   -path: carpeta con los archivos.\n'\
+    '   -fmt, exten, string: formato de fecha, extension y texto antes de la fecha.\n'\
+    '   -IndexPath: (None) archivo .npz donde se guarda el indice, si existe solo\n'\
+    '       se leen las fechas de los archivos nuevos, se guarda de nuevo cuando\n'\
+    '       aparecen o desaparecen archivos.\n'\
+    'Retorno:.\n'\
+    '   names : array con los nombres de los archivos ordenados por fecha.\n'\
+    '   times : array datetime64[s] con la fecha de cada archivo.\n'\
+    #Expresion regular a partir del formato
+    parts = re.split('(%.)', fmt)
+    regex = ''
+    for p in parts:
+        if p.startswith('%'):
+            if p not in __RadarFmtCodes__:
+                raise ValueError('Codigo de fecha %s no soportado' % p)
+            regex += __RadarFmtCodes__[p][0]
+        else:
+            regex += re.escape(p)
+    regex = re.compile(re.escape(string)+'('+regex+')'+re.escape(exten))
+    key = '%s|%s|%s' % (string, fmt, exten)
+    #Lee el indice guardado
+    L = os.listdir(path)
+    names = np.array([], dtype = str)
+    times = np.array([], dtype = 'datetime64[s]')
+    removed = False
+    if IndexPath is not None and os.path.exists(IndexPath):
+        Index = np.load(IndexPath)
+        if str(Index['key']) == key:
+            names = Index['names']; times = Index['times']
+            present = np.isin(names, L)
+            removed = not present.all()
+            names = names[present]; times = times[present]
+    #Obtiene la fecha de los archivos nuevos
+    Known = set(names.tolist())
+    newNames = []; stamps = []
+    for l in L:
+        if l not in Known:
+            m = regex.fullmatch(l)
+            if m is not None:
+                newNames.append(l); stamps.append(m.group(1))
+    if len(newNames) > 0:
+        newTimes = pd.to_datetime(stamps, format = fmt).values.astype('datetime64[s]')
+        names = np.concatenate([names, np.array(newNames)])
+        times = np.concatenate([times, newTimes])
+    #Ordena por fecha
+    order = np.argsort(times, kind = 'stable')
+    names = names[order]; times = times[order]
+    if IndexPath is not None and (len(newNames) > 0 or removed):
+        tmp = '%s.%d.tmp.npz' % (IndexPath, os.getpid())
+        np.savez(tmp, names = names, times = times, key = key)
+        os.replace(tmp, IndexPath)
+    return names, times
+
+def __ListaRadarNames__(path,FechaI,FechaF,fmt,exten,string,dt,IndexPath=None,
+    gaps=False):
     'Funcion: OCG_param\n'\
     'Descripcion: Obtiene una lista con los nombres para leer datos de radar.\n'\
     'Parametros:.\n'\
@@ -536,24 +609,55 @@ def __ListaRadarNames__(path,FechaI,FechaF,fmt,exten,string,dt):
     '   -exten : Extension de los archivos .asc, .nc, .bin ...\n'\
     '   -string : texto antes de la fecha.\n'\
     '   -dt : Intervalos de tiempo entre los eventos.\n'\
+    '   -IndexPath : (None) archivo .npz con el indice de la carpeta (ver __RadarIndex__),\n'\
+    '       si fmt tiene codigos sin expresion regular (__RadarFmtCodes__) no se usa\n'\
+    '       y se busca el nombre de cada fecha.\n'\
+    '   -gaps : (False) Si es True tambien retorna las fechas sin archivo.\n'\
     'Retorno:.\n'\
     '   Lista : la lista de python con los nombres de los binarios.\n'\
-    #Crea lista de fechas y mira que archivos estan en esas fechas
-    Dates=[FechaI]; date=FechaI
-    while date<FechaF:
-        date+=datetime.timedelta(minutes=dt)
-        Dates.append(date)
+    '   DatesFin : fechas de los archivos encontrados.\n'\
+    '   Gaps : fechas sin archivo (si gaps es True).\n'\
+    #Con otros codigos de fecha busca el nombre de cada fecha en la carpeta
+    if any(p not in __RadarFmtCodes__ for p in re.findall('%.', fmt)):
+        L = set(os.listdir(path))
+        Lista = []; DatesFin = []; Gaps = []
+        date = FechaI
+        while True:
+            name = string + date.strftime(fmt) + exten
+            if name in L:
+                Lista.append(name); DatesFin.append(date)
+            else:
+                Gaps.append(date)
+            if date >= FechaF:
+                break
+            date += datetime.timedelta(minutes = dt)
+        if gaps:
+            return Lista, DatesFin, Gaps
+        return Lista, DatesFin
+    #Indice de la carpeta ordenado por fecha
+    names, times = __RadarIndex__(path, fmt, exten, string, IndexPath)
+    #Crea lista de fechas, la ultima es la primera mayor o igual a FechaF
+    step = np.timedelta64(int(round(dt*60)), 's')
+    Ndates = 1
+    if FechaF > FechaI:
+        Ndates += int(np.ceil((np.datetime64(FechaF, 's') - np.datetime64(FechaI, 's')) / step))
+    Dates = np.datetime64(FechaI, 's') + np.arange(Ndates) * step
+    #Las fechas se llevan a la resolucion del formato de los nombres
+    res = 'D'
+    for p in re.findall('%.', fmt):
+        if 'Dhms'.index(__RadarFmtCodes__[p][1]) > 'Dhms'.index(res):
+            res = __RadarFmtCodes__[p][1]
+    Keys = Dates.astype('datetime64[%s]' % res).astype('datetime64[s]')
     #Mira que archivos estan en esas fechas
-    Lista=[]; L=os.listdir(path)
-    DatesFin = []
-    for i in Dates:
-        try:
-            stringB=string+i.strftime(fmt)+exten
-            Pos=L.index(stringB)
-            Lista.append(L[Pos])
-            DatesFin.append(i)
-        except:
-            pass
+    pos = np.minimum(np.searchsorted(times, Keys), max(times.size - 1, 0))
+    if times.size > 0:
+        found = times[pos] == Keys
+    else:
+        found = np.zeros(Ndates, dtype = bool)
+    Lista = names[pos[found]].tolist()
+    DatesFin = Dates[found].astype(datetime.datetime).tolist()
+    if gaps:
+        return Lista, DatesFin, Dates[~found].astype(datetime.datetime).tolist()
     return Lista,DatesFin
 
 def __Add_hdr_bin_2route__(path,storage=False):
@@ -588,44 +692,236 @@ def __Add_hdr_bin_2route__(path,storage=False):
             pathHdr = path + '.StOhdr'
     return pathBin,pathHdr
 
+#Indices binarios de los encabezados (.hdr y .StOhdr)
+__RainIdxDtype__ = np.dtype([('epoch','<i8'),('record','<i4'),('mean','<f8')])
+__StorageIdxDtype__ = np.dtype([('epoch','<i8'),('record','<i4'),('mean','<f8',(5,))])
+
+def __Add_idx_2route__(pathHdr):
+    '''Path of the binary index that goes next to a .hdr or .StOhdr file'''
+    if pathHdr.endswith('StOhdr'):
+        return pathHdr[:-6] + 'StOidx'
+    elif pathHdr.endswith('hdr'):
+        return pathHdr[:-3] + 'idx'
+    return pathHdr + '.idx'
+
+def __Save_hdr_idx__(pathHdr, epoch, record, mean, storage = False, append = False):
+    '''Writes (or appends) the binary index of a header file.
+    Parameters:
+        - pathHdr: path of the .hdr or .StOhdr file.
+        - epoch: dates of the records in seconds since 1970.
+        - record: record of each date inside the binary.
+        - mean: mean rain [N] or mean storage [N, 5] of each record.
+        - storage: True for storage headers.
+        - append: adds the rows at the end of the existing index.'''
+    dtype = __StorageIdxDtype__ if storage else __RainIdxDtype__
+    Idx = np.zeros(len(record), dtype = dtype)
+    Idx['epoch'] = epoch
+    Idx['record'] = record
+    Idx['mean'] = mean
+    path = __Add_idx_2route__(pathHdr)
+    if append:
+        f = open(path, 'ab')
+        Idx.tofile(f)
+        f.close()
+    else:
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        Idx.tofile(tmp)
+        os.replace(tmp, path)
+
+def __Dates2Epoch__(dates):
+    '''Dates (datetime list or index) to seconds since 1970'''
+    return pd.DatetimeIndex(dates).values.astype('datetime64[s]').astype(np.int64)
+
+def __read_hdr_table__(pathHdr, storage = False):
+    '''Parses the table of a text header with pandas.
+    Results: epoch, record, mean (as in __Save_hdr_idx__).'''
+    if storage:
+        D = pd.read_csv(pathHdr, skiprows = 5, header = None, skipinitialspace = True)
+        record = D[0].values; mean = D[[1,2,3,4,5]].values; fechas = D[6]
+    else:
+        D = pd.read_csv(pathHdr, skiprows = 6, header = None, skipinitialspace = True)
+        record = D[1].values; mean = D[2].values; fechas = D[3]
+    fechas = pd.to_datetime(fechas.astype(str).str.strip(), format = '%Y-%m-%d-%H:%M')
+    return __Dates2Epoch__(fechas), record, mean
+
+def __read_hdr_idx__(pathHdr, storage = False):
+    '''Returns the binary index of a header memory-mapped, with the fields
+    epoch, record and mean. The index is valid if it was written after the
+    header, otherwise it is built again from the text and saved.'''
+    dtype = __StorageIdxDtype__ if storage else __RainIdxDtype__
+    path = __Add_idx_2route__(pathHdr)
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(pathHdr) \
+        and os.path.getsize(path) % dtype.itemsize == 0:
+        if os.path.getsize(path) == 0:
+            return np.zeros(0, dtype = dtype)
+        return np.memmap(path, dtype = dtype, mode = 'r')
+    #Lee el texto y trata de dejar el indice para la siguiente lectura
+    try:
+        epoch, record, mean = __read_hdr_table__(pathHdr, storage)
+    except pd.errors.EmptyDataError:
+        epoch, record, mean = [], [], []
+    Idx = np.zeros(len(record), dtype = dtype)
+    Idx['epoch'] = epoch; Idx['record'] = record; Idx['mean'] = mean
+    try:
+        __Save_hdr_idx__(pathHdr, epoch, record, mean, storage)
+    except OSError:
+        pass
+    return Idx
+
+def __Epoch2Dates__(epoch):
+    '''Seconds since 1970 to a pandas DatetimeIndex'''
+    return pd.DatetimeIndex(np.asarray(epoch).astype('datetime64[s]'))
+
+#Encabezados de lluvia ya leidos: path -> (firma, indice, fechas)
+__HdrCache__ = OrderedDict()
+__HdrCacheSize__ = 16
+
+def __read_hdr_cached__(path):
+    '''Returns the index of a rain header in memory and its dates, memoised by
+    path while the mtime and size of the header and its index do not change.'''
+    key = os.path.abspath(path)
+    pathIdx = __Add_idx_2route__(path)
+    firma = [os.path.getmtime(path), os.path.getsize(path)]
+    if os.path.exists(pathIdx):
+        firma += [os.path.getmtime(pathIdx), os.path.getsize(pathIdx)]
+    firma = tuple(firma)
+    if key in __HdrCache__ and __HdrCache__[key][0] == firma:
+        __HdrCache__.move_to_end(key)
+        return __HdrCache__[key][1:]
+    Idx = np.array(__read_hdr_idx__(path))
+    Fechas = __Epoch2Dates__(Idx['epoch'])
+    if Fechas.size > 2:
+        Fechas.freq = pd.infer_freq(Fechas)
+    #La firma se toma de nuevo por si la lectura dejo el indice en disco
+    firma = [os.path.getmtime(path), os.path.getsize(path)]
+    if os.path.exists(pathIdx):
+        firma += [os.path.getmtime(pathIdx), os.path.getsize(pathIdx)]
+    __HdrCache__[key] = (tuple(firma), Idx, Fechas)
+    while len(__HdrCache__) > __HdrCacheSize__:
+        __HdrCache__.popitem(last = False)
+    return Idx, Fechas
+
 def read_mean_rain(path,Nintervals=None,FirstInt=0):
-    #Abrey cierra el archivo plano
-    Data = np.loadtxt(path,skiprows=6,usecols=(2,3),delimiter=',',dtype='str')
-    Rain = np.array([float(i[0]) for i in Data])
-    Dates = [datetime.datetime.strptime(i[1],' %Y-%m-%d-%H:%M  ') for i in Data]
+    #Lee el indice del encabezado (en memoria si ya fue leido)
+    Idx, Fechas = __read_hdr_cached__(path)
     #Corrige pedazo para capturar
-    if Nintervals == None: Nintervals = Rain.size
+    if Nintervals == None: Nintervals = Idx.shape[0]
     #Obtiene el pedazo
-    Dates = Dates[FirstInt:FirstInt+Nintervals]
-    Rain = Rain[FirstInt:FirstInt+Nintervals]
-    #Regresa el resultado de la funcion
-    Rain = pd.Series(Rain,index = pd.to_datetime(Dates))
-    Rain.index.freq = pd.infer_freq(Rain.index)
+    Fechas = Fechas[FirstInt:FirstInt+Nintervals]
+    Rain = pd.Series(Idx['mean'][FirstInt:FirstInt+Nintervals].copy(), index = Fechas)
+    if Rain.index.freq is None and Rain.size > 2:
+        Rain.index.freq = pd.infer_freq(Rain.index)
     return Rain
 
 def read_rain_struct(path):
-    D = pd.read_csv(path,skiprows=5,
-    index_col=2, parse_dates=True,
-    infer_datetime_format=True,
-    usecols = (1,2,3))
+    Idx, Fechas = __read_hdr_cached__(path)
+    D = pd.DataFrame({' Record': Idx['record'].copy(), ' Lluvia': Idx['mean'].copy()},
+        index = Fechas.copy())
+    D.index.name = ' Fecha '
     return D
 
+def __rain_memory_input__(rain, N, Nintervals, FirstInt, dates = None):
+    '''Prepares rain kept in memory to be read by models.shia_v1.
+    Parameters:
+        - rain: array or memmap [records, N], DataFrame, or a tuple (records,
+            fields) with the records 1-based as in a binary (1 is dry).
+        - N: number of elements of each field.
+        - Nintervals, FirstInt: window of the run (as rain_read_ascii_table).
+        - dates: dates of the rain (default: the DataFrame index or models.dt
+            steps since 2000-01-01).
+    Results:
+        - posEvento: record of each interval [Nintervals].
+        - Fields: int32 fields [records, N] in mm*1000, record 1 is dry and only
+            the fields used in the window are copied.
+        - Rain: series of the mean rain in the window.'''
+    #Primer registro igual que en rain_read_ascii_table
+    first = FirstInt if FirstInt > 1 else 0
+    if isinstance(rain, pd.DataFrame):
+        if dates is None:
+            dates = rain.index
+        rain = rain.values
+    if isinstance(rain, tuple):
+        records, fields = rain
+        records = np.asarray(records)[first:first+Nintervals].astype(int)
+    else:
+        fields = rain
+        records = np.arange(first, first+Nintervals) + 1
+        if fields.shape[0] < first + Nintervals:
+            raise ValueError('La lluvia tiene %d registros y se piden %d desde %d' % (fields.shape[0], Nintervals, first))
+    if fields.shape[1] != N:
+        raise ValueError('Los campos de lluvia deben tener %d elementos y tienen %d' % (N, fields.shape[1]))
+    #Solo copia los campos usados, en el orden en que aparecen
+    if isinstance(rain, tuple):
+        wet = records > 1
+    else:
+        wet = np.ones(records.size, dtype = bool)
+    uniq, inv = np.unique(records[wet], return_inverse = True)
+    Fields = np.zeros((uniq.size + 1, N), dtype = np.int32)
+    if uniq.size > 0:
+        Sel = np.asarray(fields[uniq - 1])
+        if np.issubdtype(Sel.dtype, np.integer):
+            Fields[1:] = Sel
+        else:
+            Fields[1:] = np.round(Sel * 1000)
+    posEvento = np.ones(records.size, dtype = np.int32)
+    posEvento[wet] = inv + 2
+    #Serie de lluvia media con las fechas
+    if dates is None:
+        dates = pd.date_range('2000-01-01', periods = first + Nintervals,
+            freq = '%ds' % int(models.dt))
+    dates = pd.DatetimeIndex(dates)[first:first+Nintervals]
+    Rain = pd.Series(Fields.mean(axis = 1)[posEvento - 1] / 1000.0, index = dates)
+    if Rain.size > 2:
+        Rain.index.freq = pd.infer_freq(Rain.index)
+    return posEvento, Fields, Rain
+
 def read_storage_struct(path):
     '''Lee la estructura del archivo encabezado de almacenamiento'''
     #Obtiene pathHdr
     PathBin, PathHdr = __Add_hdr_bin_2route__(path,storage=True)
-    #Lee el archivo
-    Data = pd.read_csv(PathHdr,
-        skiprows=4,
-        index_col=6,
-        parse_dates=True)
+    #Lee el indice binario del encabezado
+    Idx = __read_hdr_idx__(PathHdr, storage = True)
+    Data = pd.DataFrame(np.array(Idx['mean']),
+        columns = [' Tanque %d' % i for i in range(1,6)],
+        index = __Epoch2Dates__(Idx['epoch']))
+    Data.insert(0, 'IDfecha', np.array(Idx['record']))
+    Data.index.name = ' Fecha '
     return Data
 
+def __Save_rain_hdr__(path, ncells, nhills, meanRain, posIds, dates = None,
+    Tipo = 'radar'):
+    '''Function to save the header file (.hdr) of a rain binary
+    Parameters:
+        - path: path of the .hdr file.
+        - ncells, nhills: number of cells and hills of the basin.
+        - meanRain: mean rain of each record [Nrecords].
+        - posIds: position of each record inside the binary [Nrecords].
+        - dates: dates of the records, if None only the header is written.
+        - Tipo: text with the type of interpolation.'''
+    f=open(path,'w')
+    f.write('Numero de celdas: %d \n' % ncells)
+    f.write('Numero de laderas: %d \n' % nhills)
+    f.write('Numero de registros: %d \n' % meanRain.shape[0])
+    f.write('Numero de campos no cero: %d \n' % posIds.max())
+    f.write('Tipo de interpolacion: %s \n' % Tipo)
+    f.write('IDfecha, Record, Lluvia, Fecha \n')
+    if dates is not None:
+        c = 1
+        for d,pos,m in zip(dates,posIds,meanRain):
+            f.write('%d, \t %d, \t %.2f, %s \n' % (c,pos,m,d.strftime('%Y-%m-%d-%H:%M')))
+            c+=1
+    f.close()
+    #Indice binario con lo mismo que queda en el texto
+    if dates is not None:
+        n = min(len(dates), len(posIds))
+        __Save_hdr_idx__(path, __Dates2Epoch__(dates[:n]), posIds[:n],
+            np.round(meanRain[:n], 2))
+
 def __Save_storage_hdr__(path,path_rain,Nintervals,FirstInt,cuenca,
     Mean_Storage, WhereToStore):
     '''Function to save the header file of the model storage'''
     #Lee fechas para el intervalo de tiempo
-    S = read_mean_rain(path_rain,Nintervals,FirstInt)
+    S = path_rain if isinstance(path_rain, pd.Series) else read_mean_rain(path_rain,Nintervals,FirstInt)
     #Escribe el encabezado del archivo
     f=open(path,'w')
     f.write('Numero de celdas: %d \n' % cuenca.ncells)
@@ -635,15 +931,22 @@ def __Save_storage_hdr__(path,path_rain,Nintervals,FirstInt,cuenca,
     f.write('IDfecha, Tanque 1, Tanque 2, Tanque 3, Tanque 4, Tanque 5, Fecha \n')
     #Si no hay almacenamiento medio lo coloca en -9999
     #Escribe registros medios y fechas de los almacenamientos
-    for d,sto,c in zip(S.index.to_pydatetime(),Mean_Storage.T, WhereToStore):
+    Rows = list(zip(S.index.to_pydatetime(),Mean_Storage.T, WhereToStore))
+    for d,sto,c in Rows:
         f.write('%d, \t %.2f, \t %.4f, \t %.4f, \t %.2f, \t %.2f, %s \n' %
             (c,sto[0],sto[1],sto[2],sto[3],sto[4],d.strftime('%Y-%m-%d-%H:%M')))
     f.close()
+    #Indice binario con lo mismo que queda en el texto
+    if len(Rows) > 0:
+        Mean = np.array([r[1] for r in Rows])
+        Mean = np.array([np.round(Mean[:,i], d) for i,d in enumerate([2,4,4,2,2])]).T
+        __Save_hdr_idx__(path, __Dates2Epoch__([r[0] for r in Rows]),
+            [r[2] for r in Rows], Mean, storage = True)
 
 def __Save_speed_hdr__(path,path_rain,Nintervals,FirstInt,cuenca,
     Mean_Speed = None, WhereItSave = None):
     #Lee fechas para el intervalo de tiempo
-    S = read_mean_rain(path_rain,Nintervals,FirstInt)
+    S = path_rain if isinstance(path_rain, pd.Series) else read_mean_rain(path_rain,Nintervals,FirstInt)
     #Escribe el encabezado del archivo
     f=open(path,'w')
     f.write('Numero de celdas: %d \n' % cuenca.ncells)
@@ -665,7 +968,7 @@ def __Save_speed_hdr__(path,path_rain,Nintervals,FirstInt,cuenca,
 def __Save_retorno_hdr__(path,path_rain,Nintervals,FirstInt,cuenca,
     Mean_retorno = None):
     #Lee fechas para el intervalo de tiempo
-    S = read_mean_rain(path_rain,Nintervals,FirstInt)
+    S = path_rain if isinstance(path_rain, pd.Series) else read_mean_rain(path_rain,Nintervals,FirstInt)
     #Escribe el encabezado del archivo
     f=open(path,'w')
     f.write('Numero de celdas: %d \n' % cuenca.ncells)
@@ -877,6 +1180,587 @@ def __ejec_parallel__(ListEjecs, nproc, nodo):
     P.join()
     return Lista
 
+def __ordered_prefetch__(func, items, nproc = 1, Prefetch = None,
+    initializer = None, initargs = ()):
+    '''Generator that yields func(item) for each item in order, the items are
+    processed ahead by a pool of nproc workers with at most Prefetch of them
+    in flight, so the memory stays bounded when the consumer is slower.
+    Parameters:
+        - func: function of one argument, defined at module level.
+        - items: iterable with the arguments.
+        - nproc: number of workers, with 1 everything runs in this process.
+        - Prefetch: maximum number of items in flight (default 2*nproc).
+        - initializer, initargs: function and arguments to start each worker.'''
+    if nproc is None or nproc <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for i in items:
+            yield func(i)
+        return
+    if Prefetch is None:
+        Prefetch = 2 * nproc
+    P = Pool(processes = nproc, initializer = initializer, initargs = initargs)
+    try:
+        items = iter(items)
+        pending = deque()
+        for i in items:
+            pending.append(P.apply_async(func, (i,)))
+            if len(pending) >= Prefetch:
+                break
+        while len(pending) > 0:
+            res = pending.popleft().get()
+            for i in items:
+                pending.append(P.apply_async(func, (i,)))
+                break
+            yield res
+        P.close()
+    finally:
+        P.terminate()
+        P.join()
+
+def __radar_asc_init__(structure, modelType, hills_own, ncells, nhills, geo):
+    '''Keeps what the radar readers need of the basin (structure, model type,
+    hill of each cell and sizes) and the properties of its DEM in cu. Only
+    these go to the reading processes, not the basin. The positions of the
+    cells in the netCDF grids are rebuilt for each basin.'''
+    global __radar_asc_basin__
+    __radar_asc_basin__ = {'structure': structure, 'modelType': modelType,
+        'hills_own': hills_own, 'ncells': ncells, 'nhills': nhills}
+    __radar_nc_index_cache__.clear()
+    for k in geo.keys():
+        setattr(cu, k, geo[k])
+
+def __radar_basin2hills__(vec):
+    '''Mean of a cell vector in each hill if the basin of the radar readers
+    is of hills (as Basin.Transform_Basin2Hills), otherwise the same vector.'''
+    B = __radar_asc_basin__
+    if B['modelType'][0] == 'h':
+        return cu.basin_subbasin_map2subbasin(B['hills_own'], vec, B['nhills'],
+            np.ones(B['ncells']), 0, B['ncells'])
+    return vec
+
+def __radar_asc_read__(path):
+    '''Reads a radar map and returns it in the shape of the basin (or hills),
+    as Basin.Transform_Map2Basin.'''
+    B = __radar_asc_basin__
+    Map,p = read_map_raster(path)
+    vec = cu.basin_map2basin(B['structure'], Map, p[2], p[3], p[4], p[5], cu.nodata,
+        B['ncells'], p[0], p[1])
+    return __radar_basin2hills__(vec)
+
+#Indices de remuestreo de las grillas netCDF ya vistas en cada proceso
+__radar_nc_index_cache__ = {}
+
+def __radar_nc_index__(structure, prop):
+    '''Position of each basin cell in a radar grid, with the same rule of
+    cu.basin_map2basin.
+    Parameters:
+        - structure: structure of the basin, the DEM properties are in cu.
+        - prop: ncols, nrows, xll, yll, dx, dy of the grid.
+    Results:
+        - window: rows and columns (r0, r1, c0, c1) that enclose the basin.
+        - rows, cols: position of the cells inside the grid in the window.
+        - inside: cells that fall inside the grid.'''
+    ncols, nrows, xll, yll, dx, dy = prop
+    Xpos = cu.xll + cu.dx * (structure[1] - 0.5)
+    Ypos = cu.yll + cu.dy * ((cu.nrows - structure[2]) + 0.5)
+    inside = (Xpos > xll) & (Xpos < xll + dx * ncols) & (Ypos > yll) & (Ypos < yll + dy * nrows)
+    cols = np.ceil((Xpos[inside] - xll) / dx).astype(int) - 1
+    rows = nrows - np.ceil((Ypos[inside] - yll) / dy).astype(int)
+    if cols.size == 0:
+        return (0, 0, 0, 0), rows, cols, inside
+    window = (rows.min(), rows.max() + 1, cols.min(), cols.max() + 1)
+    return window, rows - window[0], cols - window[2], inside
+
+def __radar_nc_read__(args):
+    '''Reads the basin window of each netCDF scan of an interval and returns
+    their sum in the shape of the basin (or hills).'''
+    paths, VarName = args
+    B = __radar_asc_basin__
+    vec = np.zeros(B['ncells'])
+    for path in paths:
+        g = netcdf.Dataset(path)
+        dy = g.dy if 'dy' in g.ncattrs() else g.dx
+        prop = (int(g.ncols), int(g.nrows), float(g.xll), float(g.yll), float(g.dx), float(dy))
+        if prop not in __radar_nc_index_cache__:
+            __radar_nc_index_cache__[prop] = __radar_nc_index__(B['structure'], prop)
+        window, rows, cols, inside = __radar_nc_index_cache__[prop]
+        #Solo lee la ventana de la cuenca
+        Map = g.variables[VarName][window[0]:window[1], window[2]:window[3]]
+        g.close()
+        Map = np.ma.filled(np.ma.masked_equal(Map, cu.nodata).astype(float), np.nan)
+        #Los faltantes se llenan con la media de la ventana
+        if np.isnan(Map).any():
+            Map[np.isnan(Map)] = np.nanmean(Map) if np.isfinite(Map).any() else 0.0
+        vec[inside] += Map[rows, cols]
+    return __radar_basin2hills__(vec)
+
+#-----------------------------------------------------------------------
+#Operadores de interpolacion de lluvia
+#-----------------------------------------------------------------------
+def __rain_idw_operator__(xy_basin, coord, p = 1, k = None):
+    '''Sparse IDW operator that keeps only the k nearest stations of each cell.
+    Parameters:
+        - xy_basin: coordinates of the cells [2, ncells].
+        - coord: coordinates of the stations [2, Nest].
+        - p: exponent of the inverse distance.
+        - k: number of nearest stations used in each cell (None: all of them).
+    Results:
+        - W: sparse matrix [ncells, Nest] with the weights 1/d**p.'''
+    ncells = xy_basin.shape[1]
+    nest = coord.shape[1]
+    if k is None or k > nest:
+        k = nest
+    #The KD-tree is built once with the stations and queried for all the cells
+    Tree = cKDTree(coord.T)
+    dist, ids = Tree.query(xy_basin.T, k = k)
+    dist = np.maximum(np.reshape(dist, (ncells, k)), 1e-6)
+    ids = np.reshape(ids, (ncells, k))
+    W = sparse.csr_matrix((1.0 / dist.ravel()**p, ids.ravel(),
+        np.arange(0, ncells*k+1, k)), shape = (ncells, nest))
+    return W
+
+def __rain_tin_operator__(xy_basin, coord):
+    '''Sparse TIN operator with the barycentric weights of each cell inside
+    its Delaunay triangle (3 nonzeros per cell).
+    Parameters:
+        - xy_basin: coordinates of the cells [2, ncells].
+        - coord: coordinates of the stations [2, Nest].
+    Results:
+        - W: sparse matrix [ncells, Nest] with the barycentric weights.
+        - simplex: triangle of each cell, -1 if the cell is outside the mesh.'''
+    ncells = xy_basin.shape[1]
+    TIN = Delaunay(coord.T)
+    #All the cells are located in the mesh in one vectorised step
+    simplex = TIN.find_simplex(xy_basin.T)
+    inside = np.flatnonzero(simplex >= 0)
+    T = TIN.transform[simplex[inside]]
+    bary = np.einsum('ijk,ik->ij', T[:,:2,:], xy_basin.T[inside] - T[:,2,:])
+    bary = np.hstack([bary, 1.0 - bary.sum(axis = 1, keepdims = True)])
+    W = sparse.csr_matrix((bary.ravel(), (np.repeat(inside, 3),
+        TIN.simplices[simplex[inside]].ravel())), shape = (ncells, coord.shape[1]))
+    return W, simplex
+
+def __rain_variogram__(h, Variogram = 'exponential', Range = 1000.0, Sill = 1.0,
+    Nugget = 0.0):
+    '''Semivariance of the distances h with a theoretical model.
+    Parameters:
+        - h: array of distances.
+        - Variogram: exponential, spherical or gaussian.
+        - Range, Sill, Nugget: parameters of the variogram.
+    Results:
+        - gamma: semivariance, zero where h == 0.'''
+    h = np.asarray(h, dtype = float)
+    r = h / Range
+    if Variogram == 'exponential':
+        g = 1.0 - np.exp(-3.0 * r)
+    elif Variogram == 'spherical':
+        g = np.where(r < 1.0, 1.5 * r - 0.5 * r**3, 1.0)
+    elif Variogram == 'gaussian':
+        g = 1.0 - np.exp(-3.0 * r**2)
+    else:
+        raise ValueError('Variogram must be exponential, spherical or gaussian')
+    return np.where(h > 0, Nugget + (Sill - Nugget) * g, 0.0)
+
+def __rain_kriging_operator__(xy_basin, coord, k = None, **variogram):
+    '''Sparse ordinary kriging operator, each cell uses its k nearest stations.
+    The cells that share the same neighbourhood share one kriging system, which
+    is factored once and solved for all of them at the same time.
+    Parameters:
+        - xy_basin: coordinates of the cells [2, ncells].
+        - coord: coordinates of the stations [2, Nest].
+        - k: number of stations of each neighbourhood, None uses all of them.
+        - variogram: arguments of __rain_variogram__.
+    Results:
+        - W: sparse matrix [ncells, Nest] with the kriging weights.'''
+    ncells = xy_basin.shape[1]
+    nest = coord.shape[1]
+    if nest == 0:
+        return sparse.csr_matrix((ncells, 0))
+    if k is None or k > nest:
+        k = nest
+    dist, idx = cKDTree(coord.T).query(xy_basin.T, k = k)
+    idx = np.sort(idx.reshape(ncells, k), axis = 1)
+    sets, group = np.unique(idx, axis = 0, return_inverse = True)
+    #Cells sorted by neighbourhood so each one is a contiguous slice
+    group = group.ravel()
+    order = np.argsort(group, kind = 'stable')
+    limits = np.concatenate([[0], np.cumsum(np.bincount(group))])
+    weights = np.zeros((ncells, k))
+    for j, s in enumerate(sets):
+        cells = order[limits[j]:limits[j+1]]
+        #Kriging system of the neighbourhood with the unbiasedness constraint
+        xy = coord[:,s]
+        A = np.ones((k+1, k+1))
+        A[:k,:k] = __rain_variogram__(np.hypot(xy[0][:,None] - xy[0][None,:],
+            xy[1][:,None] - xy[1][None,:]), **variogram)
+        A[k,k] = 0.0
+        B = np.ones((k+1, cells.size))
+        B[:k] = __rain_variogram__(np.hypot(xy[0][:,None] - xy_basin[0,cells][None,:],
+            xy[1][:,None] - xy_basin[1,cells][None,:]), **variogram)
+        weights[cells] = lu_solve(lu_factor(A), B)[:k].T
+    return sparse.csr_matrix((weights.ravel(), idx.ravel(),
+        np.arange(0, ncells*k+1, k)), shape = (ncells, nest))
+
+def __rain_hills_operator__(hills_own, nhills):
+    '''Sparse operator [nhills, ncells] that adds up the cells of each hill,
+    the hills are in the order of the Fortran interpolators (row i is the hill nhills-i).'''
+    hills_own = np.asarray(hills_own).astype(int)
+    pos = np.flatnonzero((hills_own > 0) & (hills_own <= nhills))
+    return sparse.csr_matrix((np.ones(pos.size), (nhills - hills_own[pos], pos)),
+        shape = (nhills, hills_own.size))
+
+def __rain_operator_cached__(CacheDir, method, xy_basin, coord, params, builder):
+    '''Returns an interpolation operator from the disk cache, or builds it with
+    builder() and stores it in the cache.
+    Parameters:
+        - CacheDir: folder of the cache, if None the operator is always built.
+        - method: name of the method, used as prefix of the cache files.
+        - xy_basin: coordinates of the cells [2, ncells].
+        - coord: coordinates of the stations [2, Nest].
+        - params: tuple with the parameters of the method.
+        - builder: function without arguments that builds the sparse operator.
+    Results:
+        - W: sparse operator in csr format.'''
+    if CacheDir is None:
+        return builder()
+    #The key depends on the cells, the stations and the parameters
+    key = hashlib.sha1()
+    for a in [xy_basin, coord]:
+        a = np.ascontiguousarray(a, dtype = np.float64)
+        key.update(str(a.shape).encode())
+        key.update(a.tobytes())
+    key.update(repr(params).encode())
+    path = os.path.join(CacheDir, '%s_%s.npz' % (method, key.hexdigest()))
+    if os.path.exists(path):
+        try:
+            return sparse.load_npz(path).tocsr()
+        except Exception:
+            pass
+    W = builder()
+    #Written to a temporal file and renamed so other processes never read it half written
+    if not os.path.isdir(CacheDir):
+        os.makedirs(CacheDir, exist_ok = True)
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        sparse.save_npz(f, W)
+    os.replace(tmp, path)
+    return W
+
+def __rain_pattern_operator__(W, report):
+    '''Operator of the stations that report, with the weights of each cell
+    normalised to add up to one (cells without reporting stations get zero).
+    Parameters:
+        - W: sparse operator [ncells, Nest] in csc format.
+        - report: boolean array [Nest], True for the stations that report.
+    Results:
+        - Wp: sparse operator [ncells, report.sum()] in csr format.'''
+    Wp = W[:,np.flatnonzero(report)].tocsr()
+    suma = np.asarray(Wp.sum(axis = 1)).ravel()
+    norm = np.zeros(suma.size)
+    norm[suma > 0] = 1.0 / suma[suma > 0]
+    return sparse.diags(norm) @ Wp
+
+#Binarios de lluvia dispersos (decodificados por models.read_int_basin)
+__RainSparseMagic__ = 1397116247
+
+def __rain_sparse_encode__(vec):
+    '''Encodes an int32 rain record as runs of non zero cells: number of runs,
+    start (base 0) and length of each run, and the values of the runs.'''
+    nz = np.concatenate([[0], (vec != 0).astype(np.int8), [0]])
+    d = np.diff(nz)
+    starts = np.flatnonzero(d == 1)
+    lens = np.flatnonzero(d == -1) - starts
+    return np.concatenate([[starts.size], starts, lens, vec[vec != 0]]).astype(np.int32)
+
+def __rain_sparse_header__(f, N, nrec = 0, offpos = 0):
+    '''Writes the header of a sparse rain binary at the start of the file f.'''
+    f.seek(0)
+    np.array([__RainSparseMagic__, 1, N, nrec], dtype = np.int32).tofile(f)
+    np.array([offpos], dtype = np.int64).tofile(f)
+
+def __rain_write_records__(f, Records, offsets = None):
+    '''Writes int32 rain records [Nrec, N] at the end of f, if offsets is a
+    list the records are sparse encoded and their positions added to it.'''
+    if offsets is None:
+        Records.tofile(f)
+    else:
+        for r in Records:
+            offsets.append(f.tell())
+            __rain_sparse_encode__(r).tofile(f)
+
+def __rain_sparse_close__(f, N, offsets):
+    '''Writes the table of offsets at the end of a sparse binary and updates its header.'''
+    offpos = f.tell()
+    np.array(offsets, dtype = np.int64).tofile(f)
+    __rain_sparse_header__(f, N, len(offsets), offpos)
+
+def __rain_is_sparse__(path_bin):
+    '''True if the rain binary is sparse encoded.'''
+    f = open(path_bin, 'rb')
+    magic = np.fromfile(f, dtype = np.int32, count = 1)
+    f.close()
+    return magic.size == 1 and magic[0] == __RainSparseMagic__
+
+def __rain_bin_shape__(path_bin, path_hdr):
+    '''Returns the number of elements of each record, the number of records and
+    True if the rain binary is sparse encoded.'''
+    if __rain_is_sparse__(path_bin):
+        Head = np.fromfile(path_bin, dtype = np.int32, count = 4)
+        return int(Head[2]), int(Head[3]), True
+    f = open(path_hdr, 'r')
+    Nrec = [int(f.readline().split()[-1]) for i in range(4)][-1]
+    f.close()
+    return os.path.getsize(path_bin) // (4 * Nrec), Nrec, False
+
+def __rain_read_record__(path_bin, record, N, Data = None):
+    '''Reads an int32 record of a rain binary, from the memory map Data of a
+    dense binary or with models.read_int_basin.'''
+    if Data is not None:
+        return np.asarray(Data[record-1])
+    return models.read_int_basin(path_bin, record, N)[0]
+
+def __rain_field_means__(vec):
+    '''Mean rain [mm] of a field in milimeters * 1000, over all the basin (as the
+    radar readers write it) and over the cells with rain (as the interpolators).'''
+    return vec.sum() / (1000.0 * vec.size), vec.sum() / (1000.0 * max(1, (vec > 0).sum()))
+
+def rain_bin_resample(path, path_out, dt, threshold = 0.0, Sparse = None, dt_in = None):
+    'Funcion: rain_bin_resample\n'\
+    'Descripcion: Lleva un binario de lluvia a otro intervalo de tiempo en una\n'\
+    '   sola pasada, leyendo solo los records de cada intervalo nuevo.\n'\
+    '   - Intervalo mayor: suma los campos de cada intervalo nuevo (la fecha es\n'\
+    '       el inicio del intervalo), los intervalos secos van al record 1.\n'\
+    '   - Intervalo menor: reparte cada campo por igual en los sub-intervalos,\n'\
+    '       que apuntan al mismo record.\n'\
+    '   La lluvia media se calcula de nuevo con la misma definicion de la entrada:\n'\
+    '       promedio de toda la cuenca (radar) o de las celdas con lluvia (interpolacion).\n'\
+    'Parametros:.\n'\
+    '   -path: path del binario (.bin o .hdr) de entrada.\n'\
+    '   -path_out: path del binario de salida.\n'\
+    '   -dt: Intervalo de tiempo de salida [min], multiplo o divisor del de entrada.\n'\
+    '   -threshold: lluvia total [mm] bajo la cual un campo se toma como seco.\n'\
+    '   -Sparse: Formato disperso de salida, si es None usa el de la entrada.\n'\
+    '   -dt_in: Intervalo de tiempo de la entrada [min], si es None se toma de\n'\
+    '       las fechas del encabezado (necesario si tiene un solo registro).\n'\
+    'Retorno:.\n'\
+    '   meanRain: serie de lluvia media de la salida.\n'\
+    '   posIds: record de cada intervalo de la salida.\n'\
+    #Rutas, tamano y encabezado de la entrada
+    path_bin, path_hdr = __Add_hdr_bin_2route__(path)
+    out_bin, out_hdr = __Add_hdr_bin_2route__(path_out)
+    N, Nrec, isSparse = __rain_bin_shape__(path_bin, path_hdr)
+    if Sparse is None:
+        Sparse = isSparse
+    f = open(path_hdr, 'r')
+    Head = [f.readline() for i in range(5)]
+    f.close()
+    ncells = int(Head[0].split()[-1]); nhills = int(Head[1].split()[-1])
+    Tipo = Head[4].split(':')[-1].strip()
+    Idx = __read_hdr_idx__(path_hdr)
+    epoch = np.array(Idx['epoch']); record = np.array(Idx['record']); mean = np.array(Idx['mean'])
+    if dt_in is not None:
+        dt_in = int(round(dt_in * 60))
+    elif epoch.size > 1:
+        dt_in = int(np.median(np.diff(epoch)))
+    else:
+        raise ValueError('El encabezado %s tiene %d registros, se debe dar dt_in' % (path_hdr, epoch.size))
+    dt_out = int(round(dt * 60))
+    Data = None
+    if not isSparse:
+        Data = np.memmap(path_bin, dtype = np.int32, mode = 'r', shape = (Nrec, N))
+    #Binario de salida
+    offsets = None
+    f = open(out_bin, 'wb')
+    if Sparse:
+        offsets = []
+        __rain_sparse_header__(f, N)
+    __rain_write_records__(f, np.zeros((1, N), dtype = np.int32), offsets)
+    cont = 1
+    meanRain = []; posIds = []; dates = []
+    #Lluvia media de cada campo: en toda la cuenca o en las celdas con lluvia,
+    #al final se usa la que mejor reproduce la media de los campos de entrada
+    meanWet = []; errAll = 0.0; errWet = 0.0
+    if dt_out >= dt_in:
+        if dt_out % dt_in != 0:
+            raise ValueError('dt debe ser multiplo del intervalo del binario (%d min)' % (dt_in / 60))
+        #Acumula los records de cada intervalo nuevo
+        group = epoch // dt_out
+        starts = np.flatnonzero(np.concatenate([[True], group[1:] != group[:-1]]))
+        ends = np.concatenate([starts[1:], [group.size]])
+        for i,j in zip(starts, ends):
+            vec = np.zeros(N, dtype = np.int64)
+            for r,m in zip(record[i:j], mean[i:j]):
+                if r > 1:
+                    v = __rain_read_record__(path_bin, r, N, Data)
+                    ea, ew = __rain_field_means__(v)
+                    errAll += abs(ea - m); errWet += abs(ew - m)
+                    vec += v
+            dates.append(group[i] * dt_out)
+            if vec.sum() / 1000.0 > threshold and (vec > 0).any():
+                cont += 1
+                __rain_write_records__(f, vec[None,:].astype(np.int32), offsets)
+                a, w = __rain_field_means__(vec)
+                posIds.append(cont); meanRain.append(a); meanWet.append(w)
+            else:
+                posIds.append(1); meanRain.append(0.0); meanWet.append(0.0)
+    else:
+        if dt_in % dt_out != 0:
+            raise ValueError('dt debe ser divisor del intervalo del binario (%d min)' % (dt_in / 60))
+        #Reparte cada record en los sub intervalos
+        k = dt_in // dt_out
+        for t,r,m in zip(epoch, record, mean):
+            pos = 1; a = w = 0.0
+            if r > 1:
+                v = __rain_read_record__(path_bin, r, N, Data)
+                ea, ew = __rain_field_means__(v)
+                errAll += abs(ea - m); errWet += abs(ew - m)
+                vec = np.round(v / float(k))
+                if vec.sum() / 1000.0 > threshold and (vec > 0).any():
+                    cont += 1
+                    __rain_write_records__(f, vec[None,:].astype(np.int32), offsets)
+                    pos = cont; a, w = __rain_field_means__(vec)
+            for l in range(k):
+                dates.append(t + l * dt_out); posIds.append(pos)
+                meanRain.append(a); meanWet.append(w)
+    if Sparse:
+        __rain_sparse_close__(f, N, offsets)
+    f.close()
+    del Data
+    if errWet < errAll:
+        meanRain = meanWet
+    meanRain = np.array(meanRain); posIds = np.array(posIds)
+    __Save_rain_hdr__(out_hdr, ncells, nhills, meanRain, posIds,
+        __Epoch2Dates__(dates).to_pydatetime(), Tipo)
+    return meanRain, posIds
+
+def rain_bin_compress(path, path_out = None, BlockSize = 1000):
+    'Funcion: rain_bin_compress\n'\
+    'Descripcion: Convierte un binario de lluvia al formato disperso, en el cual\n'\
+    '   cada record solo guarda los tramos de celdas con lluvia y un indice con\n'\
+    '   la posicion de cada record. models.read_int_basin (y por lo tanto el\n'\
+    '   modelo) lo lee igual que el binario normal, el .hdr no cambia.\n'\
+    '   Si el disperso no queda mas pequeno se deja el binario normal.\n'\
+    'Parametros:.\n'\
+    '   -path: path del binario (.bin o .hdr).\n'\
+    '   -path_out: path del binario disperso, si es None reemplaza el original.\n'\
+    '   -BlockSize: records leidos en cada paso.\n'\
+    'Retorno:.\n'\
+    '   Relacion entre el tamano original y el disperso (1.0 si queda el normal).\n'\
+    #Rutas y cantidad de records
+    path_bin, path_hdr = __Add_hdr_bin_2route__(path)
+    N, Nrec, isSparse = __rain_bin_shape__(path_bin, path_hdr)
+    if isSparse:
+        return 1.0
+    if path_out is None:
+        out_bin = '%s.%d.tmp' % (path_bin, os.getpid())
+    else:
+        out_bin, out_hdr = __Add_hdr_bin_2route__(path_out)
+    #Pasa los records por bloques
+    Data = np.memmap(path_bin, dtype = np.int32, mode = 'r', shape = (Nrec, N))
+    f = open(out_bin, 'wb')
+    __rain_sparse_header__(f, N)
+    offsets = []
+    for i in range(0, Nrec, BlockSize):
+        __rain_write_records__(f, np.array(Data[i:i+BlockSize]), offsets)
+    __rain_sparse_close__(f, N, offsets)
+    f.close()
+    del Data
+    ratio = float(os.path.getsize(path_bin)) / os.path.getsize(out_bin)
+    #Si no reduce el tamano se queda con el binario normal
+    if ratio <= 1.0:
+        os.remove(out_bin)
+        ratio = 1.0
+        if path_out is not None:
+            shutil.copyfile(path_bin, out_bin)
+    if path_out is None:
+        if ratio > 1.0:
+            os.replace(out_bin, path_bin)
+    else:
+        shutil.copyfile(path_hdr, out_hdr)
+        if os.path.exists(__Add_idx_2route__(path_hdr)):
+            shutil.copyfile(__Add_idx_2route__(path_hdr), __Add_idx_2route__(out_hdr))
+    return ratio
+
+def __rain_write_fields__(path_bin, W, reg, threshold, Hills = None, BlockSize = 24,
+    MaxOperators = 32, PatternOperator = None, Sparse = False):
+    '''Interpolates the rain registers with a linear operator and writes the
+    fields to a rain binary, record 1 is the dry field and the rest are the
+    fields with rain.
+    The time steps of each block are grouped by the set of stations that report,
+    each group is interpolated with one product of its normalised operator, the
+    operators are kept in a LRU cache since the gaps of a network repeat.
+    Parameters:
+        - path_bin: path of the binary.
+        - W: sparse operator [ncells, Nest], at each time step the weights of each
+            cell are normalised with the stations that report (reg >= 0).
+        - reg: rain registers [Nest, Nregisters], negative values are missing data.
+        - threshold: minimum rain for a field to be written.
+        - Hills: optional operator [nhills, ncells] to write the fields by hills.
+        - BlockSize: number of time steps interpolated in each block.
+        - MaxOperators: maximum number of normalised operators kept in memory.
+        - PatternOperator: optional function that receives the boolean array of
+            the stations that report and returns their operator, by default
+            the weights of W are normalised with __rain_pattern_operator__.
+        - Sparse: writes the binary in the sparse format (see rain_bin_compress).
+    Results:
+        - meanRain: mean rain of each time step.
+        - posIds: record of each time step inside the binary.'''
+    reg = np.asarray(reg, dtype = float)
+    W = sparse.csc_matrix(W)
+    nreg = reg.shape[1]
+    meanRain = np.zeros(nreg)
+    posIds = np.ones(nreg, dtype = int)
+    if Hills is None:
+        Nout = W.shape[0]
+    else:
+        Nout = Hills.shape[0]
+    operators = OrderedDict()
+    cont = 1
+    offsets = None
+    f = open(path_bin, 'wb')
+    if Sparse:
+        offsets = []
+        __rain_sparse_header__(f, Nout)
+    __rain_write_records__(f, np.zeros((1, Nout), dtype = np.int32), offsets)
+    for i in range(0, nreg, BlockSize):
+        R = reg[:,i:i+BlockSize]
+        #Groups the time steps by the stations that report
+        patterns, group = np.unique(R.T >= 0, axis = 0, return_inverse = True)
+        group = group.ravel()
+        #The fields are kept by rows [time, cells] to write them contiguous
+        campo = np.zeros((R.shape[1], W.shape[0]))
+        for j, report in enumerate(patterns):
+            key = np.packbits(report).tobytes()
+            Wp = operators.pop(key, None)
+            if Wp is None:
+                if PatternOperator is None:
+                    Wp = __rain_pattern_operator__(W, report)
+                else:
+                    Wp = PatternOperator(report)
+                if len(operators) >= MaxOperators:
+                    operators.popitem(last = False)
+            operators[key] = Wp
+            rows = np.flatnonzero(group == j)
+            campo[rows] = (Wp @ np.maximum(R[np.ix_(report, rows)], 0.0)).T
+        np.maximum(campo, 0.0, out = campo)
+        #Only the fields with rain are written
+        suma = campo.sum(axis = 1)
+        wet = (suma > threshold) & (campo > threshold).any(axis = 1)
+        nwet = np.count_nonzero(wet)
+        if nwet > 0:
+            campo = campo[wet]
+            meanRain[i:i+R.shape[1]][wet] = suma[wet] / (campo > 0).sum(axis = 1)
+            posIds[i:i+R.shape[1]][wet] = np.arange(cont+1, cont+nwet+1)
+            cont += nwet
+            if Hills is not None:
+                campo = (Hills @ campo.T).T
+            __rain_write_records__(f, (campo * 1000).astype(np.int32), offsets)
+    if Sparse:
+        __rain_sparse_close__(f, Nout, offsets)
+    f.close()
+    return meanRain, posIds
+
 #-----------------------------------------------------------------------
 #Transformacion de datos
 #-----------------------------------------------------------------------
@@ -911,6 +1795,341 @@ def __ModifyElevErode__(X,slope=0.01,d2 = 0.03, window = 25):
     slope = np.hstack([slope,slope[-1]])
     return Y,np.abs(slope)
 
+def __GroupStats__(groups, CellMap, ngroups, stats = ['mean'], mask = None, nodata = None):
+    '''Computes grouped statistics (by hill, by reach) of one or several
+    basin variables sorting the cells only once per variable.
+    Parameters:
+        - groups: integer vector [ncells] with the group (1 to ngroups) of each cell,
+            cells with 0 do not belong to any group.
+        - CellMap: variable [ncells] or variables [nvars, ncells].
+        - ngroups: number of groups.
+        - stats: list with the statistics to compute:
+            mean, sum, min, max, count, mode and Pxx (percentile xx, Ej: P50).
+        - mask: cells taken into account (1) and not taken (0).
+        - nodata: value excluded from the statistics, it is also the value
+            of the groups without valid cells (except count).
+    Results:
+        - Stats: dictionary with the stats [nvars, ngroups] or [ngroups] if
+            CellMap is a vector, position i corresponds to the group i+1.'''
+    #Variables and cells taken into account
+    isVector = np.ndim(CellMap) == 1
+    Vars = np.atleast_2d(np.asarray(CellMap, dtype = float))
+    groups = np.asarray(groups).astype(int).ravel()
+    Base = (groups > 0) & (groups <= ngroups)
+    if mask is not None:
+        Base = Base & (np.asarray(mask).ravel() != 0)
+    fill = np.nan if nodata is None else nodata
+    Stats = {}
+    for s in stats:
+        Stats.update({s: np.ones((Vars.shape[0], ngroups)) * fill})
+    for v,var in enumerate(Vars):
+        valid = Base & np.isfinite(var)
+        if nodata is not None:
+            valid = valid & (var != nodata)
+        #Sorts by group and value, each group is then a contiguous block
+        g = groups[valid] - 1
+        x = var[valid]
+        order = np.lexsort((x, g))
+        g = g[order]; x = x[order]
+        count = np.bincount(g, minlength = ngroups)
+        start = np.cumsum(count) - count
+        has = count > 0
+        for s in stats:
+            if s == 'count':
+                Stats[s][v] = count
+            elif s == 'sum' or s == 'mean':
+                suma = np.bincount(g, weights = x, minlength = ngroups)
+                if s == 'mean':
+                    suma[has] = suma[has] / count[has]
+                Stats[s][v][has] = suma[has]
+            elif s == 'min':
+                Stats[s][v][has] = x[start[has]]
+            elif s == 'max':
+                Stats[s][v][has] = x[start[has] + count[has] - 1]
+            elif s[0] == 'P':
+                #Linear interpolation between the closest ranks (as np.percentile)
+                rank = start[has] + float(s[1:]) / 100. * (count[has] - 1)
+                low = np.floor(rank).astype(int)
+                high = np.ceil(rank).astype(int)
+                Stats[s][v][has] = x[low] + (x[high] - x[low]) * (rank - low)
+            elif s == 'mode' and x.size > 0:
+                #Runs of equal values inside each group, keeps the longest (lowest value if tie)
+                newRun = np.ones(x.size, dtype = bool)
+                newRun[1:] = (g[1:] != g[:-1]) | (x[1:] != x[:-1])
+                runStart = np.flatnonzero(newRun)
+                runLong = np.diff(np.append(runStart, x.size))
+                runG = g[runStart]; runX = x[runStart]
+                best = np.lexsort((runX, -runLong, runG))
+                first = best[np.append(True, runG[best][1:] != runG[best][:-1])]
+                Stats[s][v][runG[first]] = runX[first]
+    if isVector:
+        for s in stats:
+            Stats[s] = Stats[s][0]
+    return Stats
+
+#-----------------------------------------------------------------------
+#Clase para escribir binarios de lluvia
+#-----------------------------------------------------------------------
+
+class RainWriter:
+    def __init__(self, path, N, ncells, nhills, Tipo = 'radar', BufferSize = 12,
+        FlushTime = 600.0, append = False):
+        'Descripcion: Escritor de binarios de lluvia que mantiene abierto el\n'\
+        '   binario durante toda la sesion, guarda los campos en un buffer y\n'\
+        '   los escribe cuando se llena o cuando pasa FlushTime desde que entro el\n'\
+        '   primero (con un temporizador, aunque no lleguen mas campos).\n'\
+        '   En cada escritura primero se guardan los campos en el binario y luego\n'\
+        '   se agregan las lineas del .hdr en una sola escritura y se actualizan\n'\
+        '   los conteos del encabezado (de ancho fijo), asi el .hdr nunca apunta\n'\
+        '   a registros que no esten en el binario. Al final se agregan las\n'\
+        '   filas al indice binario (.idx) del encabezado.\n'\
+        '\n'\
+        'Parametros\n'\
+        '----------\n'\
+        'path : path del binario (.bin), el .hdr va al lado.\n'\
+        'N : Cantidad de elementos de cada campo (celdas o laderas).\n'\
+        'ncells, nhills : celdas y laderas de la cuenca (para el encabezado).\n'\
+        'Tipo : Texto con el tipo de interpolacion.\n'\
+        'BufferSize : Cantidad de campos guardados antes de escribir.\n'\
+        'FlushTime : Segundos maximos que un campo espera para ser escrito, si es\n'\
+        '   None solo se escribe al llenar el buffer o al cerrar.\n'\
+        'append : Si es True continua un binario existente con su .hdr.\n'\
+        '\n'\
+        'Retornos\n'\
+        '----------\n'\
+        'self : El escritor con el binario abierto.\n'\
+        #Rutas del binario y del encabezado
+        self.path_bin, self.path_hdr = __Add_hdr_bin_2route__(path)
+        self.N = N
+        self.BufferSize = BufferSize
+        self.FlushTime = FlushTime
+        self.buffer = []
+        self.lines = []
+        #El temporizador escribe desde otro hilo, el candado ordena los accesos
+        self.lock = threading.RLock()
+        self.timer = None
+        #Encabezado de ancho fijo para actualizar los conteos en su lugar
+        Head = ['Numero de celdas: %d \n' % ncells,
+            'Numero de laderas: %d \n' % nhills]
+        self.posCounts = len(''.join(Head))
+        if append:
+            #Toma el estado del archivo existente y reescribe su encabezado
+            if __rain_is_sparse__(self.path_bin):
+                raise ValueError('RainWriter no puede continuar un binario disperso: '+self.path_bin)
+            f = open(self.path_hdr, 'r')
+            Lista = f.readlines()
+            f.close()
+            Body = [l for l in Lista[6:] if len(l.strip()) > 0]
+            self.nrecords = len(Body)
+            self.cont = int(Lista[3].split()[-1])
+            Tipo = Lista[4].split(':')[-1].strip()
+            hdr_text = ''.join(Head) + self.__counts__() \
+                + 'Tipo de interpolacion: %s \n' % Tipo \
+                + 'IDfecha, Record, Lluvia, Fecha \n' + ''.join(Body)
+            tmp = '%s.%d.tmp' % (self.path_hdr, os.getpid())
+            f = open(tmp, 'wb')
+            f.write(hdr_text.encode())
+            f.close()
+            os.replace(tmp, self.path_hdr)
+            epoch, record, mean = __read_hdr_table__(self.path_hdr)
+            __Save_hdr_idx__(self.path_hdr, epoch, record, mean)
+            #Descarta registros escritos despues del ultimo del .hdr
+            self.fbin = open(self.path_bin, 'r+b')
+            self.fbin.truncate(self.cont * N * 4)
+            self.fbin.seek(0, 2)
+        else:
+            self.nrecords = 0
+            self.cont = 1
+            self.fbin = open(self.path_bin, 'wb')
+            np.zeros(N, dtype = np.int32).tofile(self.fbin)
+            f = open(self.path_hdr, 'wb')
+            f.write((''.join(Head) + self.__counts__()
+                + 'Tipo de interpolacion: %s \n' % Tipo
+                + 'IDfecha, Record, Lluvia, Fecha \n').encode())
+            f.close()
+            __Save_hdr_idx__(self.path_hdr, [], [], [])
+        self.fhdr = open(self.path_hdr, 'r+b')
+        self.rows = []
+
+    def __counts__(self):
+        return 'Numero de registros: %12d \nNumero de campos no cero: %12d \n' % (
+            self.nrecords + len(self.lines), self.cont)
+
+    def write(self, fecha, vec = None, meanRain = 0.0):
+        'Descripcion: Agrega un intervalo al binario.\n'\
+        '\n'\
+        'Parametros\n'\
+        '----------\n'\
+        'fecha : Fecha del intervalo.\n'\
+        'vec : Campo de lluvia [N] en mm, si es None el intervalo es seco (registro 1).\n'\
+        'meanRain : Lluvia media del intervalo.\n'\
+        '\n'\
+        'Retornos\n'\
+        '----------\n'\
+        'pos : Registro del intervalo en el binario.\n'\
+        #El temporizador puede estar escribiendo el buffer
+        with self.lock:
+            #Los intervalos secos van al registro 1
+            if vec is None:
+                pos = 1
+            else:
+                self.cont += 1
+                pos = self.cont
+                self.buffer.append((np.asarray(vec) * 1000).astype(np.int32))
+            self.lines.append('%d, \t %d, \t %.2f, %s \n' % (self.nrecords + len(self.lines) + 1,
+                pos, meanRain, fecha.strftime('%Y-%m-%d-%H:%M')))
+            self.rows.append((fecha, pos, np.round(meanRain, 2)))
+            if len(self.lines) >= self.BufferSize:
+                self.flush()
+            elif self.timer is None and self.FlushTime is not None:
+                #El primer campo pendiente se escribe a mas tardar en FlushTime
+                self.timer = threading.Timer(self.FlushTime, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+        return pos
+
+    def flush(self):
+        'Descripcion: Escribe los campos del buffer y luego las lineas del .hdr.\n'\
+        #Lo llama write, close o el temporizador, el pendiente se cancela
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            #Si no hay nada pendiente (o ya se cerro) no escribe
+            if len(self.lines) == 0 or self.fbin.closed:
+                return
+            for vec in self.buffer:
+                vec.tofile(self.fbin)
+            self.fbin.flush()
+            os.fsync(self.fbin.fileno())
+            #Las lineas nuevas se agregan de una vez y luego se actualizan los conteos
+            self.fhdr.seek(0, 2)
+            self.fhdr.write(''.join(self.lines).encode())
+            self.fhdr.seek(self.posCounts)
+            self.fhdr.write(self.__counts__().encode())
+            self.fhdr.flush()
+            os.fsync(self.fhdr.fileno())
+            #El indice binario va al final, si falta queda viejo y se lee el texto
+            __Save_hdr_idx__(self.path_hdr, __Dates2Epoch__([r[0] for r in self.rows]),
+                [r[1] for r in self.rows], [r[2] for r in self.rows], append = True)
+            self.nrecords += len(self.lines)
+            self.buffer = []
+            self.lines = []
+            self.rows = []
+
+    def close(self):
+        'Descripcion: Escribe lo que queda en el buffer y cierra los archivos.\n'\
+        #Escribe lo pendiente y cierra
+        with self.lock:
+            self.flush()
+            self.fbin.close()
+            self.fhdr.close()
+
+#-----------------------------------------------------------------------
+#Aislamiento de las cuencas de simulacion
+#-----------------------------------------------------------------------
+#Los kernels de models y cu trabajan sobre las variables globales de los modulos,
+#por lo que en un proceso hay una sola cuenca cargada a la vez. Para que varias
+#SimuBasin no se sobreescriban, la cuenca cargada se copia al cambiar a otra y se
+#vuelve a cargar cuando se usa de nuevo: cada cambio cuesta una copia del modelo
+#y los llamados de varios hilos se ejecutan uno a la vez (no es reentrante).
+#Variables de models y cu que definen una cuenca de simulacion: geometria,
+#topologia, parametros, almacenamiento y opciones (no las de cada ejecucion)
+__ModelVars__ = ['ncols', 'nrows', 'xll', 'yll', 'dx', 'dxp', 'nodata', 'nceldas',
+    'dt', 'verbose', 'calc_niter', 'calc_tol', 'rain_prefetch',
+    'drena', 'unit_type', 'hill_long', 'hill_slope', 'stream_long', 'stream_slope',
+    'stream_width', 'elem_area', 'control', 'control_h', 'sub_domain',
+    'v_coef', 'v_exp', 'h_coef', 'h_exp', 'max_capilar', 'max_gravita', 'max_aquifer',
+    'speed_type', 'retorno_gr', 'retorno_aq', 'storage_constant', 'storage',
+    'sim_sediments', 'sim_slides', 'sim_floods', 'separate_fluxes', 'separate_rain',
+    'show_storage', 'show_speed', 'show_mean_speed', 'show_mean_retorno', 'show_area',
+    'save_storage', 'save_speed', 'save_retorno', 'save_vfluxes', 'save_rc',
+    'sed_factor', 'wi', 'g', 'diametro', 'krus', 'crus', 'prus', 'parliac',
+    'sl_cohesion', 'sl_frictionangle', 'sl_fs', 'sl_gammas', 'sl_gammaw', 'sl_radslope',
+    'sl_zs', 'sl_gullienogullie',
+    'flood_aquien', 'flood_av', 'flood_cmax', 'flood_d50', 'flood_dsed', 'flood_dw',
+    'flood_hand', 'flood_max_iter', 'flood_sec_cells', 'flood_sections', 'flood_slope',
+    'flood_step', 'flood_threshold', 'flood_w', 'flood_umbral', 'flood_hmax']
+__CuVars__ = ['ncols', 'nrows', 'xll', 'yll', 'dx', 'dy', 'dxp', 'nodata']
+#Un solo hilo a la vez usa models y cu, y la cuenca que esta cargada en ellos,
+#solo las cuencas que no estan cargadas guardan una copia de sus variables
+__ModelLock__ = threading.RLock()
+__ActiveBasin__ = None
+
+def __model_snapshot__(grid = None):
+    '''Copies the basin variables of models and cu (see __ModelVars__). If
+    grid is given (see __model_method__) it is used for the cu variables.'''
+    ctx = {}
+    for mod, name, names in [(models, 'models', __ModelVars__), (cu, 'cu', __CuVars__)]:
+        for k in names:
+            v = getattr(mod, k, None)
+            if v is not None:
+                ctx[(name, k)] = np.copy(v) if isinstance(v, np.ndarray) else v
+    if grid is not None:
+        ctx.update(grid)
+    return ctx
+
+def __model_restore__(ctx):
+    '''Loads in models and cu the variables saved by __model_snapshot__.'''
+    for (name, k), v in ctx.items():
+        setattr(models if name == 'models' else cu, k, v)
+
+def __model_activate__(basin):
+    '''Leaves the basin loaded in models and cu. The state of the basin that
+    was loaded is copied to its context to be restored when it is used again,
+    the context of the basin that is loaded is released.'''
+    global __ActiveBasin__
+    active = __ActiveBasin__() if __ActiveBasin__ is not None else None
+    if active is basin:
+        return
+    if active is not None:
+        active.__model_ctx__ = __model_snapshot__(getattr(active, '__model_grid__', None))
+    ctx = getattr(basin, '__model_ctx__', None)
+    if ctx is not None:
+        __model_restore__(ctx)
+        basin.__model_ctx__ = None
+    __ActiveBasin__ = weakref.ref(basin)
+
+def __model_method__(func):
+    '''Decorator of the SimuBasin methods that use models and cu: holds the
+    model lock and loads the basin before calling the method. The grid of cu
+    is kept at the end of the call, since the next basin is usually traced
+    after changing cu by hand.'''
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with __ModelLock__:
+            __model_activate__(self)
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                self.__model_grid__ = dict((('cu', k), np.copy(getattr(cu, k))) for k in __CuVars__)
+    return wrapper
+
+#Mapas de parametros de models que se pueden guardar con una sola columna si son
+#uniformes en la cuenca, el modelo repite ese valor en todos los elementos
+__ParamMaps__ = ['v_coef', 'h_coef', 'h_exp', 'max_capilar', 'max_gravita', 'max_aquifer']
+
+def __param_full__(name, N):
+    '''Returns the parameter map of models with N columns, a uniform map
+    (one column) is repeated.'''
+    v = getattr(models, name)
+    if v.shape[1] == 1 and N > 1:
+        return np.repeat(v, N, axis = 1)
+    return v
+
+def __param_set__(name, pos, Vec):
+    '''Sets row pos of a parameter map of models. A uniform map stays with
+    one column if Vec is uniform, otherwise it is expanded first.'''
+    v = getattr(models, name)
+    flat = np.ravel(Vec)
+    if v.shape[1] == 1 and flat.size > 1:
+        if np.all(flat == flat[0]):
+            v[pos] = flat[0]
+            return
+        setattr(models, name, __param_full__(name, flat.size))
+        v = getattr(models, name)
+    v[pos] = Vec
+
 #-----------------------------------------------------------------------
 #Clase de cuencas
 #-----------------------------------------------------------------------
@@ -1917,9 +3136,10 @@ class Basin:
         '   pasada a celdas.\n'\
         #Genera el mapa de basin vacio
         CellMap = np.ones(self.ncells)
-        #itera por la cantidad de elementos y les va asignando
-        for i,k in enumerate(HillsMap[::-1]):
-            CellMap[self.hills_own==i+1] = k
+        #Asigna a cada celda el valor de su ladera (indexado directo)
+        HillsMap = np.asarray(HillsMap)[::-1]
+        pos = (self.hills_own > 0) & (self.hills_own <= HillsMap.size)
+        CellMap[pos] = HillsMap[self.hills_own[pos].astype(int) - 1]
         return CellMap
     def Transform_Basin2Hills(self,CellMap,mask=None,SumMeanMax=0):
         'Descripcion: A partir de un vector tipo Basin obtiene un\n'\
@@ -1951,6 +3171,48 @@ class Basin:
         HillsMap = cu.basin_subbasin_map2subbasin(self.hills_own,
             CellMap, self.nhills, Ma, SumMeanMax, self.ncells)
         return HillsMap
+    def Transform_Basin2HillsStats(self, CellMap, stats = ['mean'], mask = None,
+        channels = False, nodata = None):
+        'Descripcion: A partir de una o varias variables tipo Basin obtiene\n'\
+        '   estadisticos agregados por ladera o por tramo de cauce, todos\n'\
+        '   calculados en una sola pasada (ordenando las celdas una vez). \n'\
+        '\n'\
+        'Parametros\n'\
+        '----------\n'\
+        'self : la cuenca misma.\n'\
+        'CellMap : Vector [ncells] o matriz [nvars, ncells] con las propiedades por celdas.\n'\
+        'stats : Lista con los estadisticos a calcular:\n'\
+        '   mean, sum, min, max, count, mode (mapas categoricos) y\n'\
+        '   Pxx: percentil xx (Ej: P10, P50, P90).\n'\
+        'mask : Celdas sobre las cuales se agrega la variable (1), y\n'\
+        '   sobre las que no (0).\n'\
+        'channels : Si es True solo agrega las celdas de cauce de cada ladera\n'\
+        '   (self.CellCauce), es decir obtiene el estadistico por tramo de cauce.\n'\
+        'nodata : Valor que no se tiene en cuenta en los estadisticos, tambien es\n'\
+        '   el valor de las laderas sin celdas validas (por defecto NaN).\n'\
+        '\n'\
+        'Retornos\n'\
+        '----------\n'\
+        'HillsStats : Diccionario con cada estadistico [nhills] o [nvars, nhills]\n'\
+        '   en el mismo orden de Transform_Basin2Hills.\n'\
+        #Mascara de celdas a tener en cuenta
+        if mask is not None:
+            Ma = np.copy(mask)
+        else:
+            Ma = np.ones(self.ncells)
+        if channels:
+            try:
+                Cauce = self.CellCauce
+            except:
+                self.GetGeo_Cell_Basics()
+                Cauce = self.CellCauce
+            Ma = Ma * (Cauce == 1)
+        #Obtiene los estadisticos y los deja en el orden de las laderas
+        HillsStats = __GroupStats__(self.hills_own, CellMap, self.nhills,
+            stats, Ma, nodata)
+        for s in HillsStats.keys():
+            HillsStats[s] = HillsStats[s][...,::-1]
+        return HillsStats
 
 
     def Transform_Basin2Polygon(self, Vector,):
@@ -2207,9 +3469,9 @@ class Basin:
         Qmax=[]
         for t in Tr:
             #Calcula k
-            if Dist is 'gumbel':
+            if Dist == 'gumbel':
                 k=-1*(0.45+0.78*np.log(-1*np.log(1-1/float(t))))
-            elif Dist is 'lognorm':
+            elif Dist == 'lognorm':
                 Ztr=norm.ppf(1-1/float(t))
                 k=(np.exp(Ztr*np.sqrt(np.log(1+Cv**2))-0.5*np.log(1-Cv**2))-1)/Cv
             #Calcula el caudal maximo
@@ -2246,9 +3508,9 @@ class Basin:
         Qmin=[]
         for t in Tr:
             #Calcula k
-            if Dist is 'gumbel':
+            if Dist == 'gumbel':
                 k = (-1*np.sqrt(6)/np.pi)*(0.5772+np.log(-1*np.log(1/float(t))))
-            elif Dist is 'lognorm':
+            elif Dist == 'lognorm':
                 Ztr=norm.ppf(1/float(t))
                 k = 1*(np.exp(Ztr*np.sqrt(np.log(1+Cv**2))-0.5*np.log(1-Cv**2))-1)/Cv
             #Calcula el caudal maximo
@@ -2929,6 +4191,7 @@ class Basin:
             pl.show()
 class SimuBasin(Basin):
 
+    @__model_method__
     def __init__(self,lat=None,lon=None,DEM=None,DIR=None,path = None, name='NaN',stream=None,
         threshold=500,useCauceMap = None,
         noData=-999,modelType='cells',SimSed=False,SimSlides=False,dt=60,
@@ -2985,6 +4248,7 @@ class SimuBasin(Basin):
         self.radarPos = []
         self.radarMeanRain = []
         self.radarCont = 1
+        self.radarWriter = None
         #Si no hay path y el global del codigo EPSG existe, traza la cuenca
         if path is None and int(Global_EPSG) > 0:
             #Si se entrega cauce corrige coordenadas
@@ -3039,8 +4303,10 @@ class SimuBasin(Basin):
             models.storage = np.zeros((5,N))
             models.dt = dt
             models.calc_niter = 5
+            models.calc_tol = 0.0
             models.retorno_gr = 0
             models.verbose = 0
+            models.rain_prefetch = 24
             #Define los puntos de control
             models.control = np.zeros((1,N))
             #Si se da la opcion de puntos de control en toda la red lo hace
@@ -3059,27 +4325,29 @@ class SimuBasin(Basin):
                     models.control = np.ones((1,self.nhills)) * nodos[nodos!=0]
             #Puntos de control de humedad sin control por defecto
             models.control_h = np.zeros((1,N))
+            #Sin particion en subdominios por defecto
+            models.sub_domain = np.zeros((1,N))
             #Define las simulaciones que se van a hacer
             models.sim_sediments=0
-            if SimSed is 'si':
+            if SimSed == 'si':
                 models.sim_sediments=1
             models.sim_slides=0
             if SimSlides:
                 models.sim_slides=1
             models.save_storage=0
-            if SaveStorage is 'si':
+            if SaveStorage == 'si':
                 models.save_storage=1
             models.save_speed=0
-            if SaveSpeed is 'si':
+            if SaveSpeed == 'si':
                 models.save_speed=1
             models.separate_fluxes = 0
-            if SeparateFluxes is 'si':
+            if SeparateFluxes == 'si':
                 models.separate_fluxes = 1
             models.separate_rain = 0
-            if SeparateRain is 'si':
+            if SeparateRain == 'si':
                 models.separate_rain = 1
             models.show_storage = 0
-            if ShowStorage is 'si':
+            if ShowStorage == 'si':
                 models.show_storage = 1
             if SimFloods == 'si':
                 models.sim_floods = 1
@@ -3124,6 +4392,7 @@ class SimuBasin(Basin):
         models.dt = gr.dt
         models.dxp = gr.dxp
         models.retorno_gr = gr.retorno
+        models.rain_prefetch = 24
         try:
             models.storage_constant = gr.storageConst
         except:
@@ -3144,9 +4413,9 @@ class SimuBasin(Basin):
         cu.dxp = gr.dxp
         cu.nodata = gr.noData
         #de acuerdo al tipo de modeloe stablece numero de elem
-        if self.modelType[0] is 'c':
+        if self.modelType[0] == 'c':
             N = self.ncells
-        elif self.modelType[0] is 'h':
+        elif self.modelType[0] == 'h':
             N = self.nhills
         #Obtiene las variables base
         GrupoBase = gr.groups['base']
@@ -3178,9 +4447,9 @@ class SimuBasin(Basin):
         models.parliac = np.ones((3,N))*GrupoSimSed.variables['PArLiAc'][:]
 
         #Variable de drena de acuerdo al tipo de modelo
-        if self.modelType[0] is 'c':
+        if self.modelType[0] == 'c':
             models.drena = np.ones((3,N)) *GrupoSimHid.variables['drena'][:]
-        elif self.modelType[0] is 'h':
+        elif self.modelType[0] == 'h':
             models.drena = np.ones((1,N)) * GrupoSimHid.variables['drena'][:]
         models.unit_type = np.ones((1,N)) * GrupoSimHid.variables['unit_type'][:]
         models.hill_long = np.ones((1,N)) * GrupoSimHid.variables['hill_long'][:]
@@ -3193,6 +4462,7 @@ class SimuBasin(Basin):
         models.storage = np.ones((5,N)) * GrupoSimHid.variables['storage'][:]
         models.control = np.ones((1,N)) * GrupoSimHid.variables['control'][:]
         models.control_h = np.ones((1,N)) * GrupoSimHid.variables['control_h'][:]
+        models.sub_domain = np.zeros((1,N))
 
         #Propiedades de deslizamientos
         if sim_slides:
@@ -3263,11 +4533,16 @@ class SimuBasin(Basin):
         rad = rad.resample(index.freqstr).sum()
         models.evpserie = np.copy(rad.values)
 
-    def rain_interpolate_mit(self,coord,registers,path, threshold = 0.01):
+    @__model_method__
+    def rain_interpolate_mit(self,coord,registers,path, threshold = 0.01,
+        BlockSize = 24, CacheDir = None, Sparse = False):
         'Descripcion: Interpola la lluvia mediante una malla\n'\
         '   irregular de triangulos, genera campos que son. \n'\
         '   guardados en un binario para luego ser leido por el. \n'\
         '   modelo en el momento de simular. \n'\
+        '   Los pesos baricentricos de cada celda se calculan una vez y quedan\n'\
+        '   en una matriz dispersa (3 valores por celda), cada bloque de\n'\
+        '   intervalos se interpola con un producto matricial.\n'\
         '\n'\
         'Parametros\n'\
         '----------\n'\
@@ -3277,6 +4552,11 @@ class SimuBasin(Basin):
         'path : path con nombre en donde se guardara el binario con.\n'\
         '   la informacion de lluvia.\n'\
         'threshold: threshold a partir del cual se considera que un campo contiene lluvia\n'\
+        'BlockSize : Cantidad de intervalos interpolados en cada producto.\n'\
+        'CacheDir : (None) Carpeta donde se guardan los pesos de la malla, si las\n'\
+        '   coordenadas de la cuenca y de las estaciones no cambian se leen de alli\n'\
+        '   en lugar de calcularse de nuevo.\n'\
+        'Sparse : (False) Guarda el binario en formato disperso (ver rain_bin_compress).\n'\
         '\n'\
         'Retornos\n'\
         '----------\n'\
@@ -3308,65 +4588,34 @@ class SimuBasin(Basin):
         #Obtiene las coordenadas de cada celda de la cuenca
         x,y = cu.basin_coordxy(self.structure,self.ncells)
         xy_basin=np.vstack((x,y))
-        #Obtiene la malla irregular
-        TIN_mesh=Delaunay(coord.T)
-        TIN_mesh=TIN_mesh.vertices.T+1
-        #Obtiene las pertenencias en la cuenca a la malla
-        #TIN_perte = models.rain_pre_mit(xy_basin,TIN_mesh,coord,self.ncells,
-        #   TIN_mesh.shape[1],coord.shape[1])
-        c = 1
-        TIN_perte = np.zeros((1,self.ncells))
-        for t in TIN_mesh.T:
-            t = t-1
-            t = np.append(t, t[0])
-            Poly = np.vstack([coord[0][t], coord[1][t]])
-            bbPath = mplPath.Path(Poly.T, closed=True)
-            Contiene = bbPath.contains_points(xy_basin.T)
-            TIN_perte[0][Contiene == True] = c
-            c+=1
+        #Obtiene la malla irregular y los pesos de cada celda en su triangulo
+        W = __rain_operator_cached__(CacheDir, 'tin', xy_basin, coord, (),
+            lambda: __rain_tin_operator__(xy_basin, coord)[0])
         #Revisa si todas las celdas quedaron asignadas
-        if len(TIN_perte[TIN_perte == 0]) == 0:
+        TIN_perte = W.getnnz(axis = 1)
+        if TIN_perte.min() > 0:
             #Selecciona si es por laderas o por celdas
-            if self.modelType[0] is 'h':
-                maskVector = np.copy(self.hills_own)
-            elif self.modelType[0] is 'c':
-                maskVector = np.ones(self.ncells)
-            #Interpola con tin
-            meanRain,posIds = models.rain_mit(xy_basin,
-                coord,
-                reg,
-                TIN_mesh,
-                TIN_perte,
-                self.nhills,
-                path,
-                threshold,
-                maskVector,
-                self.ncells,
-                coord.shape[1],
-                TIN_mesh.shape[1],
-                reg.shape[1])
+            Hills = None
+            if self.modelType[0] == 'h':
+                Hills = __rain_hills_operator__(self.hills_own, self.nhills)
+            #Interpola con tin, los registros faltantes se toman como cero
+            meanRain,posIds = __rain_write_fields__(path, W, np.maximum(reg, 0.0),
+                threshold, Hills, BlockSize, Sparse = Sparse)
             #Guarda un archivo con informacion de la lluvia
-            f=open(path[:-3]+'hdr','w')
-            f.write('Numero de celdas: %d \n' % self.ncells)
-            f.write('Numero de laderas: %d \n' % self.nhills)
-            f.write('Numero de registros: %d \n' % reg.shape[1])
-            f.write('Numero de campos no cero: %d \n' % posIds.max())
-            f.write('Tipo de interpolacion: TIN\n')
-            f.write('IDfecha, Record, Lluvia, Fecha \n')
+            dates = None
             if isPandas:
                 dates=registers.index.to_pydatetime()
-                c = 1
-                for d,pos,m in zip(dates,posIds,meanRain):
-                    f.write('%d, \t %d, \t %.2f, %s \n' % (c,pos,m,d.strftime('%Y-%m-%d-%H:%M')))
-                    c+=1
-            f.close()
+            __Save_rain_hdr__(path[:-3]+'hdr', self.ncells, self.nhills, meanRain,
+                posIds, dates, 'TIN')
             return meanRain, posIds
         else:
             print('Error: Existen celdas de la cuenca sin asignacion de triangulos, se retornan las coordenadas no asignadas')
-            pos = np.where(TIN_perte == 0)[1]
+            pos = np.where(TIN_perte == 0)[0]
             return xy_basin[0,pos], xy_basin[1,pos]
 
-    def rain_interpolate_idw(self,coord,registers,path,p=1,threshold=0.0):
+    @__model_method__
+    def rain_interpolate_idw(self,coord,registers,path,p=1,threshold=0.0,
+        k = None, BlockSize = 24, CacheDir = None, Sparse = False):
         'Descripcion: Interpola la lluvia mediante la metodologia\n'\
         '   del inverso de la distancia ponderado. \n'\
         '\n'\
@@ -3382,6 +4631,15 @@ class SimuBasin(Basin):
         '   que un intervalo tiene suficiente agua como para generar reaccion\n'\
         '   (threshold = 0.0) a medida que incremente se generaran archivos mas\n'\
         '   livianos, igualmente existe la posibilidad de borrar informacion.\n'\
+        'k : (None) Si se da, cada celda usa solo las k estaciones mas cercanas (KD-tree),\n'\
+        '   los pesos quedan en una matriz dispersa y cada bloque de intervalos se\n'\
+        '   interpola con un producto matricial, si es None se usa models.rain_idw.\n'\
+        'BlockSize : Cantidad de intervalos interpolados en cada producto (k no None).\n'\
+        'CacheDir : (None) Carpeta donde se guardan los pesos dispersos, si las\n'\
+        '   coordenadas de la cuenca, de las estaciones, p y k no cambian se leen\n'\
+        '   de alli en lugar de calcularse de nuevo, si k es None se usan todas\n'\
+        '   las estaciones.\n'\
+        'Sparse : (False) Guarda el binario en formato disperso (ver rain_bin_compress).\n'\
         '\n'\
         'Retornos\n'\
         '----------\n'\
@@ -3403,34 +4661,115 @@ class SimuBasin(Basin):
         #Obtiene las coordenadas de cada celda de la cuenca
         x,y = cu.basin_coordxy(self.structure,self.ncells)
         xy_basin=np.vstack((x,y))
+        #Interpola con idw disperso de las k estaciones mas cercanas
+        if k is None and (CacheDir is not None or Sparse):
+            k = coord.shape[1]
+        if k is not None:
+            W = __rain_operator_cached__(CacheDir, 'idw', xy_basin, coord, (p, k),
+                lambda: __rain_idw_operator__(xy_basin, coord, p, k))
+            Hills = None
+            if self.modelType[0] == 'h':
+                Hills = __rain_hills_operator__(self.hills_own, self.nhills)
+            meanRain,posIds = __rain_write_fields__(path, W, reg, threshold,
+                Hills, BlockSize, Sparse = Sparse)
         #Interpola con idw
-        if self.modelType[0] is 'h':
+        elif self.modelType[0] == 'h':
             meanRain,posIds = models.rain_idw(xy_basin, coord, reg, p, self.nhills,
                 path, threshold, self.hills_own, self.ncells, coord.shape[1],reg.shape[1])
-        elif self.modelType[0] is 'c':
+        elif self.modelType[0] == 'c':
             meanRain,posIds = models.rain_idw(xy_basin, coord, reg, p, self.nhills,
                 path, threshold, np.ones(self.ncells), self.ncells, coord.shape[1],reg.shape[1])
         #Guarda un archivo con informacion de la lluvia
-        f=open(path[:-3]+'hdr','w')
-        f.write('Numero de celdas: %d \n' % self.ncells)
-        f.write('Numero de laderas: %d \n' % self.nhills)
-        f.write('Numero de registros: %d \n' % reg.shape[1])
-        f.write('Numero de campos no cero: %d \n' % posIds.max())
-        f.write('Tipo de interpolacion: IDW, p= %.2f \n' % p)
-        f.write('IDfecha, Record, Lluvia, Fecha \n')
+        dates = None
         if isPandas:
             dates=registers.index.to_pydatetime()
-            c = 1
-            for d,pos,m in zip(dates,posIds,meanRain):
-                f.write('%d, \t %d, \t %.2f, %s \n' % (c,pos,m,d.strftime('%Y-%m-%d-%H:%M')))
-                c+=1
-        f.close()
+        __Save_rain_hdr__(path[:-3]+'hdr', self.ncells, self.nhills, meanRain,
+            posIds, dates, 'IDW, p= %.2f' % p)
         return meanRain,posIds
 
+    @__model_method__
+    def rain_interpolate_kriging(self,coord,registers,path,threshold=0.0,
+        k = 12, Variogram = 'exponential', Range = None, Sill = 1.0, Nugget = 0.0,
+        BlockSize = 24, CacheDir = None, Sparse = False):
+        'Descripcion: Interpola la lluvia mediante kriging ordinario.\n'\
+        '   Cada celda usa sus k estaciones mas cercanas, las celdas que comparten\n'\
+        '   las mismas estaciones comparten un sistema de kriging que se factoriza\n'\
+        '   una sola vez, los pesos quedan en una matriz dispersa y cada bloque\n'\
+        '   de intervalos se interpola con un producto matricial.\n'\
+        '   Cuando faltan estaciones se resuelve el kriging con las que reportan.\n'\
+        '\n'\
+        'Parametros\n'\
+        '----------\n'\
+        'self : .\n'\
+        'coord : Array (2,Ncoord) con las coordenadas de estaciones.\n'\
+        'registers : DataFrame de pandas (Nest,Nregisters) con los registros de lluvia.\n'\
+        'path : path con nombre en donde se guardara el binario con.\n'\
+        '   la informacion de lluvia.\n'\
+        'threshold : threshold de suma total de lluvia bajo el cual se considera\n'\
+        '   que un intervalo no tiene lluvia.\n'\
+        'k : Cantidad de estaciones de la vecindad de cada celda (None: todas).\n'\
+        'Variogram : Modelo de variograma: exponential, spherical o gaussian.\n'\
+        'Range : Rango del variograma [m], si es None se usa la mitad de la\n'\
+        '   maxima distancia entre estaciones.\n'\
+        'Sill : Meseta del variograma.\n'\
+        'Nugget : Pepita del variograma.\n'\
+        'BlockSize : Cantidad de intervalos interpolados en cada producto.\n'\
+        'CacheDir : (None) Carpeta donde se guardan los pesos dispersos, si las\n'\
+        '   coordenadas y el variograma no cambian se leen de alli.\n'\
+        'Sparse : (False) Guarda el binario en formato disperso (ver rain_bin_compress).\n'\
+        '\n'\
+        'Retornos\n'\
+        '----------\n'\
+        'Guarda el binario, no hay retorno\n'\
+        'meanRain :  La serie de lluvia promedio interpolada para la cuenca\n'\
+        '\n'\
+        'Mirar Tambien\n'\
+        '----------\n'\
+        'rain_interpolate_idw: interpola campos mediante la metodologia idw.\n'\
+        'rain_interpolate_mit: interpola campos mediante una malla de triangulos.\n'\
+        #Mira si los registros son un data frame de pandas
+        isPandas=False
+        if type(registers)==pd.core.frame.DataFrame:
+            reg=registers.values.T
+            isPandas=True
+        else:
+            reg=registers
+        #Obtiene las coordenadas de cada celda de la cuenca
+        x,y = cu.basin_coordxy(self.structure,self.ncells)
+        xy_basin=np.vstack((x,y))
+        #Parametros del variograma
+        if Range is None:
+            Range = 0.5 * np.hypot(coord[0][:,None] - coord[0][None,:],
+                coord[1][:,None] - coord[1][None,:]).max()
+        variogram = {'Variogram': Variogram, 'Range': Range, 'Sill': Sill, 'Nugget': Nugget}
+        #Operador con todas las estaciones y operadores de las estaciones que reportan
+        W = __rain_operator_cached__(CacheDir, 'kriging', xy_basin, coord,
+            (k, Variogram, Range, Sill, Nugget),
+            lambda: __rain_kriging_operator__(xy_basin, coord, k, **variogram))
+        def PatternOperator(report):
+            if report.all():
+                return W
+            return __rain_kriging_operator__(xy_basin, coord[:,report], k, **variogram)
+        Hills = None
+        if self.modelType[0] == 'h':
+            Hills = __rain_hills_operator__(self.hills_own, self.nhills)
+        meanRain,posIds = __rain_write_fields__(path, W, reg, threshold,
+            Hills, BlockSize, PatternOperator = PatternOperator, Sparse = Sparse)
+        #Guarda un archivo con informacion de la lluvia
+        dates = None
+        if isPandas:
+            dates=registers.index.to_pydatetime()
+        __Save_rain_hdr__(path[:-3]+'hdr', self.ncells, self.nhills, meanRain,
+            posIds, dates, 'Kriging, %s' % Variogram)
+        return meanRain,posIds
+
+    @__model_method__
     def rain_radar2basin_from_asc(self,path_in,path_out,fechaI,fechaF,dt,
         pre_string,post_string,fmt = '%Y%m%d%H%M',conv_factor=1.0/12.0,
-        threshold = 0.0):
+        threshold = 0.0, nproc = 1, Prefetch = None, IndexPath = None):
         'Descripcion: Genera campos de lluvia a partir de archivos asc. \n'\
+        '   Los mapas se leen y se llevan a la cuenca en un grupo de procesos\n'\
+        '   que se adelantan al escritor, el cual guarda los campos en orden.\n'\
         '\n'\
         'Parametros\n'\
         '----------\n'\
@@ -3440,6 +4779,11 @@ class SimuBasin(Basin):
         'fechaI: Fecha de inicio de registros.\n'\
         'fechaF: Fecha de finalizacion de registros.\n'\
         'dt: Intervalo de tiempo entre registros.\n'\
+        'nproc: Cantidad de procesos que leen los mapas (1: secuencial).\n'\
+        'Prefetch: Maximo de mapas leidos que esperan ser escritos (defecto 2*nproc),\n'\
+        '   limita la memoria usada.\n'\
+        'IndexPath: (None) archivo .npz con el indice de path_in, en los siguientes\n'\
+        '   llamados solo se leen las fechas de los archivos nuevos.\n'\
         'Retornos\n'\
         '----------\n'\
         'Guarda el binario, no hay retorno\n'\
@@ -3452,29 +4796,35 @@ class SimuBasin(Basin):
         'rain_radar2basin_from_array: Mete campos de lluvia mediante multiples arrays.\n'\
         #Edita la path de salida
         if path_out.endswith('.hdr') or path_out.endswith('.bin'):
-            path_bin = path_out[:-3]+'.bin'
-            path_hdr = path_out[:-3]+'.hdr'
+            path_bin = path_out[:-4]+'.bin'
+            path_hdr = path_out[:-4]+'.hdr'
         else:
             path_bin = path_out+'.bin'
             path_hdr = path_out+'.hdr'
         #Establece la cantidad de elementos de acuerdo al tipo de cuenca
-        if self.modelType[0] is 'c':
+        if self.modelType[0] == 'c':
             N = self.ncells
-        elif self.modelType[0] is 'h':
+        elif self.modelType[0] == 'h':
             N = self.nhills
-        #Guarda la primera entrada como un mapa de ceros
-        models.write_int_basin(path_bin,np.zeros((1,N)),1,N,1)
         #Genera la lista de las fechas.
         ListDates,dates = __ListaRadarNames__(path_in,
             fechaI,fechaF,
-            fmt,post_string,pre_string,dt)
-        #Lee los mapas y los transforma
+            fmt,post_string,pre_string,dt,IndexPath)
+        #Propiedades del DEM para los procesos que leen
+        geo = {'ncols':cu.ncols, 'nrows':cu.nrows, 'xll':cu.xll, 'yll':cu.yll,
+            'dx':cu.dx, 'dy':cu.dy, 'dxp':cu.dxp, 'nodata':cu.nodata}
+        Frames = __ordered_prefetch__(__radar_asc_read__,
+            [path_in + l for l in ListDates], nproc, Prefetch,
+            __radar_asc_init__, (self.structure, self.modelType, self.hills_own,
+                self.ncells, self.nhills, geo))
+        #Guarda la primera entrada como un mapa de ceros y luego los campos en orden
         cont = 1
         meanRain = []
         posIds = []
-        for l in ListDates:
-            Map,p = read_map_raster(path_in + l)
-            vec = self.Transform_Map2Basin(Map,p) * conv_factor
+        f = open(path_bin, 'wb')
+        np.zeros(N, dtype = np.int32).tofile(f)
+        for vec in Frames:
+            vec = vec * conv_factor
             #Si el mapa tiene mas agua de un threshold
             if vec.sum() > threshold:
                 #Actualiza contador, lluvia media y pocisiones
@@ -3482,31 +4832,99 @@ class SimuBasin(Basin):
                 meanRain.append(vec.mean())
                 posIds.append(cont)
                 #Guarda el vector
-                vec = vec*1000; vec = vec.astype(int)
-                models.write_int_basin(path_bin,np.zeros((1,N))+vec,cont,N,1)
+                (vec*1000).astype(np.int32).tofile(f)
             else:
                 #lluvia media y pocisiones
                 meanRain.append(0.0)
                 posIds.append(1)
+        f.close()
         posIds = np.array(posIds)
         meanRain = np.array(meanRain)
         #Guarda un archivo con informacion de la lluvia
-        f=open(path_hdr[:-3]+'hdr','w')
-        f.write('Numero de celdas: %d \n' % self.ncells)
-        f.write('Numero de laderas: %d \n' % self.nhills)
-        f.write('Numero de registros: %d \n' % meanRain.shape[0])
-        f.write('Numero de campos no cero: %d \n' % posIds.max())
-        f.write('Tipo de interpolacion: radar \n')
-        f.write('IDfecha, Record, Lluvia, Fecha \n')
-        c = 1
-        for d,pos,m in zip(dates,posIds,meanRain):
-            f.write('%d, \t %d, \t %.2f, %s \n' % (c,pos,m,d.strftime('%Y-%m-%d-%H:%M')))
-            c+=1
-        f.close()
-        return np.array(meanRain),np.array(posIds)
+        __Save_rain_hdr__(path_hdr, self.ncells, self.nhills, meanRain, posIds,
+            dates, 'radar')
+        return meanRain, posIds
+
+    @__model_method__
+    def rain_radar2basin_from_nc(self, ListaRadar, FechasRadar, path_out, dt,
+        VarName = 'Rain', conv_factor = 1.0/12000.0, threshold = 0.0, nproc = 1,
+        Prefetch = None, BufferSize = 12):
+        'Descripcion: Genera campos de lluvia a partir de barridos de radar en netCDF.\n'\
+        '   De cada barrido solo se lee la ventana que encierra la cuenca, con un\n'\
+        '   indice de remuestreo que se calcula una vez por grilla. Los barridos\n'\
+        '   de cada intervalo se suman en un grupo de procesos y los campos se\n'\
+        '   guardan en orden con RainWriter.\n'\
+        '   Las celdas fuera de la grilla quedan en cero y los faltantes dentro de\n'\
+        '   ella se llenan con la media de la ventana.\n'\
+        '\n'\
+        'Parametros\n'\
+        '----------\n'\
+        'self : .\n'\
+        'ListaRadar: lista de paths de los netCDF, con los atributos ncols, nrows,\n'\
+        '   xll, yll y dx, y la variable VarName de tamano [nrows, ncols].\n'\
+        'FechasRadar: fecha de cada barrido.\n'\
+        'path_out: path donde escribe el binario con la lluvia.\n'\
+        'dt: Intervalo de tiempo de salida (ej: 5min, 1H, o segundos), cada barrido\n'\
+        '   se suma al intervalo que termina en su fecha redondeada hacia arriba.\n'\
+        'VarName: Nombre de la variable de lluvia en los netCDF.\n'\
+        'conv_factor: Factor que lleva la variable a mm en el intervalo del barrido.\n'\
+        'threshold: Lluvia total minima de un campo para no tomarlo como seco.\n'\
+        'nproc: Cantidad de procesos que leen los barridos (1: secuencial).\n'\
+        'Prefetch: Maximo de intervalos leidos que esperan ser escritos (defecto 2*nproc).\n'\
+        'BufferSize: Cantidad de campos que se guardan en cada escritura.\n'\
+        '\n'\
+        'Retornos\n'\
+        '----------\n'\
+        'meanRain :  La serie de lluvia promedio.\n'\
+        'posIds : Registro de cada intervalo en el binario.\n'\
+        '\n'\
+        'Mirar Tambien\n'\
+        '----------\n'\
+        'rain_radar2basin_from_asc: Genera campos de lluvia a partir de archivos asc.\n'\
+        #Establece la cantidad de elementos de acuerdo al tipo de cuenca
+        if self.modelType[0] == 'c':
+            N = self.ncells
+        elif self.modelType[0] == 'h':
+            N = self.nhills
+        #Agrupa los barridos por intervalo de salida
+        if isinstance(dt, (int, float, np.integer, np.floating)):
+            dt = pd.Timedelta(seconds = dt)
+        dt = pd.Timedelta(dt)
+        Fechas = pd.DatetimeIndex(pd.to_datetime(FechasRadar)).ceil(dt)
+        Orden = np.argsort(Fechas.values, kind = 'stable')
+        ListaRadar = np.asarray(ListaRadar)[Orden]
+        Fechas = Fechas[Orden]
+        dates = pd.date_range(Fechas[0], Fechas[-1], freq = dt)
+        Pos = np.searchsorted(Fechas.values, dates.values, side = 'left')
+        PosF = np.searchsorted(Fechas.values, dates.values, side = 'right')
+        Grupos = [(ListaRadar[i:j].tolist(), VarName) for i,j in zip(Pos, PosF)]
+        #Propiedades del DEM para los procesos que leen
+        geo = {'ncols':cu.ncols, 'nrows':cu.nrows, 'xll':cu.xll, 'yll':cu.yll,
+            'dx':cu.dx, 'dy':cu.dy, 'dxp':cu.dxp, 'nodata':cu.nodata}
+        Frames = __ordered_prefetch__(__radar_nc_read__, Grupos, nproc, Prefetch,
+            __radar_asc_init__, (self.structure, self.modelType, self.hills_own,
+                self.ncells, self.nhills, geo))
+        #Escribe los campos en orden
+        Writer = RainWriter(path_out, N, self.ncells, self.nhills, 'radar', BufferSize)
+        meanRain = []
+        posIds = []
+        try:
+            for fecha, vec in zip(dates.to_pydatetime(), Frames):
+                vec = vec * conv_factor
+                if vec.sum() > threshold:
+                    meanRain.append(vec.mean())
+                    posIds.append(Writer.write(fecha, vec, vec.mean()))
+                else:
+                    meanRain.append(0.0)
+                    posIds.append(Writer.write(fecha))
+        finally:
+            Writer.close()
+        return np.array(meanRain), np.array(posIds)
 
+    @__model_method__
     def rain_radar2basin_from_array(self,vec=None,path_out=None,fecha=None,dt=None,
-        status='update',threshold = 0.01, doit = False):
+        status='update',threshold = 0.01, doit = False, BufferSize = 1,
+        FlushTime = 600.0):
         'Descripcion: Genera campos de lluvia a partir de archivos array\n'\
         '\n'\
         'Parametros\n'\
@@ -3522,6 +4940,11 @@ class SimuBasin(Basin):
         '   close: Cierra un binario que se ha generado mediante update.\n'\
         '   reset: Reinicia las condiciones de self.radar... para la creacion de un campo nuevo.\n'\
         'doit: Independiente del threshold escribe el binario en la siguiente entrada.\n'\
+        'BufferSize: Campos que se guardan en memoria antes de escribirse (ver RainWriter).\n'\
+        'FlushTime: Segundos maximos que un campo espera para ser escrito, aunque\n'\
+        '   no lleguen mas campos (None: solo al llenar el buffer o con close).\n'\
+        '   El binario se abre una vez con el primer update y se cierra con close,\n'\
+        '   el .hdr se actualiza en cada escritura.\n'\
         'Retornos\n'\
         '----------\n'\
         'Guarda el binario, no hay retorno\n'\
@@ -3540,60 +4963,46 @@ class SimuBasin(Basin):
                 path_bin = path_out+'.bin'
                 path_hdr = path_out+'.hdr'
         #Establece la cantidad de elementos de acuerdo al tipo de cuenca
-        if self.modelType[0] is 'c':
+        if self.modelType[0] == 'c':
             N = self.ncells
-        elif self.modelType[0] is 'h':
+        elif self.modelType[0] == 'h':
             N = self.nhills
-            try:
-                if vec.shape[0]  == self.ncells:
-                    vec = self.Transform_Basin2Hills(vec,sumORmean=1)
-            except:
-                pass
+            if vec is not None and vec.shape[0] == self.ncells:
+                vec = self.Transform_Basin2Hills(vec,SumMeanMax=0)
         # De acerudo al estado actualiza las variables o guarda el
         # binario final
         actualizo = 1
         if status == 'update':
-            #Entrada 1 es la entrada de campos sin lluvia
-            if len(self.radarDates) == 0:
-                models.write_int_basin(path_bin,np.zeros((1,N)),1,N,1)
+            #Abre el binario una vez, la entrada 1 es la de campos sin lluvia
+            if self.radarWriter is None:
+                self.radarWriter = RainWriter(path_bin, N, self.ncells, self.nhills,
+                    'radar', BufferSize, FlushTime, append = len(self.radarDates) > 0)
             if vec.mean() > threshold or doit:
                 #Actualiza contador, lluvia media y pocisiones
-                self.radarCont +=1
+                self.radarCont = self.radarWriter.write(fecha, vec, vec.mean())
                 self.radarMeanRain.append(vec.mean())
                 self.radarPos.append(self.radarCont)
-                #Guarda el vector
-                vec = vec*1000; vec = vec.astype(int)
-                models.write_int_basin(path_bin,np.zeros((1,N))+vec,
-                    self.radarCont,N,1)
                 actualizo = 0
             else:
                 #lluvia media y pocisiones
+                self.radarWriter.write(fecha)
                 self.radarMeanRain.append(0.0)
                 self.radarPos.append(1)
             self.radarDates.append(fecha)
-        #Si ya no va a agregar nada, no agrega mas campos y genera el .hdr
+        #Si ya no va a agregar nada, no agrega mas campos y cierra el binario y el .hdr
         elif status == 'close':
-            self.radarMeanRain = np.array(self.radarMeanRain)
-            self.radarPos = np.array(self.radarPos)
-            #Guarda un archivo con informacion de la lluvia
-            f=open(path_hdr[:-3]+'hdr','w')
-            f.write('Numero de celdas: %d \n' % self.ncells)
-            f.write('Numero de laderas: %d \n' % self.nhills)
-            f.write('Numero de registros: %d \n' % self.radarMeanRain.shape[0])
-            f.write('Numero de campos no cero: %d \n' % self.radarPos.max())
-            f.write('Tipo de interpolacion: radar \n')
-            f.write('IDfecha, Record, Lluvia, Fecha \n')
-            c = 1
-            for d,pos,m in zip(self.radarDates,
-                self.radarPos,self.radarMeanRain):
-                f.write('%d, \t %d, \t %.2f, %s \n' % (c,pos,m,d.strftime('%Y-%m-%d-%H:%M')))
-                c+=1
-            f.close()
-            #Vuelve las variables listas de nuevo
-            self.radarMeanRain = self.radarMeanRain.tolist()
-            self.radarPos = self.radarPos.tolist()
+            if self.radarWriter is not None:
+                self.radarWriter.close()
+                self.radarWriter = None
+            else:
+                __Save_rain_hdr__(path_hdr, self.ncells, self.nhills,
+                    np.array(self.radarMeanRain), np.array(self.radarPos),
+                    self.radarDates, 'radar')
         elif status == 'reset':
             #Variables de radar
+            if self.radarWriter is not None:
+                self.radarWriter.close()
+                self.radarWriter = None
             self.radarDates = []
             self.radarPos = []
             self.radarMeanRain = []
@@ -3603,25 +5012,18 @@ class SimuBasin(Basin):
             f=open(path_hdr[:-3]+'hdr','r')
             Lista = f.readlines()
             self.radarCont = int(Lista[3].split()[-1])
-            cantidadIds = int(Lista[2].split()[-1])
             f.close()
-            #Abre con numpy para simplificar las cosas
-            a = np.loadtxt(path_hdr,skiprows=6,dtype='str').T
-            if self.radarCont >= 1 and cantidadIds > 1:
-                self.radarPos = [int(i.split(',')[0]) for i in a[1]]
-                self.radarMeanRain = [float(i.split(',')[0]) for i in a[2]]
-                for i in a[3]:
-                    d = datetime.datetime.strptime(i,'%Y-%m-%d-%H:%M')
-                    self.radarDates.append(d)
-            else:
-                self.radarPos = [int(a[1].split(',')[0])]
-                self.radarMeanRain = [float(a[2].split(',')[0])]
-                self.radarDates = [datetime.datetime.strptime(a[-1], '%Y-%m-%d-%H:%M')]
+            #Toma las posiciones, lluvias y fechas del indice binario
+            Idx = __read_hdr_idx__(path_hdr)
+            self.radarPos = Idx['record'].tolist()
+            self.radarMeanRain = Idx['mean'].tolist()
+            self.radarDates = __Epoch2Dates__(Idx['epoch']).to_pydatetime().tolist()
         return actualizo
 
     #------------------------------------------------------
     # Subrutinas para preparar modelo
     #------------------------------------------------------
+    @__model_method__
     def set_Geomorphology(self,thresholdes=[30,500],stream_width=None):
         'Descripcion: calcula las propiedades geomorfologicas necesarias \n'\
         '   para la simulacion. \n'\
@@ -3709,6 +5111,7 @@ class SimuBasin(Basin):
         #Ajusta variable de que la geomorfologia esta calculada
         self.isSetGeo = True
 
+    @__model_method__
     def set_Speed_type(self,types=np.ones(3)):
         'Descripcion: Especifica el tipo de velocidad a usar en cada \n'\
         '   nivel del modelo. \n'\
@@ -3730,6 +5133,7 @@ class SimuBasin(Basin):
             else:
                 models.speed_type[c]=1
 
+    @__model_method__
     def set_Floods(self,var,VarName, threshold = 1000, NumCeldas = 6, Default = False):
         'Descripcion: Aloja las variables del sub modelo de inundaciones\n'\
         '\n'\
@@ -3788,18 +5192,18 @@ class SimuBasin(Basin):
                 isVec=True
             #finalmente mete la variable en el modelo
             N = self.ncells
-            if VarName is 'Stream_W' :
+            if VarName == 'Stream_W' :
                 models.flood_w = np.ones((1,N))*Vec
-            elif VarName is 'Stream_D50':
+            elif VarName == 'Stream_D50':
                 models.flood_d50 = np.ones((1,N))*Vec
-            elif VarName is 'HAND':
+            elif VarName == 'HAND':
                 self.GetGeo_HAND(threshold = threshold)
                 models.flood_hand = np.ones((1,N))*np.copy(self.CellHAND)
                 models.flood_aquien = np.ones((1,N))*np.copy(self.CellHAND_drainCell)
-            elif VarName is 'Slope':
+            elif VarName == 'Slope':
                 self.GetGeo_Cell_Basics()
                 models.flood_slope = np.ones((1,N))*np.sin(np.arctan(self.CellSlope))
-            elif VarName is 'Sections':
+            elif VarName == 'Sections':
                 self.GetGeo_Sections(NumCeldas = NumCeldas)
                 models.flood_sections = np.ones((NumCeldas*2+1,N)) * self.Sections
                 models.flood_sec_cells = np.ones((NumCeldas*2+1,N)) * self.Sections_Cells
@@ -3816,6 +5220,7 @@ class SimuBasin(Basin):
         elif VarName == 'MaxIter':
             models.flood_max_iter = var
 
+    @__model_method__
     def set_PhysicVariables(self,modelVarName,var,pos,mask=None):
         'Descripcion: Coloca las variables fisicas en el modelo \n'\
         '   Se debe assignarel nombre del tipo de variable, la variable\n'\
@@ -3875,22 +5280,23 @@ class SimuBasin(Basin):
             Vec = var
             isVec=True
         #Si el modelo es tipo ladera agrega la variable
-        if self.modelType[0] is 'h':
+        if self.modelType[0] == 'h':
             Vec = self.Transform_Basin2Hills(Vec,mask=mask)
         #finalmente mete la variable en el modelo
-        if modelVarName is 'h_coef':
-            models.h_coef[pos] = Vec
-        elif modelVarName is 'h_exp':
-            models.h_exp[pos] = Vec
-        elif modelVarName is 'v_coef':
-            models.v_coef[pos] = Vec
-        elif modelVarName is 'v_exp':
+        if modelVarName == 'h_coef':
+            __param_set__('h_coef', pos, Vec)
+        elif modelVarName == 'h_exp':
+            __param_set__('h_exp', pos, Vec)
+        elif modelVarName == 'v_coef':
+            __param_set__('v_coef', pos, Vec)
+        elif modelVarName == 'v_exp':
             models.v_exp[pos] = Vec
-        elif modelVarName is 'capilar':
-            models.max_capilar[0] = Vec
-        elif modelVarName is 'gravit':
-            models.max_gravita[0] = Vec
+        elif modelVarName == 'capilar':
+            __param_set__('max_capilar', 0, Vec)
+        elif modelVarName == 'gravit':
+            __param_set__('max_gravita', 0, Vec)
 
+    @__model_method__
     def set_Storage(self,var,pos,hour_scale=False):
         'Descripcion: \n'\
         '   Establece el almacenamiento inicial del modelo\n'\
@@ -3921,9 +5327,9 @@ class SimuBasin(Basin):
         '----------\n'\
         'save_storage(slef,storage).\n'\
         #Determina el tipo de unidades del modelo
-        if self.modelType[0] is 'c':
+        if self.modelType[0] == 'c':
             N = self.ncells
-        elif self.modelType[0] is 'h':
+        elif self.modelType[0] == 'h':
             N = self.nhills
         #Obtiene el vector que va a alojar en el modelo
         isVec=False
@@ -3933,19 +5339,14 @@ class SimuBasin(Basin):
                 #Si es un string lee el binario de almacenamiento alojado en esa path
                 Vec,res = models.read_float_basin_ncol(var_bin,pos+1,N,5)
             if type(pos) == str:
-                # Lee las fechas
-                L = np.loadtxt(var_hdr,skiprows = 5, usecols = (0,6), dtype = str)
-                if hour_scale == False:
-                    Fechas = [datetime.datetime.strptime(i[1], '%Y-%m-%d-%H:%M') for i in L]
-                else:
-                    Fechas = [datetime.datetime.strptime(i[1][:-3], '%Y-%m-%d-%H') for i in L]
-                try:
-                    if hour_scale == False:
-                        posFecha = Fechas.index(datetime.datetime.strptime(pos, '%Y-%m-%d-%H:%M'))
-                    else:
-                        posFecha = Fechas.index(datetime.datetime.strptime(pos[:-3], '%Y-%m-%d-%H'))
-                except:
-                    print('Error: no se encuentra la fecha especificada en el archivo '+var)
+                # Busca la fecha en el indice binario (fechas en orden)
+                Fechas = __read_hdr_idx__(var_hdr, storage = True)['epoch']
+                Fecha = __Dates2Epoch__([datetime.datetime.strptime(pos, '%Y-%m-%d-%H:%M')])[0]
+                if hour_scale:
+                    Fechas = Fechas // 3600; Fecha = Fecha // 3600
+                posFecha = np.searchsorted(Fechas, Fecha)
+                if posFecha >= Fechas.size or Fechas[posFecha] != Fecha:
+                    raise ValueError('No se encuentra la fecha %s en el archivo %s' % (pos, var))
                 Vec,res = models.read_float_basin_ncol(var_bin,posFecha+1,N,5)
             isVec=True
             for p in range(5):
@@ -3959,6 +5360,7 @@ class SimuBasin(Basin):
             isVec=True
             models.storage[pos] = Vec
 
+    @__model_method__
     def set_StorageDates(self, SimuDates, SelectedDates, Nintervals):
         '''Function to set the variable that determines at which dates
         store the results from the model.
@@ -3977,6 +5379,7 @@ class SimuBasin(Basin):
         models.guarda_cond = np.copy(Guarda)
         return Guarda
 
+    @__model_method__
     def set_vFluxesDates(self, SimuDates, SelectedDates, Nintervals):
         '''Function to set the variable that determines at which dates
         store the results from the model.
@@ -3995,6 +5398,7 @@ class SimuBasin(Basin):
         models.guarda_vfluxes = np.copy(Guarda)
         return Guarda
 
+    @__model_method__
     def set_Control(self,coordXY,ids,tipo = 'Q'):
         'Descripcion: \n'\
         '   Establece los puntos deonde se va a realizar control del caudal\n'\
@@ -4017,18 +5421,18 @@ class SimuBasin(Basin):
         '----------\n'\
         'set_record, set_storage.\n'\
         #Obtiene los puntos donde hay coordenadas
-        if tipo is 'Q':
+        if tipo == 'Q':
             xyNew, basinPts, order = self.Points_Points2Stream(coordXY,ids)
-            if self.modelType[0] is 'c':
+            if self.modelType[0] == 'c':
                 models.control[0] = basinPts
                 IdsConvert = basinPts[basinPts!=0]
-            elif self.modelType[0] is 'h':
+            elif self.modelType[0] == 'h':
                 unitario = basinPts / basinPts
                 pos = self.hills_own * self.CellCauce * unitario
                 posGrande = self.hills_own * self.CellCauce * basinPts
                 IdsConvert = posGrande[posGrande!=0] / pos[pos!=0]
                 models.control[0][pos[pos!=0].astype(int).tolist()] = IdsConvert
-        elif tipo is 'H':
+        elif tipo == 'H':
             xyNew = coordXY
             basinPts, order = self.Points_Points2Basin(coordXY,ids)
             if self.modelType[0] == 'c':
@@ -4042,7 +5446,86 @@ class SimuBasin(Basin):
                 models.control_h[0][pos[pos!=0].astype(int).tolist()] = IdsConvert
         return IdsConvert,xyNew
 
+    @__model_method__
+    def set_Partition(self, Nparts = None, Nodes = None):
+        'Descripcion: \n'\
+        '   Parte la cuenca en subdominios para la ejecucion en paralelo\n'\
+        '   (run_shia con nthreads > 1): cada subdominio lo simula un hilo y los\n'\
+        '   subdominios que son tributarios de otro se simulan antes que este en\n'\
+        '   cada intervalo, por lo que el resultado es identico al de la cuenca\n'\
+        '   completa. Sin Nparts ni Nodes quita la particion.\n'\
+        '\n'\
+        'Parametros\n'\
+        '----------\n'\
+        'Nparts : Cantidad aproximada de subdominios, corta la red donde los\n'\
+        '   elementos aguas arriba aun sin subdominio llegan a N/Nparts.\n'\
+        'Nodes : Posiciones de los elementos (celdas o laderas) donde se corta\n'\
+        '   siempre, cada uno es la salida de un subdominio.\n'\
+        '\n'\
+        'Retornos\n'\
+        '----------\n'\
+        'Ncells : Cantidad de elementos de cada subdominio, en models.sub_domain\n'\
+        '   queda el subdominio de cada elemento (el 1 es el de la salida).\n'\
+        '\n'\
+        'Mirar Tambien\n'\
+        '----------\n'\
+        'run_shia.\n'\
+        #Cantidad de elementos del modelo
+        if self.modelType[0] == 'c':
+            N = self.ncells
+        elif self.modelType[0] == 'h':
+            N = self.nhills
+        if Nparts is None and Nodes is None:
+            models.sub_domain = np.zeros((1,N))
+            return np.array([N])
+        #Elementos de corte y tamano objetivo de cada subdominio
+        cuts = np.zeros(N, dtype = int)
+        if Nodes is not None:
+            cuts[np.asarray(Nodes, dtype = int)] = 1
+        size = 0 if Nparts is None else int(np.ceil(N / float(Nparts)))
+        dom, Ndom = models.route_partition(size, cuts)
+        models.sub_domain = dom[np.newaxis]
+        return np.bincount(dom)[1:]
 
+    @__model_method__
+    def set_CompactParams(self, compact = True):
+        'Descripcion: \n'\
+        '   Guarda con una sola columna los mapas de parametros que son uniformes\n'\
+        '   en la cuenca (v_coef, h_coef, h_exp, max_capilar, max_gravita y\n'\
+        '   max_aquifer), el modelo usa ese valor en todos los elementos y el\n'\
+        '   resultado es identico. Con modelos grandes y parametros constantes\n'\
+        '   reduce la memoria del modelo y de las copias de cada cuenca.\n'\
+        '   set_PhysicVariables vuelve a expandir un mapa si se le asigna un\n'\
+        '   vector que no es uniforme.\n'\
+        '\n'\
+        'Parametros\n'\
+        '----------\n'\
+        'compact : (True) Compacta los mapas uniformes, con False los expande\n'\
+        '   todos a la cantidad de elementos.\n'\
+        '\n'\
+        'Retornos\n'\
+        '----------\n'\
+        'Bytes : Memoria que ocupan los mapas de parametros.\n'\
+        '\n'\
+        'Mirar Tambien\n'\
+        '----------\n'\
+        'set_PhysicVariables, run_shia.\n'\
+        #Cantidad de elementos del modelo
+        if self.modelType[0] == 'c':
+            N = self.ncells
+        elif self.modelType[0] == 'h':
+            N = self.nhills
+        Bytes = 0
+        for k in __ParamMaps__:
+            v = getattr(models, k)
+            if compact and v.shape[1] > 1 and np.all(v == v[:, :1]):
+                setattr(models, k, np.copy(v[:, :1]))
+            elif not compact:
+                setattr(models, k, __param_full__(k, N))
+            Bytes += getattr(models, k).nbytes
+        return Bytes
+
+    @__model_method__
     def set_sediments(self,var,VarName, wi = [0.036, 2.2e-4, 8.6e-7],
         diametro = [0.35, 0.016, 0.001], G = 9.8):
         'Descripcion: Alojas las variables requeridas para la ejecucion\n'\
@@ -4069,9 +5552,9 @@ class SimuBasin(Basin):
         '   wmf.models.wi.\n'\
         '   wmf.models.diametro.\n'\
                 #Determina el tipo de unidades del modelo
-        if self.modelType[0] is 'c':
+        if self.modelType[0] == 'c':
             N = self.ncells
-        elif self.modelType[0] is 'h':
+        elif self.modelType[0] == 'h':
             N = self.nhills
                 #Se fija que tipo de variable es
         isVec=False
@@ -4087,7 +5570,7 @@ class SimuBasin(Basin):
             Vec = var
             isVec=True
         #Si el modelo es tipo ladera agrega la variable
-        if self.modelType[0] is 'h':
+        if self.modelType[0] == 'h':
             Vec = self.Transform_Basin2Hills(Vec,mask=mask)
         #Inicia las variables
         if VarName == 'Krus':
@@ -4103,6 +5586,7 @@ class SimuBasin(Basin):
         models.diametro = diametro
         models.g = G
 
+    @__model_method__
     def set_Slides(self,var,VarName):
         'Descripcion: Alojas las variables requeridas para la ejecucion\n'\
         '   del modelo de deslizamientos.\n'\
@@ -4148,22 +5632,23 @@ class SimuBasin(Basin):
             return 'El modelo por laderas no simula deslizamientos.'
         #finalmente mete la variable en el modelo
         N = self.ncells
-        if VarName is 'GammaSoil' :
+        if VarName == 'GammaSoil' :
             models.sl_gammas = np.ones((1,N))*Vec
-        elif VarName is 'Cohesion':
+        elif VarName == 'Cohesion':
             models.sl_cohesion = np.ones((1,N))*Vec
-        elif VarName is 'FrictionAngle':
+        elif VarName == 'FrictionAngle':
             models.sl_frictionangle = np.ones((1,N))*np.deg2rad(Vec)
-        elif VarName is 'Zs':
+        elif VarName == 'Zs':
             models.sl_zs = np.ones((1,N))*Vec
-        elif VarName is 'FS':
+        elif VarName == 'FS':
             models.sl_fs = var
-        elif VarName is 'Slope':
+        elif VarName == 'Slope':
             models.sl_radslope = np.ones((1,N))*np.arctan(Vec)
             models.sl_radslope[models.sl_radslope == 0] = 0.01
     #------------------------------------------------------
     # Guardado y Cargado de modelos de cuencas preparados
     #------------------------------------------------------
+    @__model_method__
     def Save_SimuBasin(self,path,SimSlides = False,
         ExtraVar = None):
         'Descripcion: guarda una cuenca previamente ejecutada\n'\
@@ -4188,9 +5673,9 @@ class SimuBasin(Basin):
             self.set_Geomorphology()
             print('Aviso: SE ha estimado la geomorfologia con los thresholdes por defecto threshold = [30, 500]')
         #Guarda la cuenca
-        if self.modelType[0] is 'c':
+        if self.modelType[0] == 'c':
             N = self.ncells
-        elif self.modelType[0] is 'h':
+        elif self.modelType[0] == 'h':
             N = self.nhills
 
         Dict = {'nombre':self.name,
@@ -4244,9 +5729,9 @@ class SimuBasin(Basin):
         #Var_H4max = GrupoSimHid.createVariable('h4_max','f4',('Nelem',),zlib = True)
         Control = GrupoSimHid.createVariable('control','i4',('Nelem',),zlib = True)
         ControlH = GrupoSimHid.createVariable('control_h','i4',('Nelem',),zlib = True)
-        if self.modelType[0] is 'c':
+        if self.modelType[0] == 'c':
             drena = GrupoSimHid.createVariable('drena','i4',('col3','Nelem'),zlib = True)
-        elif self.modelType[0] is 'h':
+        elif self.modelType[0] == 'h':
             drena = GrupoSimHid.createVariable('drena','i4',('Nelem'),zlib = True)
         unitType = GrupoSimHid.createVariable('unit_type','i4',('Nelem',),zlib = True)
         hill_long = GrupoSimHid.createVariable('hill_long','f4',('Nelem',),zlib = True)
@@ -4257,12 +5742,12 @@ class SimuBasin(Basin):
         elem_area = GrupoSimHid.createVariable('elem_area','f4',('Nelem',),zlib = True)
         speed_type = GrupoSimHid.createVariable('speed_type','i4',('col3',),zlib = True)
         storage = GrupoSimHid.createVariable('storage','i4',('col5','Nelem'),zlib = True)
-        VarH_coef[:] = models.h_coef
-        VarV_coef[:] = models.v_coef
-        VarH_exp[:] = models.h_exp
+        VarH_coef[:] = __param_full__('h_coef', N)
+        VarV_coef[:] = __param_full__('v_coef', N)
+        VarH_exp[:] = __param_full__('h_exp', N)
         VarV_exp[:] = models.v_exp
-        Var_H1max[:] = models.max_capilar
-        Var_H3max[:] = models.max_gravita
+        Var_H1max[:] = __param_full__('max_capilar', N)
+        Var_H3max[:] = __param_full__('max_gravita', N)
         #Pending activation
         #Var_H4max[:] = models.max_aquifer
         Control[:] = models.control
@@ -4334,11 +5819,28 @@ class SimuBasin(Basin):
         #------------------------------------------------------
         # Ejecucion del modelo
         #------------------------------------------------------
+    @__model_method__
+    def activate(self):
+        'Descripcion: Deja la cuenca cargada en wmf.models y wmf.cu.\n'\
+        '   Cada SimuBasin guarda su topologia, parametros y almacenamiento, y los\n'\
+        '   metodos que usan el modelo los cargan solos, esto solo hace falta para\n'\
+        '   editar o leer directamente las variables de models de esta cuenca.\n'\
+        '\n'\
+        'Retornos\n'\
+        '----------\n'\
+        'self : la cuenca, ya cargada.\n'\
+        #La carga la hace __model_method__
+        return self
+
+    @__model_method__
     def run_shia(self,Calibracion,
         rain_path, N_intervals, start_point = 1, StorageLoc = None, HspeedLoc = None,path_storage = None, path_speed = None,
-        path_conv = None, path_stra = None, path_retorno = None,kinematicN = 5, QsimDataFrame = True, 
+        path_conv = None, path_stra = None, path_retorno = None,kinematicN = 5, kinematicTol = 0,
+        kinematicCourant = 0, kinematicMaxSub = 60, kinematicHills = False, activityTol = 0,
+        QsimDataFrame = True, 
         EvpVariable = 'sun', EvpSerie = None, WheretoStore = None, path_vfluxes = None, 
-        Dates2Save = None, FluxesDates2Save = None, path_rc = None):
+        Dates2Save = None, FluxesDates2Save = None, path_rc = None, rain_dates = None,
+        nthreads = 1, fastKernel = True):
         'Descripcion: Ejecuta el modelo una ves este es preparado\n'\
         '   Antes de su ejecucion se deben tener listas todas las . \n'\
         '   variables requeridas . \n'\
@@ -4360,6 +5862,11 @@ class SimuBasin(Basin):
         '   - Max Aquifer.\n'\
         'rain_path : path donde se encuentra el archivo binario de lluvia:.\n'\
         '   generado por rain_interpolate_* o por rain_radar2basin.\n'\
+        '   Tambien puede ser la lluvia en memoria, la cual pasa directo al modelo:\n'\
+        '   - array o memmap (registros, elementos), o DataFrame con fechas en el indice.\n'\
+        '   - tupla (records, campos) como un binario: el intervalo i usa campos[records[i]-1]\n'\
+        '       y el record 1 es seco, solo se copian los campos usados.\n'\
+        '   Los campos flotantes van en mm y los enteros en mm*1000 (como en el binario).\n'\
         'N_intervals : Numero de intervalos de tiempo.\n'\
         'start_point : Punto donde comienza a usar registros de lluvia.\n'\
         '   los binarios generados por rain_* generan un archivo de texto.\n'\
@@ -4383,6 +5890,27 @@ class SimuBasin(Basin):
         '           Results = cu.run_shia(Calib, path_rain, 1, i)\n'\
         '           for c,j in enumerate(Results[''Storage'']):\n'\
         '               cu.set_Storage(j,c)\n'\
+        '   Con kinematicTol > 0 es el maximo de iteraciones de Newton.\n'\
+        'kinematicTol: (0) Tolerancia relativa de la velocidad en la onda cinematica.\n'\
+        '   Con 0 hace kinematicN iteraciones de promedio como en versiones anteriores.\n'\
+        '   Con > 0 (Ej: 1e-4) resuelve por Newton y sale al converger (casi siempre en\n'\
+        '   1 a 3 iteraciones), kinematicN pasa a ser el maximo de iteraciones.\n'\
+        'kinematicCourant: (0) Courant maximo (v*dt/longitud) del transito en el cauce, en cada\n'\
+        '   celda donde se supera el intervalo se divide en subpasos iguales (con la velocidad\n'\
+        '   del intervalo anterior), asi se puede usar un dt largo (horario) sin que las celdas\n'\
+        '   rapidas se vacien en un solo paso. Con 0 no hay subpasos, 1 es un valor tipico.\n'\
+        '   No aplica en run_shia_batch.\n'\
+        'kinematicMaxSub: (60) Maximo de subpasos en un intervalo.\n'\
+        'kinematicHills: (False) Tambien divide en subpasos los tanques de ladera que van\n'\
+        '   por onda cinematica (speed_type 2).\n'\
+        'activityTol: (0) Mascara de actividad de los tanques por onda cinematica: si el\n'\
+        '   almacenamiento de un tanque cambio menos de esta fraccion desde su ultima solucion\n'\
+        '   no se resuelve y el flujo sale por una recesion extrapolada de esa solucion,\n'\
+        '   cuando entra lluvia o flujo de aguas arriba vuelve a resolverse. En periodos\n'\
+        '   secos (simulaciones largas) evita la mayoria de soluciones. El error en el flujo\n'\
+        '   de cada tanque es menor a h_exp*(1+h_exp)*activityTol**2 y se reporta en\n'\
+        '   Activity_Error. Con 0 siempre resuelve, 1e-2 es un valor tipico. No se usa\n'\
+        '   con sedimentos ni en run_shia_batch.\n'\
         'QsimDataFrame: Retorna un data frame con los caudales simulados indicando su id de acuerdo con el\n'\
         '   que guarda la funcion Save_Net2Map con la opcion Numlink_id = True. \n'\
         'EvpVariable: (False) Asume que la evp del modelo cambia en funcion o no de la radiacion\n'\
@@ -4390,23 +5918,50 @@ class SimuBasin(Basin):
         '   serie: is a time serie of the mean potential evaporation for the watershed.\n'\
         'EvpSerie: default None, however, it could be a ndarray (N_intervals) with the potential evaporation\n'\
         'WheretoStore: (None) Array de numpy o lista  indicando con numeros ascendentes\n'\
+        'rain_dates: (None) Fechas de la lluvia en memoria, si no se dan se toman del\n'\
+        '   DataFrame o se generan cada models.dt desde 2000-01-01.\n'\
+        'nthreads: (1) Hilos de OpenMP, con mas de uno cada intervalo se resuelve en dos fases:\n'\
+        '   balance vertical en paralelo y transito por niveles de la red, con resultados\n'\
+        '   identicos a la ejecucion serial. Con sedimentos, deslizamientos, inundaciones o\n'\
+        '   separacion de flujos o de lluvia se ejecuta en serie. Si la cuenca esta partida\n'\
+        '   con set_Partition cada hilo transita subdominios completos. Si models se\n'\
+        '   compilo sin OpenMP (ver WMF_OPENMP en setup.py) siempre se ejecuta en serie.\n'\
+        'fastKernel: (True) En serie y sin sedimentos, deslizamientos, inundaciones, separacion\n'\
+        '   de flujos o de lluvia ni guardado de vfluxes o rc, usa un recorrido especializado\n'\
+        '   sin esas ramas y con los coeficientes fijos precalculados (identico al general).\n'\
         '\n'\
         'Retornos\n'\
         '----------\n'\
         'Qsim : Caudal simulado en los puntos de control.\n'\
         'Hsim : Humedad simulada en los puntos de control.\n'\
-                #genera las paths
-        rain_pathBin,rain_pathHdr = __Add_hdr_bin_2route__(rain_path)
-        #Obtiene las fechas
-        Rain = read_mean_rain(rain_pathHdr, N_intervals, start_point)
+        'Balance : Error de balance [mm] en cada intervalo (suma sobre los elementos). Las sumas\n'\
+        '   se hacen en doble precision, por lo que es el error de redondeo del estado del\n'\
+        '   modelo (float32) frente a un balance exacto.\n'\
+        'Kinematic_Count : Soluciones de la onda cinematica, iteraciones, soluciones\n'\
+        '   que no convergieron en kinematicN iteraciones y tanques que salieron por recesion.\n'\
+        'Activity_Error : (con activityTol > 0) Cota del error de volumen [mm] por la recesion\n'\
+        '   en cada intervalo (suma sobre los elementos, mismas unidades de Balance).\n'\
+        'Kernel : Recorrido usado, 1: general, 2: especializado, 3: especializado con\n'\
+        '   laderas lineales (solo el cauce por onda cinematica), 4: en paralelo.\n'\
         # De acuerdo al tipo de modelo determina la cantidad de elementos
-        if self.modelType[0] is 'c':
+        if self.modelType[0] == 'c':
             N = self.ncells
-        elif self.modelType[0] is 'h':
+        elif self.modelType[0] == 'h':
             N = self.nhills
+        rain_pathBin, rain_pathHdr, Rain = self.__set_rain_input__(rain_path,
+            N, N_intervals, start_point, rain_dates)
+        #Si la lluvia esta en memoria los encabezados de salida toman las fechas de Rain
+        RainHdr = rain_pathHdr if models.rain_in_memory == 0 else Rain
         #prepara variables globales
         models.rain_first_point = start_point
         models.calc_niter = kinematicN
+        models.calc_tol = kinematicTol
+        models.route_courant = kinematicCourant
+        models.route_maxsub = kinematicMaxSub
+        models.route_hills = 1 if kinematicHills else 0
+        models.act_tol = activityTol
+        models.shia_threads = nthreads
+        models.shia_fast = 1 if fastKernel else 0
         #Prepara terminos para control
         if np.count_nonzero(models.control) == 0 :
             NcontrolQ = 1
@@ -4551,18 +6106,18 @@ class SimuBasin(Basin):
             pathStorageHdr = __Add_hdr_bin_2route__(path_storage)
             #Caso en el que se registra el alm medio
             if models.show_storage == 1:
-                __Save_storage_hdr__(path_sto_hdr,rain_pathHdr,N_intervals,
+                __Save_storage_hdr__(path_sto_hdr,RainHdr,N_intervals,
                     start_point,self,
                     Mean_Storage =np.copy(models.mean_storage),
                     WhereToStore = models.guarda_cond)
             #Caso en el que no hay alm medio para cada uno de los
             else:
-                __Save_storage_hdr__(path_sto_hdr,rain_pathHdr,N_intervals,
+                __Save_storage_hdr__(path_sto_hdr,RainHdr,N_intervals,
                     start_point,self,Mean_Storage=np.zeros((5,N))*-9999,
                     WhereToStore = models.guarda_cond)
         #Escribe el encabezado de los binarios con los datos de los vertical fluxes
         if models.save_vfluxes == 1:
-            __Save_speed_hdr__(path_vflux_hdr,rain_pathHdr,N_intervals,
+            __Save_speed_hdr__(path_vflux_hdr,RainHdr,N_intervals,
                 start_point,self,models.mean_vfluxes,FluxesWhereItSaves)
         #Area de la seccion
         if models.show_area == 1:
@@ -4576,24 +6131,28 @@ class SimuBasin(Basin):
             pathSpeedHdr = __Add_hdr_bin_2route__(path_speed)
             #Caso en el que hay velocidad media para todos los tanques
             if models.show_mean_speed == 1:
-                __Save_speed_hdr__(path_speed_hdr,rain_pathHdr,N_intervals,
+                __Save_speed_hdr__(path_speed_hdr,RainHdr,N_intervals,
                     start_point,self,Mean_Speed = np.copy(models.mean_speed))
             #Caso en el que no hay alm medio para cada uno de los
             else:
-                __Save_speed_hdr__(path_speed_hdr,rain_pathHdr,N_intervals,
+                __Save_speed_hdr__(path_speed_hdr,RainHdr,N_intervals,
                     start_point,self)
 
         if models.save_retorno == 1:
             if models.show_mean_retorno == 1:
-                __Save_retorno_hdr__(path_ret_hdr, rain_pathHdr, N_intervals,
+                __Save_retorno_hdr__(path_ret_hdr, RainHdr, N_intervals,
                     start_point, self, Mean_retorno = models.mean_retorno)
             else:
-                __Save_retorno_hdr__(path_ret_hdr, rain_pathHdr, N_intervals,
+                __Save_retorno_hdr__(path_ret_hdr, RainHdr, N_intervals,
                     start_point, self)
 
         #Campo de lluvia acumulado para el evento
         Retornos.update({'Rain_Acum': models.acum_rain})
         Retornos.update({'Rain_hietogram': models.mean_rain})
+        Retornos.update({'Kinematic_Count': np.copy(models.calc_count)})
+        Retornos.update({'Kernel': int(models.shia_kernel)})
+        if activityTol > 0:
+            Retornos.update({'Activity_Error': np.copy(models.act_error)})
         #Retornos en caso de simular deslizamientos
         if models.sim_slides == 1:
             Retornos.update({'Slides_Map': np.copy(models.sl_slideocurrence)})
@@ -4640,6 +6199,98 @@ class SimuBasin(Basin):
             return Retornos, Qdict
         return Retornos
 
+    def __set_rain_input__(self, rain_path, N, N_intervals, start_point, rain_dates = None):
+        '''Descripcion: Deja lista la lluvia de una ejecucion, en un binario
+        (rain_path es un path) o en memoria (ver run_shia). Retorna las paths
+        del binario y del encabezado, y la serie de lluvia media.'''
+        if isinstance(rain_path, str):
+            #genera las paths
+            rain_pathBin,rain_pathHdr = __Add_hdr_bin_2route__(rain_path)
+            #Obtiene las fechas
+            Rain = read_mean_rain(rain_pathHdr, N_intervals, start_point)
+            models.rain_in_memory = 0
+        else:
+            #Lluvia en memoria
+            posEvento, Fields, Rain = __rain_memory_input__(rain_path, N,
+                N_intervals, start_point, rain_dates)
+            models.rain_fields = Fields.T
+            models.posevento = posEvento
+            models.rain_in_memory = 1
+            rain_pathBin = rain_pathHdr = 'lluvia_en_memoria'
+        return rain_pathBin, rain_pathHdr, Rain
+
+    @__model_method__
+    def run_shia_batch(self, Calibraciones, rain_path, N_intervals, start_point = 1,
+        StorageLoc = None, kinematicN = 5, kinematicTol = 0, EvpVariable = 'sun',
+        QsimDataFrame = True, rain_dates = None):
+        'Descripcion: Ejecuta el modelo para varios juegos de parametros en una\n'\
+        '   sola pasada (models.shia_v1_batch): la lluvia se lee una vez por\n'\
+        '   intervalo y la red se recorre una vez para todos los miembros.\n'\
+        '   Solo entrega caudal y balance, no simula sedimentos, deslizamientos,\n'\
+        '   inundaciones ni separacion de flujos y no guarda estados.\n'\
+        '   Cada miembro da lo mismo que run_shia con su calibracion, salvo el\n'\
+        '   redondeo de las potencias vectoriales (del orden de 1e-6 relativo).\n'\
+        '\n'\
+        'Parametros\n'\
+        '----------\n'\
+        'Calibraciones : Parametros de calibracion [K, 11], en el orden de run_shia.\n'\
+        'rain_path : path del binario de lluvia o lluvia en memoria (ver run_shia).\n'\
+        'N_intervals : Numero de intervalos de tiempo.\n'\
+        'start_point : Punto donde comienza a usar registros de lluvia.\n'\
+        'StorageLoc : (None) Almacenamiento inicial de cada miembro [K, 5, N], si\n'\
+        '   no se da todos parten del almacenamiento global del modelo.\n'\
+        'kinematicN: Cantidad de iteraciones para la solucion de la onda cinematica.\n'\
+        'kinematicTol: (0) Tolerancia de la onda cinematica (ver run_shia).\n'\
+        'EvpVariable: (sun) igual que en run_shia.\n'\
+        'QsimDataFrame: Retorna ademas un DataFrame de caudales por miembro.\n'\
+        'rain_dates: (None) Fechas de la lluvia en memoria.\n'\
+        '\n'\
+        'Retornos\n'\
+        '----------\n'\
+        'Retornos : Diccionario con Qsim [K, Ncontrol, N_intervals], Balance [K, N_intervals],\n'\
+        '   Storage [K, 5, N], Rain_hietogram y Kinematic_Count.\n'\
+        'Qdict : Lista con el DataFrame de caudales de cada miembro (si QsimDataFrame).\n'\
+        # De acuerdo al tipo de modelo determina la cantidad de elementos
+        if self.modelType[0] == 'c':
+            N = self.ncells
+        elif self.modelType[0] == 'h':
+            N = self.nhills
+        Calibraciones = np.atleast_2d(np.asarray(Calibraciones, dtype = float))
+        K = Calibraciones.shape[0]
+        rain_pathBin, rain_pathHdr, Rain = self.__set_rain_input__(rain_path,
+            N, N_intervals, start_point, rain_dates)
+        #prepara variables globales
+        models.rain_first_point = start_point
+        models.calc_niter = kinematicN
+        models.calc_tol = kinematicTol
+        if np.count_nonzero(models.control) == 0 :
+            NcontrolQ = 1
+        else:
+            NcontrolQ = np.count_nonzero(models.control)+1
+        #Almacenamiento inicial de los miembros
+        if StorageLoc is not None:
+            if StorageLoc.shape != (K, 5, N):
+                raise ValueError('Error: almacenamiento debe ser: (%d, 5, %d), y es: %s' % (K, N, str(StorageLoc.shape)))
+        else:
+            StorageLoc = np.zeros((K,5,N))*-9999.0
+        #Evaporacion
+        if EvpVariable:
+            Rad = self.__GetEVP_Serie__(Rain.index)
+        else:
+            models.evpserie = np.ones(N_intervals)
+        # Ejecuta el modelo
+        Qsim, Balance, Alm = models.shia_v1_batch(rain_pathBin, rain_pathHdr,
+            Calibraciones, StorageLoc, NcontrolQ, N_intervals)
+        Retornos = {'Qsim': Qsim, 'Balance': Balance, 'Storage': Alm,
+            'Rain_hietogram': models.mean_rain, 'Kinematic_Count': np.copy(models.calc_count)}
+        if QsimDataFrame:
+            ids = models.control[models.control!=0]
+            Qdict = [pd.DataFrame({str(j): i for i,j in zip(q[1:], ids)}, index = Rain.index)
+                for q in Qsim]
+            return Retornos, Qdict
+        return Retornos
+
+    @__model_method__
     def efficiencia(self, Qobs, Qsim):
         'Descripcion: Calcula diferentes indices de desempeno del modelo\n'\
         '   nash, qpico, rmse, rmseLog, t_pico\n'\
@@ -4732,6 +6383,17 @@ class SimuBasin(Basin):
         #Retorno
         return pop, QsimPar, np.array(fitnesses).T
 
+#Los metodos heredados de Basin que leen la malla de cu (o models) tambien se
+#ejecutan con la cuenca cargada (ver __model_method__)
+for __name in ['Save_Basin2nc', 'GetGeo_Parameters', 'GetGeo_Cell_Basics', 'GetGeo_StreamOrder',
+    'GetGeo_IsoChrones', 'GetGeo_WidthFunction', 'GetGeo_Ppal_Hipsometric', 'GetGeo_IT',
+    'GetGeo_HAND_and_rDUNE', 'GetGeo_Sections', 'Transform_Map2Basin', 'Transform_Basin2Map',
+    'Transform_Basin2Hills', 'Transform_Basin2Asnych', 'Points_Points2Stream',
+    'Points_Points2Basin', 'GetQ_Balance', 'GetQ_Max', 'Save_Net2Map', 'Save_Basin2Map',
+    'Plot_Net', '__GetBasinPolygon__']:
+    setattr(SimuBasin, __name, __model_method__(getattr(Basin, __name)))
+del __name
+
 
 class nsgaii_element:
     def __init__(self, pathLluvia, Qobs, npasos, inicio, SimuBasinElem ,evp =[0,1], infil = [1,200], perco = [1, 40],